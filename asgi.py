@@ -0,0 +1,75 @@
+import asyncio
+import os
+
+# ASGI entry point, e.g. `uvicorn asgi:app --workers 2`. Flask stays a WSGI app: a2wsgi runs each
+# request on a thread pool of ASGI_THREADS threads, and the pipeline runs on the shared transport
+# event loop exactly as it does under gunicorn.
+#
+# This module does for each uvicorn worker what gunicorn.conf.py does for gunicorn workers: metrics go
+# to PROMETHEUS_MULTIPROC_DIR (set before anything imports prometheus_client) and the feedback flusher
+# and job workers run for the life of the process, started and stopped by the ASGI lifespan events.
+# uvicorn's supervisor never imports this module, so the directory can't be wiped once per server start
+# as gunicorn does; instead each worker drops the live gauges left by workers that are no longer running.
+multiproc_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/talmud_query_metrics")
+os.makedirs(multiproc_dir, exist_ok=True)
+
+from prometheus_client import multiprocess
+from main import create_app, job_pool
+from talmud_query.feedback import feedback_flusher
+from talmud_query.transport import warm_up
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError as e:
+    raise ImportError("Serving through asgi.py needs a2wsgi (pip install a2wsgi uvicorn)") from e
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def remove_dead_workers():
+    """Mark every worker with sample files in the metrics directory that has exited as dead."""
+    pids = set()
+    for name in os.listdir(multiproc_dir):
+        pid = name[:-len(".db")].rsplit("_", 1)[-1]
+        if name.endswith(".db") and pid.isdigit():
+            pids.add(int(pid))
+    for pid in pids:
+        if not is_running(pid):
+            multiprocess.mark_process_dead(pid, multiproc_dir)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            remove_dead_workers()
+            # Picks up feedback spooled and jobs queued before a restart without waiting for new requests
+            feedback_flusher.start()
+            job_pool.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # A job still running when this times out is picked up again once its lease lapses
+            await asyncio.to_thread(feedback_flusher.stop, 5)
+            await asyncio.to_thread(job_pool.stop, 5)
+            multiprocess.mark_process_dead(os.getpid(), multiproc_dir)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+warm_up()
+wsgi_app = WSGIMiddleware(create_app(), workers=int(os.getenv("ASGI_THREADS", 32)))
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    else:
+        await wsgi_app(scope, receive, send)
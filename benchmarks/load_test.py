@@ -0,0 +1,262 @@
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import numpy as np
+from benchmarks.mock_servers import add_mock_arguments, mock_env, mock_options, start_mock_servers
+
+# Load/latency benchmark against local OpenAI and Pinecone stand-ins.
+#
+#   python -m benchmarks.load_test --concurrency 1 4 16 --requests 50
+#   python -m benchmarks.load_test --target v1 --concurrency 1 4
+#   python -m benchmarks.load_test --target stream --concurrency 1 4 16
+#   python -m benchmarks.load_test --compare benchmarks/results/<older>.json
+#
+# "http" (the default) serves main.app in-process and drives GET /query over HTTP; "stream" does the
+# same with GET /query/stream, reading the events to the end; "v1" and "v2" call talmud_query_v1/talmud_query_v2 directly. Caches are disabled unless --warm-caches is given,
+# so every request runs the full pipeline. Results are written as JSON, one file per run.
+
+API_KEY = "benchmark-key"
+
+QUESTIONS = [
+    "What are the laws of lighting Shabbat candles?",
+    "When may the evening Shema be recited?",
+    "Who is liable for damage caused by an ox?",
+    "What does the Talmud say about returning lost objects?",
+    "How is the sukkah built and how tall may it be?",
+    "What blessings are said before eating bread?",
+]
+
+# Set before the app is imported, since talmud_query.config reads the environment at import time
+COLD_CACHE_ENV = {
+    "ANSWER_CACHE_ENABLED": "false",
+    "EMBED_CACHE_PATH": "",
+    "EMBED_CACHE_MAX_ITEMS": "0",
+    "FILTER_VERDICT_CACHE_MAX_ITEMS": "0",
+    "PASSAGE_CACHE_MAX_ITEMS": "0",
+}
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def summarize(latencies, errors, elapsed):
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "elapsed_seconds": elapsed,
+        "requests_per_second": (len(latencies) + errors) / elapsed if elapsed else None,
+        "latency_seconds": {
+            "mean": float(np.mean(latencies)) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies) if latencies else None,
+        },
+    }
+
+
+def stage_latency_totals():
+    """(sum, count) per stage from the in-process Prometheus histogram."""
+    from talmud_query.metrics import STAGE_LATENCY
+
+    totals = {}
+    for metric in STAGE_LATENCY.collect():
+        for sample in metric.samples:
+            stage = sample.labels.get("stage")
+            if sample.name.endswith("_sum"):
+                totals.setdefault(stage, [0.0, 0.0])[0] = sample.value
+            elif sample.name.endswith("_count"):
+                totals.setdefault(stage, [0.0, 0.0])[1] = sample.value
+    return totals
+
+
+def stage_latency_delta(before, after):
+    stages = {}
+    for stage, (total, count) in after.items():
+        total -= before.get(stage, (0.0, 0.0))[0]
+        count -= before.get(stage, (0.0, 0.0))[1]
+        if count:
+            stages[stage] = {"calls": int(count), "mean_seconds": total / count}
+    return stages
+
+
+def start_app_server():
+    from werkzeug.serving import make_server
+    import main
+
+    server = make_server("127.0.0.1", 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="benchmark-app", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def make_request_fn(target, base_url, timeout):
+    if target == "http":
+        client = httpx.Client(timeout=timeout, limits=httpx.Limits(max_connections=None, max_keepalive_connections=None))
+
+        def send(query):
+            response = client.get(f"{base_url}/query", params={"query": query}, headers={"X-API-Key": API_KEY})
+            response.raise_for_status()
+            return response.json()
+        return send
+
+    if target == "stream":
+        client = httpx.Client(timeout=timeout, limits=httpx.Limits(max_connections=None, max_keepalive_connections=None))
+
+        def send(query):
+            with client.stream("GET", f"{base_url}/query/stream", params={"query": query}, headers={"X-API-Key": API_KEY}) as response:
+                response.raise_for_status()
+                event = None
+                for line in response.iter_lines():
+                    if line.startswith("event: "):
+                        event = line[len("event: "):]
+                    elif line.startswith("data: ") and event in ("done", "error"):
+                        data = json.loads(line[len("data: "):])
+                        if event == "error":
+                            raise RuntimeError(data.get("error"))
+                        return data
+            raise RuntimeError("stream ended without a done event")
+        return send
+
+    from talmud_query.talmud_query import talmud_query_v1, talmud_query_v2
+    pipeline = talmud_query_v1 if target == "v1" else talmud_query_v2
+    return pipeline
+
+
+def run_level(send, concurrency, requests, servers, offset):
+    for server in servers.values():
+        server.reset_counts()
+    stages_before = stage_latency_totals()
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def one(i):
+        query = f"{QUESTIONS[i % len(QUESTIONS)]} ({offset + i})"
+        started = time.perf_counter()
+        try:
+            send(query)
+        except Exception as e:
+            with lock:
+                errors.append(repr(e))
+            return
+        with lock:
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    result = {"concurrency": concurrency, **summarize(latencies, len(errors), elapsed)}
+    result["outbound"] = {name: server.counts() for name, server in servers.items()}
+    result["outbound_per_request"] = {
+        name: {stage: calls / requests for stage, calls in counts["calls"].items()}
+        for name, counts in result["outbound"].items()
+    }
+    result["stages"] = stage_latency_delta(stages_before, stage_latency_totals())
+    result["sample_errors"] = errors[:5]
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results):
+    """Print the change in throughput and tail latency per concurrency level against an earlier run."""
+    previous = {level["concurrency"]: level for level in baseline["levels"]}
+    print(f"Compared with {baseline.get('commit')} ({baseline.get('started_at')}):")
+    for level in results["levels"]:
+        before = previous.get(level["concurrency"])
+        if not before:
+            continue
+        changes = []
+        for label, new, old in (
+            ("rps", level["requests_per_second"], before["requests_per_second"]),
+            ("p50", level["latency_seconds"]["p50"], before["latency_seconds"]["p50"]),
+            ("p95", level["latency_seconds"]["p95"], before["latency_seconds"]["p95"]),
+            ("p99", level["latency_seconds"]["p99"], before["latency_seconds"]["p99"]),
+        ):
+            if new is not None and old:
+                changes.append(f"{label} {old:.3f} -> {new:.3f} ({(new - old) / old:+.1%})")
+        print(f"  concurrency {level['concurrency']}: " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the query pipeline against local OpenAI/Pinecone stand-ins.")
+    parser.add_argument("--target", choices=["http", "stream", "v1", "v2"], default="http", help="GET /query or /query/stream, or call talmud_query_v1/v2 directly")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=40, help="requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=2, help="unrecorded requests before the first level")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--warm-caches", action="store_true", help="leave the answer/embedding/verdict caches enabled")
+    parser.add_argument("--output", default=None, help="results file (default benchmarks/results/<time>-<commit>.json)")
+    parser.add_argument("--compare", default=None, help="earlier results file to compare against")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    openai_server, pinecone_server = start_mock_servers(**mock_options(args))
+    servers = {"openai": openai_server, "pinecone": pinecone_server}
+    os.environ.update(mock_env(openai_server, pinecone_server))
+    os.environ["API_KEY"] = API_KEY
+    if not args.warm_caches:
+        os.environ.update(COLD_CACHE_ENV)
+
+    app_server, base_url = start_app_server() if args.target in ("http", "stream") else (None, None)
+    send = make_request_fn(args.target, base_url, args.timeout)
+
+    results = {
+        "commit": git_commit(),
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "target": args.target,
+        "warm_caches": args.warm_caches,
+        "mocks": mock_options(args),
+        "levels": [],
+    }
+    try:
+        for i in range(args.warmup):
+            try:
+                send(f"warmup question {i}")
+            except Exception as e:
+                print(f"Warmup request failed: {e!r}")
+
+        offset = 0
+        for concurrency in args.concurrency:
+            level = run_level(send, concurrency, args.requests, servers, offset)
+            offset += args.requests
+            results["levels"].append(level)
+            latency = level["latency_seconds"]
+            print(f"concurrency {concurrency}: {level['requests_per_second']:.2f} req/s, "
+                  f"p50 {latency['p50'] or 0:.3f}s p95 {latency['p95'] or 0:.3f}s p99 {latency['p99'] or 0:.3f}s, "
+                  f"{level['errors']} errors, outbound per request {level['outbound_per_request']}")
+    finally:
+        if app_server:
+            app_server.shutdown()
+        openai_server.stop()
+        pinecone_server.stop()
+
+    output = args.output or os.path.join(
+        "benchmarks", "results",
+        f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}-{results['commit'] or 'unknown'}-{args.target}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
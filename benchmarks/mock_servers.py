@@ -0,0 +1,406 @@
+import argparse
+import base64
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+# Local stand-ins for the OpenAI (chat + embeddings) and Pinecone (control + data plane) HTTP APIs.
+# Each server sleeps for a sampled latency, fails a configurable share of requests and counts
+# calls per stage, so the benchmark can report outbound traffic without paying for live calls.
+# Chat completions with "stream": true are answered as server-sent events, one chunk every
+# stream_interval seconds after the sampled latency (the time to the first token).
+#
+#   python -m benchmarks.mock_servers    # run standalone and print the env vars to point the app at them
+
+BOOKS = ['Berakhot', 'Shabbat', 'Pesachim', 'Yoma', 'Sukkah', 'Megillah', 'Ketubot', 'Gittin', 'Bava_Kamma', 'Sanhedrin']
+
+# Chat requests are told apart by the name of the structured-output schema they ask for
+CHAT_STAGES = {
+    "QueryResponse": "get_queries_from_openai",
+    "FilterVerdicts": "filter_context",
+    "FinalAnswer": "get_final_answer",
+}
+
+
+class Latency:
+    """A latency distribution parsed from "fixed:S", "uniform:LO,HI", "normal:MEAN,STD" or "lognormal:MEDIAN,SIGMA" (seconds)."""
+
+    def __init__(self, spec):
+        kind, _, params = spec.partition(":")
+        self.spec = spec
+        self.kind = kind
+        self.params = [float(value) for value in params.split(",")] if params else [0.0]
+        if kind not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self):
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return random.uniform(*self.params)
+        if self.kind == "normal":
+            return max(0.0, random.gauss(*self.params))
+        return random.lognormvariate(np.log(self.params[0]), self.params[1])
+
+
+class Stream:
+    """A handler payload sent as server-sent events ("data: {chunk}"), one every interval seconds, then "data: [DONE]"."""
+
+    def __init__(self, chunks, interval=0.0):
+        self.chunks = chunks
+        self.interval = interval
+
+
+class MockServer:
+    """Threaded HTTP server with per-stage call counters and latency/error injection."""
+
+    def __init__(self, latency="fixed:0", error_rate=0.0, host="127.0.0.1", port=0):
+        self.latency = Latency(latency) if isinstance(latency, str) else latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.errors = Counter()
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_counts(self):
+        with self._lock:
+            self.calls.clear()
+            self.errors.clear()
+
+    def counts(self):
+        with self._lock:
+            return {"calls": dict(self.calls), "errors": dict(self.errors)}
+
+    def record(self, stage, failed):
+        with self._lock:
+            self.calls[stage] += 1
+            if failed:
+                self.errors[stage] += 1
+
+    def handle(self, method, path, body):
+        """Return (stage, status, payload dict or Stream)."""
+        raise NotImplementedError
+
+    def latency_for(self, stage):
+        return self.latency
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _dispatch(self, method):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length)) if length else {}
+                stage, status, payload = server.handle(method, self.path, body)
+
+                time.sleep(server.latency_for(stage).sample())
+                failed = status < 400 and random.random() < server.error_rate
+                if failed:
+                    status, payload = random.choice([429, 500, 503]), {"error": {"message": "injected failure", "type": "server_error"}}
+                server.record(stage, failed or status >= 400)
+
+                if isinstance(payload, Stream):
+                    self._stream(payload)
+                    return
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, stream):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                events = [f"data: {json.dumps(chunk)}\n\n" for chunk in stream.chunks] + ["data: [DONE]\n\n"]
+                for i, event in enumerate(events):
+                    if i and stream.interval:
+                        time.sleep(stream.interval)
+                    data = event.encode("utf-8")
+                    self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+
+            def do_GET(self):
+                self._dispatch("GET")
+
+            def do_POST(self):
+                self._dispatch("POST")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class MockOpenAI(MockServer):
+    """Chat completions (structured outputs for the three pipeline prompts, streamed or not) and embeddings."""
+
+    def __init__(self, latency="lognormal:0.5,0.4", embed_latency="lognormal:0.08,0.3", error_rate=0.0,
+                 embedding_dim=1536, answer_chars=1200, relevance_rate=0.5, stream_chunk_chars=16, stream_interval=0.01, **kwargs):
+        super().__init__(latency=latency, error_rate=error_rate, **kwargs)
+        self.embed_latency = Latency(embed_latency)
+        self.embedding_dim = embedding_dim
+        self.answer_chars = answer_chars
+        self.relevance_rate = relevance_rate
+        self.stream_chunk_chars = stream_chunk_chars
+        self.stream_interval = stream_interval
+
+    def handle(self, method, path, body):
+        if path.endswith("/embeddings"):
+            return "embeddings", 200, self._embeddings(body)
+        if path.endswith("/chat/completions"):
+            return self._chat(body)
+        return "unknown", 404, {"error": {"message": f"No route for {method} {path}"}}
+
+    def latency_for(self, stage):
+        return self.embed_latency if stage == "embeddings" else self.latency
+
+    def _embeddings(self, body):
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        # A list of ints is one pre-tokenized input, a list of lists is several
+        if inputs and isinstance(inputs[0], int):
+            inputs = [inputs]
+        vectors = np.random.standard_normal((len(inputs), self.embedding_dim)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        if body.get("encoding_format") == "base64":
+            encoded = [base64.b64encode(vector.tobytes()).decode("ascii") for vector in vectors]
+        else:
+            encoded = vectors.tolist()
+        tokens = sum(len(item) if isinstance(item, list) else len(item.split()) for item in inputs)
+        return {
+            "object": "list",
+            "model": body.get("model"),
+            "data": [{"object": "embedding", "index": i, "embedding": vector} for i, vector in enumerate(encoded)],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    def _chat(self, body):
+        response_format = body.get("response_format") or {}
+        schema_spec = response_format.get("json_schema") or {}
+        name = schema_spec.get("name", "")
+        stage = CHAT_STAGES.get(name, "chat")
+        prompt = "\n".join(message.get("content") or "" for message in body.get("messages", []) if isinstance(message.get("content"), str))
+        passage_ids = list(dict.fromkeys(int(passage_id) for passage_id in re.findall(r'(?:"passage_id": |Passage id: |\[passage_id )(\d+)', prompt)))
+
+        if name == "FilterVerdicts":
+            content = {"verdicts": [{"passage_id": passage_id, "relevant": random.random() < self.relevance_rate} for passage_id in passage_ids]}
+        elif name == "FinalAnswer":
+            content = {"answer": _text(self.answer_chars), "relevant_passage_ids": passage_ids[:5]}
+        elif "schema" in schema_spec:
+            content = _fill_schema(schema_spec["schema"], schema_spec["schema"])
+        else:
+            content = _text(self.answer_chars)
+
+        prompt_tokens = len(prompt) // 4
+        completion = json.dumps(content) if not isinstance(content, str) else content
+        response = {
+            "id": f"chatcmpl-mock-{random.getrandbits(32)}",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(completion) // 4, "total_tokens": prompt_tokens + len(completion) // 4},
+        }
+        if body.get("stream"):
+            return stage, 200, Stream(self._chunks(response, completion, body.get("stream_options") or {}), self.stream_interval)
+        return stage, 200, {
+            **response,
+            "object": "chat.completion",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": completion, "refusal": None},
+                "finish_reason": "stop",
+                "logprobs": None,
+            }],
+        }
+
+    def _chunks(self, response, completion, stream_options):
+        """chat.completion.chunk payloads carrying the completion stream_chunk_chars characters at a time."""
+        base = {"id": response["id"], "object": "chat.completion.chunk", "created": response["created"], "model": response["model"]}
+        pieces = [completion[i:i + self.stream_chunk_chars] for i in range(0, len(completion), self.stream_chunk_chars)]
+        chunks = [
+            {**base, "choices": [{"index": 0, "delta": {"role": "assistant", "content": piece} if i == 0 else {"content": piece}, "finish_reason": None, "logprobs": None}]}
+            for i, piece in enumerate(pieces)
+        ]
+        chunks.append({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop", "logprobs": None}]})
+        if stream_options.get("include_usage"):
+            chunks.append({**base, "choices": [], "usage": response["usage"]})
+        return chunks
+
+
+class MockPinecone(MockServer):
+    """Control plane (describe index) and data plane (query, upsert) on one port. The described host
+    carries an explicit http:// scheme so the app sends data-plane calls back to this server."""
+
+    def __init__(self, latency="lognormal:0.06,0.3", error_rate=0.0, passage_chars=900, corpus_size=5000, **kwargs):
+        super().__init__(latency=latency, error_rate=error_rate, **kwargs)
+        self.passage_chars = passage_chars
+        self.corpus_size = corpus_size
+
+    def handle(self, method, path, body):
+        if method == "GET" and path.startswith("/indexes/"):
+            return "describe_index", 200, {"name": path.rsplit("/", 1)[-1], "host": self.url, "status": {"ready": True}}
+        if method == "POST" and path == "/query":
+            return "query", 200, self._query(body)
+        if method == "POST" and path == "/vectors/upsert":
+            return "upsert", 200, {"upsertedCount": len(body.get("vectors", []))}
+        return "unknown", 404, {"message": f"No route for {method} {path}"}
+
+    def _query(self, body):
+        top_k = body.get("topK", 10)
+        passage_ids = random.sample(range(1, self.corpus_size + 1), min(top_k, self.corpus_size))
+        scores = sorted((random.uniform(0.7, 0.9) for _ in passage_ids), reverse=True)
+        matches = []
+        for passage_id, score in zip(passage_ids, scores):
+            match = {"id": f"{passage_id}-0", "score": score, "values": []}
+            if body.get("includeMetadata"):
+                match["metadata"] = self._metadata(passage_id)
+            matches.append(match)
+        return {"matches": matches, "namespace": body.get("namespace", "")}
+
+    def _metadata(self, passage_id):
+        english_text = _text(self.passage_chars)
+        return {
+            "passage_id": passage_id,
+            "hebrew_text": "א" * (self.passage_chars // 2),
+            "english_text": english_text,
+            "text_to_embed": english_text,
+            "translation_id": passage_id,
+            "book_name": BOOKS[passage_id % len(BOOKS)],
+            "page_number": f"{passage_id % 150 + 2}a",
+        }
+
+
+WORDS = "the rabbis taught that one who recites shema in the evening must say blessings before and after it on sabbath festival".split()
+
+
+def _text(chars):
+    words = []
+    length = 0
+    while length < chars:
+        word = random.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+
+def _fill_schema(schema, root):
+    """Produce a value matching a (structured-outputs style) JSON schema."""
+    if "$ref" in schema:
+        return _fill_schema(root["$defs"][schema["$ref"].rsplit("/", 1)[-1]], root)
+    if "anyOf" in schema:
+        options = [option for option in schema["anyOf"] if option.get("type") != "null"]
+        return _fill_schema(options[0], root) if options else None
+    if "enum" in schema:
+        return schema["enum"][0]
+    kind = schema.get("type")
+    if kind == "object":
+        return {key: _fill_schema(value, root) for key, value in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [_fill_schema(schema.get("items", {}), root) for _ in range(3)]
+    if kind == "integer":
+        return random.randint(1, 1000)
+    if kind == "number":
+        return random.random()
+    if kind == "boolean":
+        return True
+    if kind == "null":
+        return None
+    return _text(60)
+
+
+def start_mock_servers(openai_latency="lognormal:0.5,0.4", embed_latency="lognormal:0.08,0.3", pinecone_latency="lognormal:0.06,0.3",
+                       openai_error_rate=0.0, pinecone_error_rate=0.0, embedding_dim=1536, passage_chars=900, answer_chars=1200,
+                       relevance_rate=0.5, stream_interval=0.01):
+    openai_server = MockOpenAI(latency=openai_latency, embed_latency=embed_latency, error_rate=openai_error_rate,
+                               embedding_dim=embedding_dim, answer_chars=answer_chars, relevance_rate=relevance_rate,
+                               stream_interval=stream_interval).start()
+    pinecone_server = MockPinecone(latency=pinecone_latency, error_rate=pinecone_error_rate, passage_chars=passage_chars).start()
+    return openai_server, pinecone_server
+
+
+def mock_env(openai_server, pinecone_server):
+    """Environment variables that point the app at the stand-ins."""
+    return {
+        "OPENAI_API_KEY": "mock-key",
+        "OPENAI_BASE_URL": f"{openai_server.url}/v1",
+        "PINECONE_API_KEY": "mock-key",
+        "PINECONE_CONTROLLER_URL": pinecone_server.url,
+        "VECTOR_BACKEND": "pinecone",
+        "SLIM_VECTOR_METADATA": "false",
+        "LANGCHAIN_TRACING_V2": "false",
+    }
+
+
+def add_mock_arguments(parser):
+    parser.add_argument("--openai-latency", default="lognormal:0.5,0.4", help="chat completion latency distribution")
+    parser.add_argument("--embed-latency", default="lognormal:0.08,0.3", help="embeddings latency distribution")
+    parser.add_argument("--pinecone-latency", default="lognormal:0.06,0.3", help="Pinecone latency distribution")
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--pinecone-error-rate", type=float, default=0.0)
+    parser.add_argument("--embedding-dim", type=int, default=1536)
+    parser.add_argument("--passage-chars", type=int, default=900, help="size of each passage's text in Pinecone metadata")
+    parser.add_argument("--answer-chars", type=int, default=1200)
+    parser.add_argument("--relevance-rate", type=float, default=0.5, help="share of passages the mock filter marks relevant")
+    parser.add_argument("--stream-interval", type=float, default=0.01, help="seconds between streamed chat completion chunks")
+
+
+def mock_options(args):
+    return {
+        "openai_latency": args.openai_latency,
+        "embed_latency": args.embed_latency,
+        "pinecone_latency": args.pinecone_latency,
+        "openai_error_rate": args.openai_error_rate,
+        "pinecone_error_rate": args.pinecone_error_rate,
+        "embedding_dim": args.embedding_dim,
+        "passage_chars": args.passage_chars,
+        "answer_chars": args.answer_chars,
+        "relevance_rate": args.relevance_rate,
+        "stream_interval": args.stream_interval,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run local OpenAI and Pinecone stand-ins.")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    openai_server, pinecone_server = start_mock_servers(**mock_options(args))
+    for key, value in mock_env(openai_server, pinecone_server).items():
+        print(f"export {key}={value}")
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps({"openai": openai_server.counts(), "pinecone": pinecone_server.counts()}))
+    except KeyboardInterrupt:
+        openai_server.stop()
+        pinecone_server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+from talmud_query.startup import PRELOAD_MODULES
+from benchmarks.load_test import git_commit
+
+# Cold-start benchmark: import time and resident memory per module, each measured in a fresh interpreter.
+#
+#   python -m benchmarks.startup
+#   python -m benchmarks.startup --compare benchmarks/results/<older>-startup.json
+#
+# "main" is what a web worker pays before it can serve; the talmud_query modules and heavy
+# dependencies show where that goes. "main + preload" adds everything GUNICORN_PRELOAD loads.
+
+MODULES = [
+    "main",
+    "talmud_query.talmud_query",
+    "talmud_query.pinecone_utils",
+    "talmud_query.embed_utils",
+    "talmud_query.transport",
+    "talmud_query.metrics",
+    "talmud_query.db",
+    "flask",
+    "httpx",
+    "numpy",
+    "pydantic",
+] + [module for module in PRELOAD_MODULES if not module.startswith("talmud_query")]
+
+# Runs in the child interpreter; prints {"seconds", "rss_before", "rss_after"} as JSON
+MEASURE = """
+import json, os, resource, sys, time
+
+def rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == "darwin" else usage * 1024
+
+before = rss()
+started = time.perf_counter()
+for module in sys.argv[1].split(","):
+    __import__(module)
+if len(sys.argv) > 2:
+    from talmud_query.startup import preload_modules
+    preload_modules()
+seconds = time.perf_counter() - started
+print(json.dumps({"seconds": seconds, "rss_before": before, "rss_after": rss()}))
+"""
+
+
+def measure(modules, preload=False, repeat=3):
+    """Best-of-repeat import time and RSS growth for importing modules in a fresh interpreter."""
+    runs = []
+    for _ in range(repeat):
+        args = [sys.executable, "-c", MEASURE, ",".join(modules)] + (["preload"] if preload else [])
+        completed = subprocess.run(args, capture_output=True, text=True, env={**os.environ, "PYTHONWARNINGS": "ignore"})
+        if completed.returncode != 0:
+            return {"error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "import failed"}
+        runs.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+    best = min(runs, key=lambda run: run["seconds"])
+    return {
+        "seconds": best["seconds"],
+        "rss_mb": best["rss_after"] / 2 ** 20,
+        "rss_delta_mb": (best["rss_after"] - best["rss_before"]) / 2 ** 20,
+    }
+
+
+def slowest_imports(module, limit=15):
+    """The modules with the largest cumulative import time under `python -X importtime`."""
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True)
+    imports = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        try:
+            imports.append({"module": name.strip(), "cumulative_seconds": int(cumulative) / 1e6})
+        except ValueError:
+            continue
+    return sorted(imports, key=lambda item: item["cumulative_seconds"], reverse=True)[:limit]
+
+
+def compare(baseline, results):
+    previous = baseline["modules"]
+    print(f"Compared with {baseline.get('commit')} ({baseline.get('started_at')}):")
+    for name, current in results["modules"].items():
+        before = previous.get(name)
+        if not before or "seconds" not in before or "seconds" not in current:
+            continue
+        print(f"  {name:32} {before['seconds']:.3f}s -> {current['seconds']:.3f}s ({(current['seconds'] - before['seconds']) / before['seconds']:+.1%}), "
+              f"rss {before['rss_mb']:.0f} -> {current['rss_mb']:.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import time and RSS of the app and its heavy modules.")
+    parser.add_argument("--repeat", type=int, default=3, help="fresh interpreters per module (best run is kept)")
+    parser.add_argument("--output", default=None, help="results file (default benchmarks/results/<time>-<commit>-startup.json)")
+    parser.add_argument("--compare", default=None, help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    results = {
+        "commit": git_commit(),
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "modules": {},
+    }
+    results["modules"]["(interpreter)"] = measure(["sys"], repeat=args.repeat)
+    for module in MODULES:
+        results["modules"][module] = measure([module], repeat=args.repeat)
+    results["modules"]["main + preload"] = measure(["main"], preload=True, repeat=args.repeat)
+    results["slowest_imports"] = slowest_imports("main")
+
+    for name, result in results["modules"].items():
+        if "error" in result:
+            print(f"{name:32} error: {result['error']}")
+        else:
+            print(f"{name:32} {result['seconds']:7.3f}s  rss {result['rss_mb']:6.1f} MB  (+{result['rss_delta_mb']:.1f} MB)")
+
+    output = args.output or os.path.join(
+        "benchmarks", "results", f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}-{results['commit'] or 'unknown'}-startup.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
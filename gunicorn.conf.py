@@ -0,0 +1,56 @@
+import os
+import shutil
+
+# Threaded workers: each request mostly waits on OpenAI/Pinecone, so one worker process serves many
+# in-flight queries on its threads. The pipeline itself runs on the worker's shared event loop.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+threads = int(os.getenv("GUNICORN_THREADS", 32))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 180))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+# Optionally load the app and its heavy dependencies once in the master so workers fork with them
+# already imported (faster worker start, shared memory). Off by default so workers reload code on HUP.
+preload_app = os.getenv("GUNICORN_PRELOAD", "false").lower() == "true"
+
+# Prometheus multiprocess mode: every worker writes its metric samples under PROMETHEUS_MULTIPROC_DIR
+# and /metrics aggregates them. The directory is wiped on startup so stale samples don't leak in.
+multiproc_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/talmud_query_metrics")
+
+
+def on_starting(server):
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    os.makedirs(multiproc_dir, exist_ok=True)
+
+
+def when_ready(server):
+    if preload_app:
+        from talmud_query.startup import preload_modules
+        timings = preload_modules()
+        server.log.info("Preloaded %d modules in %.2fs", len(timings), sum(timings.values()))
+
+
+def post_fork(server, worker):
+    # Each worker creates its HTTP/OpenAI clients and event loop once, before taking traffic
+    from talmud_query.transport import warm_up
+    warm_up()
+    # Picks up feedback spooled before a restart even if no new feedback arrives
+    from talmud_query.feedback import feedback_flusher
+    feedback_flusher.start()
+    # Likewise, jobs queued or leased before a restart are resumed without waiting for a new POST /query
+    from main import job_pool
+    job_pool.start()
+
+
+def worker_exit(server, worker):
+    from talmud_query.feedback import feedback_flusher
+    feedback_flusher.stop(timeout=5)
+    # A job still running when this times out is picked up again once its lease lapses
+    from main import job_pool
+    job_pool.stop(timeout=5)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,11 +1,25 @@
 from flask import Flask, jsonify
 import os
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, request, jsonify, Response, stream_with_context, url_for, g, send_file
 from flask_cors import CORS
 import time
-from talmud_query.talmud_query import talmud_query_v1, talmud_query_v2
-from talmud_query.feedback import feedback_to_langsmith
+from talmud_query.talmud_query import talmud_query_v1, talmud_query_v2, talmud_query_v2_async, talmud_query_batch_async, talmud_query_coalesced, filter_verdict_cache, expansion_cache
+from talmud_query.feedback import feedback_to_langsmith, get_feedback_stats
+from talmud_query.transport import run_async, submit_async, warm_up
+from talmud_query.embed_cache import get_embedding_cache_stats
+from talmud_query.db import get_pool_stats
+from talmud_query.embed_utils import embed_text_openai_batch_async
+from talmud_query.answer_cache import answer_cache, get_answer_cache_stats, invalidate_answer_cache
+from talmud_query.answer_cache import normalize_query
+from talmud_query.references import parse_references
+from talmud_query.single_flight import single_flight
+from talmud_query.jobs import JobQueue, JobWorkerPool, QueueFullError
+from talmud_query.config import ANSWER_CACHE_ENABLED, SSE_HEARTBEAT_SECONDS, SINGLE_FLIGHT_ENABLED, JOB_POLL_INTERVAL, BATCH_MAX_QUERIES
+from talmud_query.metrics import render_metrics
+from talmud_query.profiling import profile_trigger, start_request_profile, profiled, list_profiles, get_profile_path
 import uuid
+import json
+import queue
 import asyncio
 from functools import wraps
 
@@ -18,21 +32,21 @@ load_dotenv()
 REACT_APP_URL = os.getenv("REACT_APP_URL")
 BACKEND_JS_URL = os.getenv("BACKEND_JS_URL")
 
-# Initialize Flask app
-app = Flask(__name__)
-# Configure CORS to allow all origins
-CORS(app, resources={r"/*": {"origins": "*"}})
+# All routes live on a blueprint so create_app() can build fresh app instances
+routes = Blueprint("talmud_query", __name__)
+
+def has_api_key():
+    return request.headers.get('X-API-Key') == os.getenv('API_KEY')
 
 def require_api_key(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        api_key = request.headers.get('X-API-Key')
-        if api_key != os.getenv('API_KEY'):
+        if not has_api_key():
             return jsonify({"error": "Invalid API key"}), 401
         return f(*args, **kwargs)
     return decorated
 
-@app.route('/feedback', methods=['GET'])
+@routes.route('/feedback', methods=['GET'])
 @require_api_key
 def query_feedback():
     score, comment, run_id = request.args.get("score"), request.args.get("comment"), request.args.get("run_id")
@@ -41,36 +55,413 @@ def query_feedback():
         return jsonify({"error": "Score or comment is required"}), 400
     if not run_id:
         return jsonify({"error": "Run ID is required"}), 400
-    
-    feedback_to_langsmith(run_id, score, comment)
+    try:
+        int(score)
+    except ValueError:
+        return jsonify({"error": "Score must be an integer"}), 400
+
+    # Spooled and acknowledged here; a background thread sends it to LangSmith
+    if not feedback_to_langsmith(run_id, score, comment):
+        return jsonify({"error": "Failed to save feedback"}), 500
     
     return jsonify({
         "success": True
     })
 
-@app.route('/query', methods=['GET'])
+def semantic_lookup_applies(query):
+    # "Berakhot 2a" and "Berakhot 2b" embed almost identically; only the exact text may match a page reference
+    return ANSWER_CACHE_ENABLED and not parse_references(query)
+
+async def run_pipeline(query, on_event=None):
+    """Run the v2 pipeline while the answer cache is searched for a near-duplicate question. The query's
+    embedding is started here and shared with the pipeline's raw-query retrieval, so a cache miss costs no
+    extra round trip. Returns (response, cached, query embedding); on a hit the pipeline is cancelled and
+    response is [cached answer, None]."""
+    if not semantic_lookup_applies(query):
+        return await profiled(talmud_query_v2_async(query, on_event=on_event)), False, None
+
+    embedding = asyncio.ensure_future(embed_text_openai_batch_async([query]))
+    # Pipeline events are held until the lookup misses, so a hit doesn't stream the start of a cancelled run
+    held = []
+    def emit(event, data):
+        if held is None:
+            on_event(event, data)
+        else:
+            held.append((event, data))
+    pipeline = asyncio.ensure_future(profiled(talmud_query_v2_async(query, on_event=emit if on_event else None, query_embedding=embedding)))
+
+    query_embedding = cached = None
+    try:
+        query_embedding = (await asyncio.shield(embedding))[0]
+        cached = await asyncio.to_thread(answer_cache.get_similar, query_embedding)
+    except Exception as e:
+        print(f"Error embedding query for answer cache: {e}")
+    if cached:
+        pipeline.cancel()
+        return [cached, None], True, query_embedding
+
+    if on_event:
+        for event, data in held:
+            on_event(event, data)
+    held = None
+    return await pipeline, False, query_embedding
+
+def has_answer(response):
+    return bool(response and response[0] and response[0].get("answer"))
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def cached_answer_events(cached):
+    yield format_sse("answer_delta", {"text": cached["answer"]})
+    yield format_sse("done", {**cached, "run_id": str(uuid.uuid4()), "cached": True})
+
+def answer_query(query):
+    """Answer a query through the answer cache, request coalescing and the v2 pipeline. Shared by
+    GET /query and the job workers."""
+    if ANSWER_CACHE_ENABLED:
+        cached = answer_cache.get_exact(query)
+        if cached:
+            return {
+                **cached,
+                "run_id": str(uuid.uuid4()),
+                "cached": True
+            }
+
+    # Flask 1.x has no async views, so the async pipeline runs on the shared transport event loop
+    lookup = {}
+    def run():
+        response, lookup["cached"], lookup["embedding"] = run_async(run_pipeline(query))
+        return response
+
+    coalesced = False
+    if SINGLE_FLIGHT_ENABLED:
+        # Identical concurrent queries share one pipeline run; each follower gets its own run id, linked to the leader's
+        response, coalesced = single_flight.do(normalize_query(query), run, publish_if=has_answer)
+        if coalesced and response:
+            response = talmud_query_coalesced(query, response[1], response[0])
+    else:
+        response = run()
+
+    if lookup.get("cached"):
+        return {
+            **response[0],
+            "run_id": str(uuid.uuid4()),
+            "cached": True
+        }
+
+    answer = response[0]["answer"] if response and response[0] else None
+    relevant_passage_ids = response[0]["relevant_passage_ids"] if response and response[0] else None
+    degradations = response[0].get("degradations") if response and response[0] else None
+    run_id = str(response[1]) if response and response[1] else str(uuid.uuid4())
+
+    # Only keep real answers; "no passages found", answers cut short by the deadline and errors are worth retrying
+    if ANSWER_CACHE_ENABLED and answer and relevant_passage_ids and not degradations and not coalesced:
+        answer_cache.set(query, {"answer": answer, "relevant_passage_ids": relevant_passage_ids}, embedding=lookup.get("embedding"))
+
+    result = {
+        "answer": answer,
+        "relevant_passage_ids": relevant_passage_ids,
+        "run_id": run_id
+    }
+    if degradations:
+        result["degradations"] = degradations
+    if coalesced:
+        result["coalesced"] = True
+    return result
+
+def run_query_job(query):
+    result = answer_query(query)
+    # The pipeline reports its own failures as an empty answer; raising lets the job be retried
+    if not result["answer"]:
+        raise RuntimeError("pipeline returned no answer")
+    return result
+
+job_queue = JobQueue()
+job_pool = JobWorkerPool(job_queue, run_query_job)
+
+@routes.route('/query', methods=['GET'])
 @require_api_key
 def query_talmud():
     query = request.args.get("query")
     if not query:
         return jsonify({"error": "Query is required"}), 400
-    
-    response = talmud_query_v2(query)
 
-    answer = response[0]["answer"] if response and response[0] else None
-    relevant_passage_ids = response[0]["relevant_passage_ids"] if response and response[0] else None
-    run_id = response[1] if response and response[1] else str(uuid.uuid4())
+    return jsonify(answer_query(query))
+
+@routes.route('/query', methods=['POST'])
+@require_api_key
+def submit_query_job():
+    body = request.get_json(silent=True) or {}
+    query = body.get("query") or request.form.get("query") or request.args.get("query")
+    if not query:
+        return jsonify({"error": "Query is required"}), 400
+
+    try:
+        job_id = job_queue.enqueue(query)
+    except QueueFullError as e:
+        return jsonify({"error": f"Job queue is full: {e}"}), 503, {"Retry-After": "30"}
 
     return jsonify({
-        "answer": answer,
-        "relevant_passage_ids": relevant_passage_ids,
-        "run_id": run_id
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": url_for(".get_query_job", job_id=job_id),
+        "events_url": url_for(".query_job_events", job_id=job_id)
+    }), 202, {"Location": url_for(".get_query_job", job_id=job_id)}
+
+@routes.route('/query/batch', methods=['POST'])
+@require_api_key
+def query_talmud_batch():
+    """Answer {"queries": [...]} in one pipeline run that shares embedding, retrieval and passage loading.
+    Clients that accept text/event-stream get a "result" event per question as it is answered, then "done"
+    with the batch stats; everyone else gets {"results", "stats"} once the whole batch is done."""
+    body = request.get_json(silent=True) or {}
+    queries = body.get("queries")
+    if not isinstance(queries, list) or not queries or not all(isinstance(query, str) and query.strip() for query in queries):
+        return jsonify({"error": "queries must be a non-empty list of questions"}), 400
+    if len(queries) > BATCH_MAX_QUERIES:
+        return jsonify({"error": f"At most {BATCH_MAX_QUERIES} queries per batch"}), 400
+
+    if request.accept_mimetypes.best != "text/event-stream":
+        try:
+            return jsonify(run_async(profiled(talmud_query_batch_async(queries))))
+        except Exception as e:
+            print(f"Error answering batch: {e}")
+            return jsonify({"error": "Failed to answer the batch"}), 500
+
+    # Results arrive from the shared event loop thread; None marks the end of the run
+    events = queue.Queue()
+    future = submit_async(profiled(talmud_query_batch_async(queries, on_result=lambda index, result: events.put(("result", {"index": index, **result})))))
+    future.add_done_callback(lambda _: events.put(None))
+
+    def generate():
+        while True:
+            try:
+                item = events.get(timeout=SSE_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            if item is None:
+                break
+            yield format_sse(*item)
+
+        try:
+            response = future.result()
+        except Exception as e:
+            print(f"Error answering batch: {e}")
+            yield format_sse("error", {"error": "Failed to answer the batch"})
+            return
+        yield format_sse("done", {"stats": response["stats"]})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
     })
 
-@app.before_request
+@routes.route('/query/<job_id>', methods=['GET'])
+@require_api_key
+def get_query_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+@routes.route('/query/<job_id>/events', methods=['GET'])
+@require_api_key
+def query_job_events(job_id):
+    if job_queue.get(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    def generate():
+        # One "status" event per change, then "done" with the finished job
+        last_status, last_event = None, time.monotonic()
+        while True:
+            job = job_queue.get(job_id)
+            if job is None:
+                yield format_sse("error", {"error": "Job expired"})
+                return
+            if job["status"] in ("succeeded", "failed"):
+                yield format_sse("done", job)
+                return
+            if (job["status"], job["attempts"]) != last_status:
+                last_status = (job["status"], job["attempts"])
+                yield format_sse("status", {"status": job["status"], "attempts": job["attempts"]})
+                last_event = time.monotonic()
+            elif time.monotonic() - last_event >= SSE_HEARTBEAT_SECONDS:
+                yield ": keep-alive\n\n"
+                last_event = time.monotonic()
+            time.sleep(JOB_POLL_INTERVAL)
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@routes.route('/query/stream', methods=['GET'])
+@require_api_key
+def query_talmud_stream():
+    query = request.args.get("query")
+    if not query:
+        return jsonify({"error": "Query is required"}), 400
+
+    if ANSWER_CACHE_ENABLED:
+        cached = answer_cache.get_exact(query)
+        if cached:
+            return Response(cached_answer_events(cached), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    # Pipeline events arrive from the shared event loop thread; None marks the end of the run
+    events = queue.Queue()
+    future = submit_async(run_pipeline(query, on_event=lambda event, data: events.put((event, data))))
+    future.add_done_callback(lambda _: events.put(None))
+
+    def generate():
+        while True:
+            try:
+                item = events.get(timeout=SSE_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                # Comment line to keep proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+                continue
+            if item is None:
+                break
+            yield format_sse(*item)
+
+        try:
+            response, cached, query_embedding = future.result()
+        except Exception as e:
+            print(f"Error streaming query: {e}")
+            yield format_sse("error", {"error": "Failed to answer the query"})
+            return
+        if cached:
+            yield from cached_answer_events(response[0])
+            return
+
+        answer = response[0]["answer"] if response and response[0] else None
+        relevant_passage_ids = response[0]["relevant_passage_ids"] if response and response[0] else None
+        degradations = response[0].get("degradations") if response and response[0] else None
+        run_id = response[1] if response and response[1] else str(uuid.uuid4())
+
+        if ANSWER_CACHE_ENABLED and answer and relevant_passage_ids and not degradations:
+            answer_cache.set(query, {"answer": answer, "relevant_passage_ids": relevant_passage_ids}, embedding=query_embedding)
+
+        done = {
+            "answer": answer,
+            "relevant_passage_ids": relevant_passage_ids,
+            "run_id": str(run_id)
+        }
+        if degradations:
+            done["degradations"] = degradations
+        yield format_sse("done", done)
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@routes.route('/query/cache', methods=['DELETE'])
+@require_api_key
+def invalidate_query_cache():
+    # Without a query parameter the whole answer cache is cleared
+    removed = invalidate_answer_cache(request.args.get("query"))
+    if removed is None:
+        return jsonify({"error": "Failed to invalidate the answer cache"}), 503
+    return jsonify({
+        "invalidated": removed
+    })
+
+@routes.route('/cache/stats', methods=['GET'])
+@require_api_key
+def cache_stats():
+    return jsonify({
+        "embeddings": get_embedding_cache_stats(),
+        "answers": get_answer_cache_stats(),
+        "filter_verdicts": filter_verdict_cache.stats(),
+        "expansions": expansion_cache.stats(),
+        "jobs": job_queue.stats(),
+        "db_pool": get_pool_stats(),
+        "feedback": get_feedback_stats()
+    })
+
+@routes.route('/metrics', methods=['GET'])
+@require_api_key
+def metrics():
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+@routes.route('/profiles', methods=['GET'])
+@require_api_key
+def profiles():
+    return jsonify({
+        "profiles": [
+            {
+                **profile,
+                "html_url": url_for(".get_profile", profile_id=profile["id"], format="html"),
+                "speedscope_url": url_for(".get_profile", profile_id=profile["id"], format="speedscope")
+            }
+            for profile in list_profiles(limit=request.args.get("limit", 50, type=int))
+        ]
+    })
+
+@routes.route('/profiles/<profile_id>', methods=['GET'])
+@require_api_key
+def get_profile(profile_id):
+    format = request.args.get("format", "html")
+    path = get_profile_path(profile_id, format)
+    if not path:
+        return jsonify({"error": "Profile not found"}), 404
+    return send_file(os.path.abspath(path), mimetype="text/html" if format == "html" else "application/json")
+
+# Requests that are never profiled
+UNPROFILED_ENDPOINTS = {"talmud_query.profiles", "talmud_query.get_profile", "talmud_query.metrics"}
+
+@routes.before_app_request
 def before_request():
     if request.method == 'OPTIONS':
         return '', 200
+    if request.endpoint not in UNPROFILED_ENDPOINTS:
+        # Only callers with the API key can ask for a profile; sampled requests need no header
+        requested = request.headers.get('X-Profile') == '1' and has_api_key()
+        trigger = profile_trigger(requested)
+        if trigger:
+            g.profile = start_request_profile(f"{request.method} {request.full_path.rstrip('?')}", trigger)
+
+def finish_profile(profile, status):
+    try:
+        profile.finish(status)
+    except Exception as e:
+        print(f"Error writing profile: {e}")
+
+@routes.after_app_request
+def after_request(response):
+    profile = g.get("profile")
+    if profile:
+        # A sampled request from a caller without the API key is profiled but not told where the profile is
+        if has_api_key():
+            response.headers["X-Profile-URL"] = url_for("talmud_query.get_profile", profile_id=profile.id, format="html")
+            response.headers["X-Profile-Speedscope-URL"] = url_for("talmud_query.get_profile", profile_id=profile.id, format="speedscope")
+        # Finished once the body is sent, so a streamed response is profiled to its end
+        response.call_on_close(lambda: finish_profile(profile, response.status_code))
+    return response
+
+@routes.teardown_app_request
+def teardown_request(exc):
+    profile = g.pop("profile", None)
+    if profile:
+        profile.release()
+
+def create_app():
+    """Build the Flask app. Request handling keeps no per-request global state and every client it uses
+    is process-wide, so the app can be served by threaded (gthread) workers or through asgi.py."""
+    app = Flask(__name__)
+    # Configure CORS to allow all origins
+    CORS(app, resources={r"/*": {"origins": "*"}})
+    app.register_blueprint(routes)
+    return app
+
+app = create_app()
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=int(os.getenv("PORT", 5001)))
\ No newline at end of file
+    warm_up()
+    # Under gunicorn the job workers are started per worker process in gunicorn.conf.py
+    job_pool.start()
+    app.run(debug=True, host='0.0.0.0', port=int(os.getenv("PORT", 5001)), threaded=True)
\ No newline at end of file
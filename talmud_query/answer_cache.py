@@ -0,0 +1,234 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+import numpy as np
+from talmud_query.config import ANSWER_CACHE_PATH, ANSWER_CACHE_MAX_ITEMS, ANSWER_CACHE_TTL, ANSWER_CACHE_SIMILARITY_THRESHOLD, ANSWER_CACHE_FLUSH_INTERVAL
+from talmud_query.metrics import record_cache_lookups
+
+# Response cache in front of /query. Exact matches are found by normalized query text; near-duplicates
+# by cosine similarity between query embeddings. Entries expire after a TTL and the least recently
+# used entry is evicted once the cache is full.
+#
+# Entries and hit counters live in a SQLite file on the host, so every gunicorn worker and worker.py see
+# the same answers, an invalidation reaches all of them, and /cache/stats reports the whole host. Each
+# process keeps the embedding matrix for similarity lookups in memory and reloads it when the cache's
+# generation (bumped on every write) changes.
+#
+# Lookups only read the file. Hit/miss counts and last-used times are gathered in memory and written at most
+# every ANSWER_CACHE_FLUSH_INTERVAL seconds (and with each write), so cache hits don't queue up on SQLite's
+# write lock. Eviction order and the stats of other workers may lag by that interval.
+
+STAT_NAMES = ("exact_hits", "semantic_hits", "misses", "evictions")
+
+
+def normalize_query(query):
+    query = re.sub(r"[^\w\s]", " ", query.lower())
+    return " ".join(query.split())
+
+
+class AnswerCache:
+    def __init__(self, path=ANSWER_CACHE_PATH, max_items=ANSWER_CACHE_MAX_ITEMS, ttl=ANSWER_CACHE_TTL, similarity_threshold=ANSWER_CACHE_SIMILARITY_THRESHOLD,
+                 flush_interval=ANSWER_CACHE_FLUSH_INTERVAL):
+        self.path = path
+        self.max_items = max_items
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Counts and last-used times not yet written to the file
+        self._pending_lock = threading.Lock()
+        self._pending_counts = Counter()
+        self._pending_used = {}
+        self._flushed_at = time.monotonic()
+        self._matrix = None
+        self._matrix_keys = []
+        self._matrix_generation = None
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, response TEXT, embedding BLOB, expires_at REAL, used_at REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS answers_used_at ON answers (used_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS answer_stats (name TEXT PRIMARY KEY, value INTEGER)")
+            conn.execute("CREATE TABLE IF NOT EXISTS answer_generation (id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER)")
+            conn.execute("INSERT OR IGNORE INTO answer_generation (id, value) VALUES (0, 0)")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, work):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(conn)
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _count(self, conn, name, amount=1):
+        conn.execute(
+            "INSERT INTO answer_stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount)
+        )
+
+    def _bump_generation(self, conn):
+        conn.execute("UPDATE answer_generation SET value = value + 1 WHERE id = 0")
+
+    def _note(self, kind, key=None):
+        """Count a lookup (and mark key used) in memory, writing the batch out once it is old enough."""
+        with self._pending_lock:
+            self._pending_counts[kind] += 1
+            if key is not None:
+                self._pending_used[key] = time.time()
+            due = time.monotonic() - self._flushed_at >= self.flush_interval
+        if due:
+            try:
+                self._transaction(self._flush)
+            except sqlite3.Error as e:
+                print(f"Error writing answer cache stats: {e}")
+
+    def _flush(self, conn):
+        """Write the pending counts and last-used times inside the caller's transaction."""
+        with self._pending_lock:
+            counts, used = self._pending_counts, self._pending_used
+            self._pending_counts, self._pending_used = Counter(), {}
+            self._flushed_at = time.monotonic()
+        try:
+            for name, amount in counts.items():
+                self._count(conn, name, amount)
+            conn.executemany("UPDATE answers SET used_at = MAX(used_at, ?) WHERE key = ?", [(used_at, key) for key, used_at in used.items()])
+        except BaseException:
+            with self._pending_lock:
+                self._pending_counts.update(counts)
+                self._pending_used = {**used, **self._pending_used}
+            raise
+
+    def _hit(self, conn, key, kind):
+        """The cached response for key if it has not expired, counting the hit."""
+        row = conn.execute("SELECT response FROM answers WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        if row is None:
+            return None
+        self._note(kind, key)
+        record_cache_lookups("answers", 1, 0)
+        return json.loads(row[0])
+
+    def _similarity_matrix(self, conn):
+        generation = conn.execute("SELECT value FROM answer_generation WHERE id = 0").fetchone()[0]
+        with self._lock:
+            if generation != self._matrix_generation:
+                rows = conn.execute("SELECT key, embedding FROM answers WHERE embedding IS NOT NULL").fetchall()
+                self._matrix_keys = [key for key, _ in rows]
+                if rows:
+                    self._matrix = np.stack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows])
+                else:
+                    self._matrix = np.empty((0, 0), dtype=np.float32)
+                self._matrix_generation = generation
+            return self._matrix, self._matrix_keys
+
+    def get_exact(self, query):
+        try:
+            return self._hit(self._connection(), normalize_query(query), "exact_hits")
+        except sqlite3.Error as e:
+            print(f"Error reading answer cache: {e}")
+            return None
+
+    def get_similar(self, embedding):
+        vector = _unit_vector(embedding)
+        try:
+            conn = self._connection()
+            matrix, keys = self._similarity_matrix(conn)
+            if len(keys):
+                scores = matrix @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity_threshold:
+                    cached = self._hit(conn, keys[best], "semantic_hits")
+                    if cached is not None:
+                        return cached
+            self._note("misses")
+        except sqlite3.Error as e:
+            print(f"Error reading answer cache: {e}")
+        record_cache_lookups("answers", 0, 1)
+        return None
+
+    def set(self, query, response, embedding=None):
+        key = normalize_query(query)
+        blob = _unit_vector(embedding).tobytes() if embedding is not None else None
+
+        def store(conn):
+            self._flush(conn)
+            now = time.time()
+            conn.execute("DELETE FROM answers WHERE expires_at <= ?", (now,))
+            conn.execute(
+                "INSERT OR REPLACE INTO answers (key, response, embedding, expires_at, used_at) VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(response), blob, now + self.ttl, now)
+            )
+            evicted = conn.execute(
+                "DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY used_at DESC LIMIT -1 OFFSET ?)", (self.max_items,)
+            ).rowcount
+            if evicted:
+                self._count(conn, "evictions", evicted)
+            self._bump_generation(conn)
+
+        try:
+            self._transaction(store)
+        except sqlite3.Error as e:
+            print(f"Error writing answer cache: {e}")
+
+    def invalidate(self, query=None):
+        """Drop one query (matched by normalized text) or, with no query, the whole cache, in every worker on
+        the host. Returns the number removed, or None if the cache could not be changed."""
+        def remove(conn):
+            if query is None:
+                removed = conn.execute("DELETE FROM answers").rowcount
+            else:
+                removed = conn.execute("DELETE FROM answers WHERE key = ?", (normalize_query(query),)).rowcount
+            self._bump_generation(conn)
+            return removed
+
+        try:
+            return self._transaction(remove)
+        except sqlite3.Error as e:
+            print(f"Error invalidating answer cache: {e}")
+            return None
+
+    def stats(self):
+        """Counts for the whole host, including this process's unwritten ones, or {"error": ...} if the cache can't be read."""
+        try:
+            self._transaction(self._flush)
+            conn = self._connection()
+            stats = {name: 0 for name in STAT_NAMES}
+            stats.update(dict(conn.execute("SELECT name, value FROM answer_stats").fetchall()))
+            stats["items"] = conn.execute("SELECT COUNT(*) FROM answers WHERE expires_at > ?", (time.time(),)).fetchone()[0]
+            return stats
+        except sqlite3.Error as e:
+            print(f"Error reading answer cache stats: {e}")
+            return {"error": "answer cache unavailable"}
+
+
+def _unit_vector(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+answer_cache = AnswerCache()
+
+
+def get_answer_cache_stats():
+    return answer_cache.stats()
+
+
+def invalidate_answer_cache(query=None):
+    return answer_cache.invalidate(query)
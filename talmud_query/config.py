@@ -1,8 +1,13 @@
+import json
 import os
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 
+# Service endpoints (overridden by the benchmark suite to point at local stand-ins)
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")  # None uses the OpenAI default
+PINECONE_CONTROLLER_URL = os.getenv("PINECONE_CONTROLLER_URL", "https://api.pinecone.io")
+
 # Configuration constants
 OPENAI_MODEL = 'text-embedding-ada-002'
 OPENAI_EMBEDDING_MODEL = 'text-embedding-ada-002'
@@ -11,6 +16,169 @@ NAMESPACE = "SWD-passages-openai"
 VECTOR_DIM = 1536
 PRINT_OUTPUT = False
 
+# Seconds between keep-alive comments on /query/stream while a stage is still running
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", 15))
+
+# Retrieval backend: "pinecone" (remote) or "local" (memory-mapped index built by `python -m talmud_query.local_index`)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "pinecone")
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "indexes")
+LOCAL_INDEX_NPROBE = int(os.getenv("LOCAL_INDEX_NPROBE", 32))  # IVF lists scanned per unfiltered query
+
+# Slim vector metadata: vectors carry only filter fields, queries return ids and scores,
+# and passage text is loaded from Postgres (with an in-process LRU in front of it)
+SLIM_VECTOR_METADATA = os.getenv("SLIM_VECTOR_METADATA", "false").lower() == "true"
+PASSAGE_CACHE_MAX_ITEMS = int(os.getenv("PASSAGE_CACHE_MAX_ITEMS", 50000))
+TRANSLATION_VERSION = 'Sefaria-William-Davidson'
+
+# Reranking between retrieval and filtering (reciprocal-rank fusion, optionally with BM25)
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "true").lower() == "true"
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", 40))
+RRF_K = int(os.getenv("RRF_K", 60))
+RERANK_USE_BM25 = os.getenv("RERANK_USE_BM25", "true").lower() == "true"
+RERANK_BM25_WEIGHT = float(os.getenv("RERANK_BM25_WEIGHT", 1.0))
+
+# Hybrid retrieval: Postgres full-text search (`python -m talmud_query.fulltext` builds its indexes) fused
+# with the vector lookups. Precise lexical hits let the vector channel run with a smaller k and fewer
+# fused passages go on to filtering.
+FULLTEXT_ENABLED = os.getenv("FULLTEXT_ENABLED", "false").lower() == "true"
+FULLTEXT_K = int(os.getenv("FULLTEXT_K", 20))
+FULLTEXT_WEIGHT = float(os.getenv("FULLTEXT_WEIGHT", 2.0))  # fusion weight of the lexical list against each vector list
+FULLTEXT_INCLUDE_HEBREW = os.getenv("FULLTEXT_INCLUDE_HEBREW", "false").lower() == "true"
+HYBRID_VECTOR_K = int(os.getenv("HYBRID_VECTOR_K", 15))
+HYBRID_RERANK_TOP_N = int(os.getenv("HYBRID_RERANK_TOP_N", 24))
+
+# Speculative retrieval: the raw query is embedded and looked up (filtered to any tractate it names) while
+# gpt-4o expands it, unless the expansion is already cached; expansions are cached per normalized query
+SPECULATIVE_RETRIEVAL_ENABLED = os.getenv("SPECULATIVE_RETRIEVAL_ENABLED", "true").lower() == "true"
+EXPANSION_CACHE_MAX_ITEMS = int(os.getenv("EXPANSION_CACHE_MAX_ITEMS", 10000))
+EXPANSION_CACHE_TTL = float(os.getenv("EXPANSION_CACHE_TTL", 24 * 3600))
+
+# Client-side OpenAI rate limiting shared by every worker on the host (see rate_limit.py). Limits are per
+# quota group (a model name without its snapshot date, unless OPENAI_QUOTA_GROUPS maps it elsewhere, e.g.
+# '{"gpt-4o-mini": "gpt-4o"}'); OPENAI_RATE_LIMITS overrides them, e.g. '{"gpt-4o-mini": {"rpm": 10000, "tpm": 10000000}}'
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH", "cache/rate_limit.sqlite3")
+OPENAI_RPM_LIMIT = float(os.getenv("OPENAI_RPM_LIMIT", 5000))
+OPENAI_TPM_LIMIT = float(os.getenv("OPENAI_TPM_LIMIT", 800000))
+OPENAI_RATE_LIMITS = json.loads(os.getenv("OPENAI_RATE_LIMITS", "{}"))
+OPENAI_QUOTA_GROUPS = json.loads(os.getenv("OPENAI_QUOTA_GROUPS", "{}"))
+RATE_LIMIT_FILTER_RESERVE = float(os.getenv("RATE_LIMIT_FILTER_RESERVE", 0.2))  # share of each bucket filtering leaves free
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", 4))
+RATE_LIMIT_BACKOFF = float(os.getenv("RATE_LIMIT_BACKOFF", 1.0))
+RATE_LIMIT_POLL_INTERVAL = float(os.getenv("RATE_LIMIT_POLL_INTERVAL", 0.05))
+RATE_LIMIT_MAX_POLL_INTERVAL = float(os.getenv("RATE_LIMIT_MAX_POLL_INTERVAL", 0.5))  # waiters behind the head back off up to this
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", 120))  # after this long in the queue a call goes out anyway
+
+# Per-request deadline for the /query pipeline, with per-stage caps. When time runs short the pipeline
+# degrades: filtering is skipped (the top fused passages go straight to the final answer), and with too
+# little left for the final answer the response is the retrieved passages alone.
+QUERY_DEADLINE_SECONDS = float(os.getenv("QUERY_DEADLINE_SECONDS", 60))
+EXPANSION_TIMEOUT = float(os.getenv("EXPANSION_TIMEOUT", 12))
+RETRIEVAL_TIMEOUT = float(os.getenv("RETRIEVAL_TIMEOUT", 10))
+FILTER_TIMEOUT = float(os.getenv("FILTER_TIMEOUT", 20))
+FINAL_ANSWER_RESERVE = float(os.getenv("FINAL_ANSWER_RESERVE", 20))  # kept back for the final answer by earlier stages
+FILTER_MIN_SECONDS = float(os.getenv("FILTER_MIN_SECONDS", 3))
+FINAL_ANSWER_MIN_SECONDS = float(os.getenv("FINAL_ANSWER_MIN_SECONDS", 5))
+DEGRADED_CONTEXT_PASSAGES = int(os.getenv("DEGRADED_CONTEXT_PASSAGES", 10))
+PINECONE_TIMEOUT = float(os.getenv("PINECONE_TIMEOUT", 5))
+PINECONE_HEDGE_DELAY = float(os.getenv("PINECONE_HEDGE_DELAY", 0.5))  # 0 disables hedged queries
+
+# Batch queries (POST /query/batch): questions filtered and answered at once, texts per embedding call, and
+# vector lookups in flight at once
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", 500))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 16))
+BATCH_EMBED_SIZE = int(os.getenv("BATCH_EMBED_SIZE", 256))
+BATCH_LOOKUP_CONCURRENCY = int(os.getenv("BATCH_LOOKUP_CONCURRENCY", 32))
+
+# Direct-reference fast path: queries naming a page ("Berakhot 2a") load it from Postgres instead of
+# running query expansion and vector retrieval
+REFERENCE_FAST_PATH_ENABLED = os.getenv("REFERENCE_FAST_PATH_ENABLED", "true").lower() == "true"
+REFERENCE_MAX_PAGES = int(os.getenv("REFERENCE_MAX_PAGES", 4))  # longest range (in sides) taken as a reference
+REFERENCE_MAX_PASSAGES = int(os.getenv("REFERENCE_MAX_PASSAGES", 80))
+
+# Relevance filtering (several passages graded per gpt-4o-mini call)
+FILTER_BATCH_SIZE = int(os.getenv("FILTER_BATCH_SIZE", 8))
+FILTER_CONCURRENCY = int(os.getenv("FILTER_CONCURRENCY", 8))
+FILTER_MAX_RETRIES = int(os.getenv("FILTER_MAX_RETRIES", 3))
+FILTER_RETRY_BACKOFF = float(os.getenv("FILTER_RETRY_BACKOFF", 0.5))
+FILTER_VERDICT_CACHE_MAX_ITEMS = int(os.getenv("FILTER_VERDICT_CACHE_MAX_ITEMS", 100000))
+FILTER_VERDICT_CACHE_TTL = float(os.getenv("FILTER_VERDICT_CACHE_TTL", 7 * 24 * 3600))
+
+# Corpus ingestion (`python -m talmud_query.ingest`)
+INGEST_EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH_SIZE", 256))
+INGEST_EMBED_CONCURRENCY = int(os.getenv("INGEST_EMBED_CONCURRENCY", 4))
+INGEST_UPSERT_BATCH_SIZE = int(os.getenv("INGEST_UPSERT_BATCH_SIZE", 100))
+INGEST_MAX_RETRIES = int(os.getenv("INGEST_MAX_RETRIES", 6))
+
+# Postgres connection pool (shared by every thread in a worker)
+DB_POOL_MIN_CONNECTIONS = int(os.getenv("DB_POOL_MIN_CONNECTIONS", 1))
+DB_POOL_MAX_CONNECTIONS = int(os.getenv("DB_POOL_MAX_CONNECTIONS", 20))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))  # seconds to wait for a free connection
+DB_HEALTH_CHECK_INTERVAL = float(os.getenv("DB_HEALTH_CHECK_INTERVAL", 30))  # idle seconds before a connection is pinged
+
+# HTTP transport (shared keep-alive clients for Pinecone and OpenAI)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 60))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() == "true"
+INDEX_HOST_TTL = float(os.getenv("INDEX_HOST_TTL", 3600))  # seconds a resolved Pinecone index host is reused
+
+# Embedding cache (in-memory LRU in front of a SQLite file shared by all workers; empty path disables the disk tier)
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "cache/embeddings.sqlite3")
+EMBED_CACHE_MAX_ITEMS = int(os.getenv("EMBED_CACHE_MAX_ITEMS", 10000))
+
+# Answer cache in front of /query (exact normalized match, then cosine similarity on the query embedding),
+# kept in a SQLite file shared by every worker on the host
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "cache/answers.sqlite3")
+ANSWER_CACHE_MAX_ITEMS = int(os.getenv("ANSWER_CACHE_MAX_ITEMS", 1000))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 24 * 3600))
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", 0.97))
+ANSWER_CACHE_FLUSH_INTERVAL = float(os.getenv("ANSWER_CACHE_FLUSH_INTERVAL", 5))  # seconds between writes of hit counts and last-used times
+
+# Final-answer context packing: token budget for the passages, smallest useful truncated passage,
+# and whether the Hebrew text is sent alongside the English
+FINAL_ANSWER_CONTEXT_TOKENS = int(os.getenv("FINAL_ANSWER_CONTEXT_TOKENS", 12000))
+FINAL_ANSWER_MIN_PASSAGE_TOKENS = int(os.getenv("FINAL_ANSWER_MIN_PASSAGE_TOKENS", 64))
+FINAL_ANSWER_INCLUDE_HEBREW = os.getenv("FINAL_ANSWER_INCLUDE_HEBREW", "false").lower() == "true"
+
+# Coalescing of identical in-flight /query requests, within a worker and across workers through a
+# SQLite file on the host (empty path keeps it per worker)
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+SINGLE_FLIGHT_PATH = os.getenv("SINGLE_FLIGHT_PATH", "cache/single_flight.sqlite3")
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv("SINGLE_FLIGHT_TIMEOUT", 180))  # longest wait on another worker, and claim lease
+SINGLE_FLIGHT_POLL_INTERVAL = float(os.getenv("SINGLE_FLIGHT_POLL_INTERVAL", 0.1))
+SINGLE_FLIGHT_RESULT_TTL = float(os.getenv("SINGLE_FLIGHT_RESULT_TTL", 10))  # how long a published result is kept for waiters
+
+# Asynchronous query jobs (POST /query): durable SQLite queue and the worker pool that drains it.
+# JOB_WORKERS=0 leaves the draining to a separate `python worker.py` on the same host.
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "cache/jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", 5))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 300))  # a running job is retried if its worker is silent this long
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", 3600))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 0.5))
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", 1000))
+
+# /feedback is spooled to a SQLite file and sent to LangSmith in the background, retrying with backoff
+FEEDBACK_SPOOL_PATH = os.getenv("FEEDBACK_SPOOL_PATH", "cache/feedback.sqlite3")
+FEEDBACK_FLUSH_INTERVAL = float(os.getenv("FEEDBACK_FLUSH_INTERVAL", 2))
+FEEDBACK_BATCH_SIZE = int(os.getenv("FEEDBACK_BATCH_SIZE", 50))
+FEEDBACK_RETRY_BACKOFF = float(os.getenv("FEEDBACK_RETRY_BACKOFF", 5))
+FEEDBACK_MAX_BACKOFF = float(os.getenv("FEEDBACK_MAX_BACKOFF", 600))
+FEEDBACK_MAX_ATTEMPTS = int(os.getenv("FEEDBACK_MAX_ATTEMPTS", 20))
+FEEDBACK_LEASE_SECONDS = float(os.getenv("FEEDBACK_LEASE_SECONDS", 60))  # a claimed batch is resent if not confirmed by then
+
+# Opt-in request profiling (pyinstrument): requests sending "X-Profile: 1" with a valid API key, plus a random
+# PROFILE_SAMPLE_RATE share of all requests, are profiled and written to PROFILE_DIR (listed at /profiles)
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "true").lower() == "true"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.001))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "cache/profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", 200))  # oldest profiles are deleted beyond this
+
 
 POSSIBLE_BOOKS = [
     'Berakhot', 'Eiruvin', 'Pesachim', 'Rosh Hashanah', 'Yoma', 'Beitzah', 
@@ -0,0 +1,78 @@
+import functools
+import re
+from talmud_query.config import FINAL_ANSWER_CONTEXT_TOKENS, FINAL_ANSWER_MIN_PASSAGE_TOKENS, FINAL_ANSWER_INCLUDE_HEBREW
+
+# Packs filtered passages into the final-answer prompt. Only the fields the answer needs are kept
+# (id, book, page and text, with markup stripped), in a compact plain-text layout, most relevant
+# first, within a token budget. Once the budget runs out the next passage is truncated and the
+# rest are dropped, so the lowest-ranked passages are always the ones that lose out.
+
+TAG_PATTERN = re.compile(r"<[^>]+>")
+TRUNCATION_MARKER = " …"
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name):
+    """The tiktoken encoding for a model, or None if it cannot be loaded (tokens are then estimated)."""
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        print(f"Error loading tiktoken encoding for {model_name}, estimating token counts instead: {e}")
+        return None
+
+
+def count_tokens(text, encoding):
+    return len(encoding.encode(text)) if encoding else len(text) // 4 + 1
+
+
+def truncate_to_tokens(text, max_tokens, encoding):
+    if encoding:
+        return encoding.decode(encoding.encode(text)[:max_tokens])
+    return text[:max_tokens * 4]
+
+
+def clean_text(text):
+    return " ".join(TAG_PATTERN.sub("", text or "").split())
+
+
+def relevance_key(passage):
+    # Reranked passages carry a fused score; otherwise fall back to the vector score
+    fused_score = passage.get('fused_score')
+    return fused_score if fused_score is not None else (passage.get('score') or 0)
+
+
+def format_passage_header(passage):
+    return f"[passage_id {passage['passage_id']}] {passage['book_name']} {passage['page_number']}"
+
+
+def pack_context(context, model_name, max_tokens=None, include_hebrew=FINAL_ANSWER_INCLUDE_HEBREW, min_passage_tokens=FINAL_ANSWER_MIN_PASSAGE_TOKENS):
+    """Return (context text, passage ids included) for the final-answer prompt."""
+    max_tokens = max_tokens or FINAL_ANSWER_CONTEXT_TOKENS
+    encoding = get_encoding(model_name)
+
+    blocks, included = [], []
+    remaining = max_tokens
+    for passage in sorted(context, key=relevance_key, reverse=True):
+        header = format_passage_header(passage)
+        text = clean_text(passage['english_text'])
+        if include_hebrew and passage.get('hebrew_text'):
+            text = f"{clean_text(passage['hebrew_text'])}\n{text}"
+
+        header_tokens = count_tokens(header, encoding) + 2  # newline after the header, blank line between blocks
+        text_tokens = count_tokens(text, encoding)
+        if header_tokens + text_tokens > remaining:
+            available = remaining - header_tokens - count_tokens(TRUNCATION_MARKER, encoding)
+            if available >= min_passage_tokens:
+                blocks.append(f"{header}\n{truncate_to_tokens(text, available, encoding)}{TRUNCATION_MARKER}")
+                included.append(passage['passage_id'])
+            break
+
+        blocks.append(f"{header}\n{text}")
+        included.append(passage['passage_id'])
+        remaining -= header_tokens + text_tokens
+
+    return "\n\n".join(blocks), included
@@ -1,35 +1,157 @@
 import os
+import threading
+import time
 import psycopg2
 from psycopg2 import pool
 from dotenv import load_dotenv
+from talmud_query.config import DB_POOL_MIN_CONNECTIONS, DB_POOL_MAX_CONNECTIONS, DB_POOL_TIMEOUT, DB_HEALTH_CHECK_INTERVAL
+from talmud_query.metrics import record_db_checkout, set_db_connections_in_use
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Initialize connection pool as None
+# Process-wide thread-safe pool, created on first use. Checkouts block (up to DB_POOL_TIMEOUT) instead
+# of failing when every connection is busy, and a connection that has sat idle for longer than
+# DB_HEALTH_CHECK_INTERVAL is pinged before it is handed out, so dropped connections get replaced.
+#
+# The slot semaphore lives for the whole process. If the pool is closed and re-created while connections
+# are checked out, each connection still goes back to (or is closed with) the pool it came from and frees
+# its slot in the same semaphore.
+#
+# Checkouts and idle connections are counted here rather than read off the pool's private state. Like
+# ThreadedConnectionPool, the count assumes the pool opens DB_POOL_MIN_CONNECTIONS up front, hands out an idle
+# connection whenever it has one, and keeps a returned connection (rather than closing it) only up to that many.
+
 connection_pool = None
+_pool_lock = threading.Lock()
+_pool_slots = None
+_last_used = {}
+_checked_out = {}  # id(conn) -> pool the connection was taken from
+_idle_connections = 0  # open connections waiting in the current pool
+_stats_lock = threading.Lock()
+
+
+class PoolTimeoutError(Exception):
+    pass
+
 
 def initialize_connection_pool():
-    global connection_pool
+    global connection_pool, _pool_slots, _idle_connections
     if connection_pool is None or connection_pool.closed:
-        connection_pool = psycopg2.pool.SimpleConnectionPool(
-            1, 10,  # Min and max number of connections
-            user=os.getenv('DB_USER'),
-            host=os.getenv('DB_HOST'),
-            database=os.getenv('DB_DATABASE'),
-            password=os.getenv('DB_PASSWORD'),
-            port=os.getenv('DB_PORT'),
-            sslmode='require'  # enables SSL
-        )
+        with _pool_lock:
+            if connection_pool is None or connection_pool.closed:
+                connection_pool = psycopg2.pool.ThreadedConnectionPool(
+                    DB_POOL_MIN_CONNECTIONS, DB_POOL_MAX_CONNECTIONS,
+                    user=os.getenv('DB_USER'),
+                    host=os.getenv('DB_HOST'),
+                    database=os.getenv('DB_DATABASE'),
+                    password=os.getenv('DB_PASSWORD'),
+                    port=os.getenv('DB_PORT'),
+                    sslmode='require'  # enables SSL
+                )
+                if _pool_slots is None:
+                    _pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_CONNECTIONS)
+                _last_used.clear()
+                with _stats_lock:
+                    _idle_connections = DB_POOL_MIN_CONNECTIONS
+
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    last_used = _last_used.get(id(conn))
+    if last_used is not None and time.monotonic() - last_used < DB_HEALTH_CHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _take_idle():
+    global _idle_connections
+    with _stats_lock:
+        _idle_connections = max(_idle_connections - 1, 0)
+
 
 def get_connection():
     initialize_connection_pool()  # Ensure the pool is initialized before getting a connection
-    return connection_pool.getconn()
+    started = time.monotonic()
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        record_db_checkout("timeout", time.monotonic() - started)
+        raise PoolTimeoutError(f"No database connection available after {DB_POOL_TIMEOUT}s")
+
+    source = connection_pool
+    try:
+        conn = source.getconn()
+        _take_idle()
+        while not _is_healthy(conn):
+            record_db_checkout("replaced", 0)
+            _last_used.pop(id(conn), None)
+            source.putconn(conn, close=True)
+            conn = source.getconn()
+            _take_idle()
+    except BaseException:
+        _pool_slots.release()
+        raise
+
+    _checked_out[id(conn)] = source
+    record_db_checkout("ok", time.monotonic() - started)
+    set_db_connections_in_use(len(_checked_out))
+    return conn
+
 
 def release_connection(conn):
-    if connection_pool:
-        connection_pool.putconn(conn)
+    global _idle_connections
+    source = _checked_out.pop(id(conn), None)
+    if source is None:
+        return
+    try:
+        if source.closed:
+            # The pool was closed (and maybe re-created) while this connection was out
+            _last_used.pop(id(conn), None)
+            conn.close()
+        else:
+            _last_used[id(conn)] = time.monotonic()
+            source.putconn(conn)
+            # The pool closes connections beyond the ones it keeps idle
+            if conn.closed:
+                _last_used.pop(id(conn), None)
+            elif source is connection_pool:
+                with _stats_lock:
+                    _idle_connections += 1
+    finally:
+        _pool_slots.release()
+    set_db_connections_in_use(len(_checked_out))
+
+
+def get_pool_stats():
+    in_use = len(_checked_out)
+    idle = _idle_connections if connection_pool is not None and not connection_pool.closed else 0
+    return {"open": in_use + idle, "in_use": in_use, "idle": idle, "max": DB_POOL_MAX_CONNECTIONS}
+
 
 def close_pool():
+    global _idle_connections
     if connection_pool:
-        connection_pool.closeall()
\ No newline at end of file
+        connection_pool.closeall()
+        with _stats_lock:
+            _idle_connections = 0
+
+
+def _reset_after_fork():
+    # A forked worker must not share the parent's sockets; it opens its own pool on first use
+    global connection_pool, _pool_lock, _pool_slots, _idle_connections, _stats_lock
+    connection_pool = None
+    _pool_lock = threading.Lock()
+    _pool_slots = None
+    _idle_connections = 0
+    _stats_lock = threading.Lock()
+    _last_used.clear()
+    _checked_out.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,6 +1,13 @@
 from talmud_query.db import get_connection, release_connection
+from talmud_query.config import PASSAGE_CACHE_MAX_ITEMS, TRANSLATION_VERSION
+from talmud_query.lru import LRUCache
+from talmud_query.metrics import timed
+
+# Hydrated passages keyed on (passage_id, version_name)
+passage_cache = LRUCache(PASSAGE_CACHE_MAX_ITEMS, name="passages")
 
 # Step 1: Fetch all passages from the database for books that do NOT include "rashi" in their name
+@timed("db.fetch_passages")
 def fetch_passages():
     conn = get_connection()
     try:
@@ -18,6 +25,7 @@ def fetch_passages():
     
     return passages
 
+@timed("db.fetch_english_passages")
 def fetch_english_passages():
     conn = get_connection()
     try:
@@ -50,6 +58,7 @@ def fetch_english_passages():
     
     return formatted_passages
 
+@timed("db.fetch_sentence_passages")
 def fetch_sentence_passages():
     conn = get_connection()
     try:
@@ -83,6 +92,7 @@ def fetch_sentence_passages():
 
     return formatted_passages
 
+@timed("db.fetch_bolded_words_passages")
 def fetch_bolded_words_passages():
     conn = get_connection()
     try:
@@ -115,6 +125,42 @@ def fetch_bolded_words_passages():
 
     return formatted_passages
 
+def stream_english_passages(after_passage_id=0, batch_size=1000):
+    """Yield lists of passages in passage_id order, reading through a server-side cursor."""
+    conn = get_connection()
+    try:
+        with conn.cursor(name="stream_english_passages") as cursor:
+            cursor.itersize = batch_size
+            cursor.execute("""
+                SELECT passages.passage_id, passages.hebrew_text, translations.text, translations.translation_id, books.name, pages.page_number
+                FROM passages
+                JOIN pages ON passages.page_id = pages.page_id
+                JOIN books ON passages.book_id = books.book_id
+                JOIN translations ON passages.passage_id = translations.passage_id
+                WHERE books.name NOT ILIKE '%%rashi%%'
+                AND translations.version_name = 'Sefaria-William-Davidson'
+                AND passages.passage_id > %s
+                ORDER BY passages.passage_id
+            """, (after_passage_id,))
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield [
+                    {
+                        'passage_id': row[0],
+                        'hebrew_text': row[1],
+                        'english_text': row[2],
+                        'translation_id': row[3],
+                        'book_name': row[4],
+                        'page_number': row[5]
+                    }
+                    for row in rows
+                ]
+    finally:
+        release_connection(conn)
+
+@timed("db.get_passage_text")
 def get_passage_text(passage_id):
     conn = get_connection()
     try:
@@ -130,6 +176,7 @@ def get_passage_text(passage_id):
     
     return passage[0]
 
+@timed("db.get_translation_text")
 def get_translation_text(translation_id):
     conn = get_connection()
     try:
@@ -146,32 +193,86 @@ def get_translation_text(translation_id):
     return translation[0]
 
 
-def get_passage_and_translation(passage_id, version_name):
+@timed("db.get_passages_and_translations")
+def get_passages_and_translations(passage_ids, version_name=TRANSLATION_VERSION):
+    """Return {passage_id: passage} for the given ids, loading cache misses with one bulk query."""
+    passage_ids = list(dict.fromkeys(passage_ids))
+    cached = passage_cache.get_many([(passage_id, version_name) for passage_id in passage_ids])
+    passages = {passage_id: passage for (passage_id, _), passage in cached.items()}
+
+    missing_ids = [passage_id for passage_id in passage_ids if passage_id not in passages]
+    if missing_ids:
+        conn = get_connection()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT passages.passage_id, passages.hebrew_text, translations.text, translations.translation_id, books.name, pages.page_number
+                    FROM passages
+                    JOIN pages ON passages.page_id = pages.page_id
+                    JOIN books ON passages.book_id = books.book_id
+                    JOIN translations ON passages.passage_id = translations.passage_id
+                    WHERE passages.passage_id = ANY(%s)
+                    AND translations.version_name = %s
+                """, (missing_ids, version_name))
+                rows = cursor.fetchall()
+        finally:
+            release_connection(conn)
+
+        loaded = {
+            row[0]: {
+                'passage_id': row[0],
+                'hebrew_text': row[1],
+                'english_text': row[2],
+                'translation_id': row[3],
+                'book_name': row[4],
+                'page_number': row[5]
+            }
+            for row in rows
+        }
+        passage_cache.set_many({(passage_id, version_name): passage for passage_id, passage in loaded.items()})
+        passages.update(loaded)
+
+    return passages
+
+@timed("db.get_passages_by_reference")
+def get_passages_by_reference(references, version_name=TRANSLATION_VERSION, limit=None):
+    """Return the passages on the referenced pages (see talmud_query.references), in page order."""
+    conditions = " OR ".join(["(books.name = ANY(%s) AND pages.page_number = ANY(%s))"] * len(references))
+    params = [value for reference in references for value in (reference["book_names"], reference["page_numbers"])]
     conn = get_connection()
     try:
         with conn.cursor() as cursor:
-            cursor.execute("""
+            cursor.execute(f"""
                 SELECT passages.passage_id, passages.hebrew_text, translations.text, translations.translation_id, books.name, pages.page_number
                 FROM passages
-                JOIN pages ON passages.page_id = pages.page_id      
+                JOIN pages ON passages.page_id = pages.page_id
+                JOIN books ON passages.book_id = books.book_id
                 JOIN translations ON passages.passage_id = translations.passage_id
-                WHERE passages.passage_id = %s
+                WHERE ({conditions})
                 AND translations.version_name = %s
-            """, (passage_id, version_name))
-            passage = cursor.fetchone()
+                ORDER BY passages.passage_id
+                LIMIT %s
+            """, (*params, version_name, limit))
+            rows = cursor.fetchall()
     finally:
         release_connection(conn)
-    
-    formatted_passage = {
-        'passage_id': passage[0],
-        'hebrew_text': passage[1],
-        'english_text': passage[2],
-        'translation_id': passage[3],
-        'book_name': passage[4],
-        'page_number': passage[5]
-    }
-
-    return formatted_passage
+
+    passages = [
+        {
+            'passage_id': row[0],
+            'hebrew_text': row[1],
+            'english_text': row[2],
+            'translation_id': row[3],
+            'book_name': row[4],
+            'page_number': row[5]
+        }
+        for row in rows
+    ]
+    passage_cache.set_many({(passage['passage_id'], version_name): passage for passage in passages})
+    return passages
+
+def get_passage_and_translation(passage_id, version_name):
+    return get_passages_and_translations([passage_id], version_name).get(passage_id)
 
 import re
 
@@ -0,0 +1,84 @@
+import asyncio
+import contextvars
+import time
+from contextlib import contextmanager
+from talmud_query.metrics import record_degradation, record_hedge
+
+# Per-request time budget. A pipeline run opens a request_deadline() scope; every stage then asks for its
+# timeout with stage_timeout(), which is the stage's own cap cut down to what is left of the budget (minus
+# time held back for later stages). A stage that runs out of time is abandoned and the pipeline carries on
+# with a cheaper fallback, recording a named degradation that is returned with the answer.
+#
+# Both values live in context variables, so tasks created by the pipeline (lookups, filter batches) see them.
+
+_deadline = contextvars.ContextVar("talmud_query_deadline", default=None)
+_degradations = contextvars.ContextVar("talmud_query_degradations", default=None)
+
+
+@contextmanager
+def request_deadline(seconds):
+    deadline_token = _deadline.set(time.monotonic() + seconds)
+    degradations_token = _degradations.set([])
+    try:
+        yield
+    finally:
+        _deadline.reset(deadline_token)
+        _degradations.reset(degradations_token)
+
+
+def remaining():
+    """Seconds left in the current request's budget, or None outside a request_deadline() scope."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def stage_timeout(cap, reserve=0.0):
+    """The stage's cap, limited to the remaining budget less the seconds reserved for later stages."""
+    left = remaining()
+    return cap if left is None else max(0.0, min(cap, left - reserve))
+
+
+def degrade(name):
+    degradations = _degradations.get()
+    if degradations is not None and name not in degradations:
+        degradations.append(name)
+        record_degradation(name)
+
+
+def get_degradations():
+    return list(_degradations.get() or [])
+
+
+async def run_within(awaitable, timeout, degradation, fallback=None):
+    """Await with a timeout; on timeout record the degradation and return the fallback."""
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError:
+        print(f"Out of time, degrading: {degradation}")
+        degrade(degradation)
+        return fallback
+
+
+async def hedged(make_call, delay, operation):
+    """Await make_call(), starting an identical second call if the first is still running after delay
+    seconds. The first call to succeed wins and the other is cancelled."""
+    if not delay:
+        return await make_call()
+    tasks = [asyncio.ensure_future(make_call())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            record_hedge(operation)
+            tasks.append(asyncio.ensure_future(make_call()))
+        pending = set(tasks)
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+            if not pending:
+                # Both failed; surface the error of the last one to finish
+                return done.pop().result()
+    finally:
+        for task in tasks:
+            task.cancel()
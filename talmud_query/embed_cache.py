@@ -0,0 +1,127 @@
+import array
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from talmud_query.config import EMBED_CACHE_PATH, EMBED_CACHE_MAX_ITEMS
+from talmud_query.metrics import record_cache_lookups
+
+# Two-tier embedding cache keyed on (model, normalized text): an in-process LRU in front of
+# a SQLite store that survives restarts and is shared by every gunicorn worker on the host.
+
+SQLITE_BATCH_SIZE = 500
+
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+
+def cache_key(model_name, text):
+    return hashlib.sha256(f"{model_name}\n{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, path=EMBED_CACHE_PATH, max_items=EMBED_CACHE_MAX_ITEMS):
+        self.path = path
+        self.max_items = max_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, model TEXT, vector BLOB)")
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key, vector):
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
+
+    def get_many(self, model_name, texts):
+        """Return a list aligned with texts holding the cached vector or None for each miss."""
+        keys = [cache_key(model_name, text) for text in texts]
+        results = [None] * len(keys)
+        disk_lookups = {}
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    results[i] = vector
+                else:
+                    disk_lookups.setdefault(key, []).append(i)
+
+        rows = []
+        if disk_lookups and self.path:
+            lookup_keys = list(disk_lookups)
+            try:
+                for start in range(0, len(lookup_keys), SQLITE_BATCH_SIZE):
+                    chunk = lookup_keys[start:start + SQLITE_BATCH_SIZE]
+                    rows.extend(self._connection().execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                    ).fetchall())
+            except sqlite3.Error as e:
+                print(f"Error reading embedding cache: {e}")
+            for key, blob in rows:
+                vector = array.array("f", blob).tolist()
+                self._remember(key, vector)
+                indices = disk_lookups.pop(key)
+                for i in indices:
+                    results[i] = vector
+                with self._lock:
+                    self._stats["disk_hits"] += len(indices)
+
+        misses = sum(len(indices) for indices in disk_lookups.values())
+        with self._lock:
+            self._stats["misses"] += misses
+        record_cache_lookups("embeddings", len(keys) - misses, misses)
+        return results
+
+    def put_many(self, model_name, texts, vectors):
+        rows = []
+        for text, vector in zip(texts, vectors):
+            key = cache_key(model_name, text)
+            self._remember(key, list(vector))
+            rows.append((key, model_name, array.array("f", vector).tobytes()))
+
+        if rows and self.path:
+            try:
+                conn = self._connection()
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO embeddings (key, model, vector) VALUES (?, ?, ?)", rows)
+            except sqlite3.Error as e:
+                print(f"Error writing embedding cache: {e}")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_items"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def clear_memory(self):
+        with self._lock:
+            self._memory.clear()
+
+
+embedding_cache = EmbeddingCache()
+
+
+def get_embedding_cache_stats():
+    return embedding_cache.stats()
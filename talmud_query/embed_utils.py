@@ -1,18 +1,70 @@
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langsmith import traceable
+import asyncio
+import os
+import weakref
 from talmud_query.config import OPENAI_API_KEY, OPENAI_MODEL, OPENAI_EMBEDDING_MODEL
+from talmud_query.transport import get_openai_client, get_async_openai_client
+from talmud_query.embed_cache import embedding_cache
+from talmud_query.metrics import timed
+from talmud_query.tracing import traceable
+
+_embedders = {}
+_async_embedders = weakref.WeakKeyDictionary()
+
+# Embedders hold the parent's OpenAI client, so a forked worker builds its own
+os.register_at_fork(after_in_child=_embedders.clear)
+
+def get_embedder(model_name=OPENAI_EMBEDDING_MODEL):
+    embed = _embedders.get(model_name)
+    if embed is None:
+        # langchain is imported on first use; it adds most of a second to startup. Embeddings don't go through
+        # the rate limiter, so they keep the SDK's own retries
+        from langchain.embeddings.openai import OpenAIEmbeddings
+        embed = OpenAIEmbeddings(model=model_name, openai_api_key=OPENAI_API_KEY, client=get_openai_client().with_options(max_retries=2).embeddings)
+        _embedders[model_name] = embed
+    return embed
+
+def get_async_embedder(model_name=OPENAI_EMBEDDING_MODEL):
+    # The async OpenAI client belongs to the running loop, so embedders are kept per loop too
+    embedders = _async_embedders.setdefault(asyncio.get_running_loop(), {})
+    embed = embedders.get(model_name)
+    if embed is None:
+        from langchain.embeddings.openai import OpenAIEmbeddings
+        embed = OpenAIEmbeddings(model=model_name, openai_api_key=OPENAI_API_KEY, async_client=get_async_openai_client().with_options(max_retries=2).embeddings)
+        embedders[model_name] = embed
+    return embed
+
+def _cache_misses(texts, cached):
+    # Unique texts that still need embedding, in first-seen order
+    return list(dict.fromkeys(text for text, vector in zip(texts, cached) if vector is None))
+
+def _merge_embeddings(texts, cached, missing, embeddings):
+    embedded = dict(zip(missing, embeddings))
+    return [vector if vector is not None else embedded[text] for text, vector in zip(texts, cached)]
 
 def embed_text_openai(text, model_name=OPENAI_EMBEDDING_MODEL):
-    embed = OpenAIEmbeddings(model=model_name, openai_api_key=OPENAI_API_KEY)
-    return embed.embed_documents([text])[0]
+    return embed_text_openai_batch([text], model_name=model_name)[0]
 
 
 @traceable
+@timed("embed_text_openai_batch")
 def embed_text_openai_batch(texts, model_name=OPENAI_EMBEDDING_MODEL):
-    embed = OpenAIEmbeddings(model=model_name, openai_api_key=OPENAI_API_KEY)
-    return embed.embed_documents(texts)
+    cached = embedding_cache.get_many(model_name, texts)
+    missing = _cache_misses(texts, cached)
+    embeddings = get_embedder(model_name).embed_documents(missing) if missing else []
+    embedding_cache.put_many(model_name, missing, embeddings)
+    return _merge_embeddings(texts, cached, missing, embeddings)
+
+@traceable
+@timed("embed_text_openai_batch")
+async def embed_text_openai_batch_async(texts, model_name=OPENAI_EMBEDDING_MODEL):
+    cached = embedding_cache.get_many(model_name, texts)
+    missing = _cache_misses(texts, cached)
+    embeddings = await get_async_embedder(model_name).aembed_documents(missing) if missing else []
+    embedding_cache.put_many(model_name, missing, embeddings)
+    return _merge_embeddings(texts, cached, missing, embeddings)
 
 def add_openai_embeddings_to_passages(passages, model_name=OPENAI_EMBEDDING_MODEL):
+    from langchain.embeddings.openai import OpenAIEmbeddings
     embed = OpenAIEmbeddings(
         model=model_name,
         openai_api_key=OPENAI_API_KEY
@@ -1,28 +1,205 @@
-import openai
-import json as JSON
-from langchain.embeddings.openai import OpenAIEmbeddings
-import asyncio
-import httpx
-from pydantic import BaseModel, create_model
-from typing import Union, Optional
-from langsmith.wrappers import wrap_openai
-from langsmith.run_helpers import get_current_run_tree
-from langsmith import traceable, Client
-from talmud_query.prompts import *
-from talmud_query.config import *
-from talmud_query.pinecone_utils import get_index_endpoint, query_vectors, query_vectors
+import os
+import sqlite3
+import threading
+import time
+from talmud_query.transport import get_langsmith_client
+from talmud_query.config import (
+    FEEDBACK_SPOOL_PATH,
+    FEEDBACK_FLUSH_INTERVAL,
+    FEEDBACK_BATCH_SIZE,
+    FEEDBACK_RETRY_BACKOFF,
+    FEEDBACK_MAX_BACKOFF,
+    FEEDBACK_MAX_ATTEMPTS,
+    FEEDBACK_LEASE_SECONDS,
+)
+from talmud_query.metrics import record_feedback_event
+
+# User feedback is written to a SQLite spool on the host and acknowledged straight away; a background
+# flusher sends it to LangSmith in batches with the process-wide client. Sends that fail are retried
+# with exponential backoff (capped at FEEDBACK_MAX_BACKOFF), so feedback survives LangSmith outages and
+# restarts. Every worker runs a flusher; a claimed batch holds a lease so two workers never send the same
+# row. Rows still failing after FEEDBACK_MAX_ATTEMPTS are kept with status 'failed' for inspection.
+
+PENDING, FAILED = "pending", "failed"
+
+
+class FeedbackSpool:
+    def __init__(self, path=FEEDBACK_SPOOL_PATH, retry_backoff=FEEDBACK_RETRY_BACKOFF, max_backoff=FEEDBACK_MAX_BACKOFF,
+                 max_attempts=FEEDBACK_MAX_ATTEMPTS, lease_seconds=FEEDBACK_LEASE_SECONDS):
+        self.path = path
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.feedback_added = threading.Event()
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS feedback (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    run_id TEXT NOT NULL,
+                    score INTEGER NOT NULL,
+                    comment TEXT,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    available_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS feedback_status_available ON feedback (status, available_at)")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, work):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(conn)
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def add(self, run_id, score, comment):
+        now = time.time()
+        self._connection().execute(
+            "INSERT INTO feedback (run_id, score, comment, status, created_at, available_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (run_id, score, comment, PENDING, now, now)
+        )
+        record_feedback_event("spooled")
+        self.feedback_added.set()
+
+    def claim(self, limit=FEEDBACK_BATCH_SIZE):
+        """Lease up to limit rows that are due to be sent, oldest first."""
+        def take(conn):
+            now = time.time()
+            rows = conn.execute(
+                "SELECT id, run_id, score, comment, attempts FROM feedback WHERE status = ? AND available_at <= ? ORDER BY id LIMIT ?",
+                (PENDING, now, limit)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE feedback SET available_at = ? WHERE id = ?",
+                [(now + self.lease_seconds, row["id"]) for row in rows]
+            )
+            return [dict(row) for row in rows]
+
+        return self._transaction(take)
+
+    def sent(self, ids):
+        if ids:
+            self._transaction(lambda conn: conn.executemany("DELETE FROM feedback WHERE id = ?", [(feedback_id,) for feedback_id in ids]))
+            record_feedback_event("sent", len(ids))
+
+    def retry(self, item, error):
+        """Reschedule a failed send with backoff, or mark it failed once it is out of attempts."""
+        attempts = item["attempts"] + 1
+        if attempts >= self.max_attempts:
+            self._transaction(lambda conn: conn.execute(
+                "UPDATE feedback SET status = ?, attempts = ?, error = ? WHERE id = ?", (FAILED, attempts, error, item["id"])
+            ))
+            record_feedback_event("failed")
+            return
+        delay = min(self.retry_backoff * 2 ** (attempts - 1), self.max_backoff)
+        self._transaction(lambda conn: conn.execute(
+            "UPDATE feedback SET attempts = ?, error = ?, available_at = ? WHERE id = ?", (attempts, error, time.time() + delay, item["id"])
+        ))
+        record_feedback_event("retried")
+
+    def stats(self):
+        """Rows waiting in the spool by status ({"pending": n, "failed": n})."""
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM feedback GROUP BY status").fetchall()
+        return {PENDING: 0, FAILED: 0, **{status: count for status, count in rows}}
+
+
+def send_feedback_to_langsmith(run_id, score, comment):
+    get_langsmith_client().create_feedback(
+        run_id=run_id,
+        key="user_feedback",
+        score=score,
+        comment=comment,
+    )
+
+
+class FeedbackFlusher:
+    """A background thread that drains the spool every FEEDBACK_FLUSH_INTERVAL seconds, or as soon as
+    feedback is added in this process."""
+
+    def __init__(self, spool, send=send_feedback_to_langsmith, interval=FEEDBACK_FLUSH_INTERVAL):
+        self.spool = spool
+        self.send = send
+        self.interval = interval
+        self._thread = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="talmud-query-feedback", daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self.spool.feedback_added.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            try:
+                while self.flush() and not self._stopping.is_set():
+                    pass
+            except sqlite3.Error as e:
+                print(f"Error flushing feedback spool: {e}")
+            if self._stopping.is_set():
+                return
+            self.spool.feedback_added.wait(self.interval)
+            self.spool.feedback_added.clear()
+
+    def flush(self):
+        """Send one batch. Returns the number of rows claimed."""
+        batch = self.spool.claim()
+        sent = []
+        for item in batch:
+            try:
+                self.send(item["run_id"], item["score"], item["comment"])
+                sent.append(item["id"])
+            except Exception as e:
+                print(f"Error sending feedback for run {item['run_id']} (attempt {item['attempts'] + 1}): {e}")
+                self.spool.retry(item, str(e))
+        self.spool.sent(sent)
+        return len(batch)
+
+
+feedback_spool = FeedbackSpool()
+feedback_flusher = FeedbackFlusher(feedback_spool)
+
 
 def feedback_to_langsmith(run_id, score, comment):
+    """Spool feedback for delivery to LangSmith. Returns True once it is stored durably."""
     try:
         print(f"Feedback: run_id={run_id}, score={score}, comment={comment}")
-        feedback_client = Client()
-        feedback_client.create_feedback(
-            run_id=run_id,
-            key="user_feedback",
-            score=int(score),
-            comment=comment,
-        )
-        return "Feedback saved successfully"
-    except Exception as e:
+        feedback_spool.add(run_id, int(score), comment)
+    except sqlite3.Error as e:
         print(f"Error saving feedback: {e}")
-        return "Failed to save feedback"
\ No newline at end of file
+        return False
+    # Started on first use rather than at import so the thread lives in the gunicorn worker, not the master
+    feedback_flusher.start()
+    return True
+
+
+def get_feedback_stats():
+    return feedback_spool.stats()
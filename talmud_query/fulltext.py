@@ -0,0 +1,132 @@
+import argparse
+import re
+from talmud_query.db import get_connection, release_connection
+from talmud_query.db_utils import passage_cache
+from talmud_query.local_index import filter_values
+from talmud_query.config import TRANSLATION_VERSION, FULLTEXT_K, FULLTEXT_INCLUDE_HEBREW
+from talmud_query.metrics import timed
+
+# Lexical retrieval channel: Postgres full-text search over the English translations (and optionally the
+# Hebrew/Aramaic text), run alongside the vector lookups and merged with them by rank fusion. It catches
+# rare names and technical terms that embeddings blur. Query terms are OR-ed and ranked with ts_rank_cd,
+# so a passage matching several rare terms comes first.
+#
+# The search relies on GIN expression indexes; build them once with
+#
+#   python -m talmud_query.fulltext [--hebrew]
+#
+# The expressions below must stay identical to the indexed ones or Postgres will not use the indexes.
+
+ENGLISH_TSVECTOR = "to_tsvector('english', regexp_replace({column}, '<[^>]+>', ' ', 'g'))"
+HEBREW_TSVECTOR = "to_tsvector('simple', {column})"
+HEBREW_PATTERN = re.compile("[\u0590-\u05ff]")
+
+INDEXES = {
+    "english": ("translations_text_fulltext_idx", "translations", ENGLISH_TSVECTOR.format(column="text")),
+    "hebrew": ("passages_hebrew_text_fulltext_idx", "passages", HEBREW_TSVECTOR.format(column="hebrew_text")),
+}
+
+
+def create_fulltext_indexes(include_hebrew=False):
+    """Build the GIN indexes the search uses. CONCURRENTLY keeps the tables writable while they build."""
+    conn = get_connection()
+    try:
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            for language, (name, table, expression) in INDEXES.items():
+                if language == "hebrew" and not include_hebrew:
+                    continue
+                print(f"Building {name} on {table}")
+                cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} USING GIN (({expression}))")
+                cursor.execute(f"ANALYZE {table}")
+    finally:
+        conn.autocommit = False
+        release_connection(conn)
+
+
+def filter_conditions(filter):
+    """SQL conditions and parameters for a Pinecone style book_name/page_number filter."""
+    conditions, params = [], []
+    for field, column in (("book_name", "books.name"), ("page_number", "pages.page_number")):
+        values = filter_values(filter, field)
+        if values is not None:
+            conditions.append(f"{column} = ANY(%s)")
+            params.append(values)
+    return conditions, params
+
+
+def any_terms_query(config):
+    # plainto_tsquery ANDs every term; a question rarely has all of them in one passage, so OR them instead
+    return f"NULLIF(replace(plainto_tsquery('{config}', %s)::text, '&', '|'), '')::tsquery"
+
+
+@timed("db.search_passages_fulltext")
+def search_passages_fulltext(query, k=FULLTEXT_K, filter=None, include_hebrew=FULLTEXT_INCLUDE_HEBREW, version_name=TRANSLATION_VERSION):
+    """Return up to k passages matching the query's terms, best first, each with a 'lexical_score'."""
+    conditions, filter_params = filter_conditions(filter)
+    english_vector = ENGLISH_TSVECTOR.format(column="translations.text")
+    rank = f"ts_rank_cd({english_vector}, terms.english)"
+    match = f"{english_vector} @@ terms.english"
+    params = [query]
+    if include_hebrew and HEBREW_PATTERN.search(query):
+        hebrew_vector = HEBREW_TSVECTOR.format(column="passages.hebrew_text")
+        rank = f"{rank} + coalesce(ts_rank_cd({hebrew_vector}, terms.hebrew), 0)"
+        match = f"({match} OR {hebrew_vector} @@ terms.hebrew)"
+        hebrew_terms = f", {any_terms_query('simple')} AS hebrew"
+        params.append(query)
+    else:
+        hebrew_terms = ""
+    filter_sql = " ".join(f"AND {condition}" for condition in conditions)
+
+    conn = get_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT passages.passage_id, passages.hebrew_text, translations.text, translations.translation_id, books.name, pages.page_number,
+                       {rank} AS lexical_score
+                FROM (SELECT {any_terms_query('english')} AS english{hebrew_terms}) AS terms,
+                     passages
+                JOIN pages ON passages.page_id = pages.page_id
+                JOIN books ON passages.book_id = books.book_id
+                JOIN translations ON passages.passage_id = translations.passage_id
+                WHERE {match}
+                AND books.name NOT ILIKE '%%rashi%%'
+                AND translations.version_name = %s
+                {filter_sql}
+                ORDER BY lexical_score DESC
+                LIMIT %s
+            """, (*params, version_name, *filter_params, k))
+            rows = cursor.fetchall()
+    finally:
+        release_connection(conn)
+
+    passages = [
+        {
+            'passage_id': row[0],
+            'hebrew_text': row[1],
+            'english_text': row[2],
+            'translation_id': row[3],
+            'book_name': row[4],
+            'page_number': row[5],
+            'lexical_score': row[6]
+        }
+        for row in rows
+    ]
+    passage_cache.set_many({
+        (passage['passage_id'], version_name): {key: value for key, value in passage.items() if key != 'lexical_score'}
+        for passage in passages
+    })
+    return passages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the Postgres full-text indexes used for lexical retrieval.")
+    parser.add_argument("--hebrew", action="store_true", help="also index passages.hebrew_text (for FULLTEXT_INCLUDE_HEBREW)")
+    args = parser.parse_args()
+    create_fulltext_indexes(include_hebrew=args.hebrew)
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
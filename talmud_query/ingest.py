@@ -0,0 +1,171 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from talmud_query.config import (
+    INDEX_NAME,
+    OPENAI_EMBEDDING_MODEL,
+    INGEST_EMBED_BATCH_SIZE,
+    INGEST_EMBED_CONCURRENCY,
+    INGEST_UPSERT_BATCH_SIZE,
+    INGEST_MAX_RETRIES,
+    SLIM_VECTOR_METADATA,
+)
+from talmud_query.db_utils import stream_english_passages, break_into_sentences, get_only_bolded_words
+from talmud_query.embed_utils import get_async_embedder
+from talmud_query.pinecone_utils import get_index_endpoint_async, upsert_vectors_async
+from talmud_query.transport import retryable_openai_errors, retry_after_seconds
+
+# Streaming corpus ingestion: read passages through a server-side cursor, embed them in concurrent
+# rate-limit-aware batches, upsert them to a Pinecone namespace and checkpoint after every window
+# so an interrupted run resumes where it stopped without re-embedding.
+#
+#   python -m talmud_query.ingest --namespace SWD-passages-openai-bold --strategy bold
+
+CHUNKING_STRATEGIES = {
+    "plain": lambda text: [text],
+    "sentence": break_into_sentences,
+    "bold": lambda text: [get_only_bolded_words(text)],
+}
+
+
+def chunk_passages(passages, strategy):
+    """Expand passages into (vector_id, text_to_embed, passage) records, skipping empty chunks."""
+    records = []
+    for passage in passages:
+        for i, text in enumerate(CHUNKING_STRATEGIES[strategy](passage["english_text"])):
+            if text.strip():
+                records.append((f"{passage['passage_id']}-{i}", text, passage))
+    return records
+
+
+def build_vector_metadata(passage, text_to_embed):
+    if SLIM_VECTOR_METADATA:
+        # Only what metadata filters need; the text is loaded from Postgres at query time
+        return {"passage_id": passage["passage_id"], "book_name": passage["book_name"], "page_number": passage["page_number"]}
+    return {**passage, "text_to_embed": text_to_embed}
+
+
+def load_checkpoint(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {"last_passage_id": 0, "vectors_upserted": 0}
+
+
+def save_checkpoint(path, checkpoint):
+    # Write to a temporary file first so a crash never leaves a half-written checkpoint
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+async def with_retries(make_call, max_retries=INGEST_MAX_RETRIES):
+    for attempt in range(max_retries + 1):
+        try:
+            return await make_call()
+        except retryable_openai_errors() as e:
+            if attempt == max_retries:
+                raise
+            delay = retry_after_seconds(e) or min(60, 2 ** attempt) + random.random()
+            print(f"Retrying after {delay:.1f}s ({e.__class__.__name__})")
+            await asyncio.sleep(delay)
+
+
+async def embed_records(records, model_name, batch_size, semaphore):
+    embedder = get_async_embedder(model_name)
+
+    async def embed_batch(batch):
+        async with semaphore:
+            return await with_retries(lambda: embedder.aembed_documents([text for _, text, _ in batch]))
+
+    batches = [records[i:i + batch_size] for i in range(0, len(records), batch_size)]
+    results = await asyncio.gather(*[embed_batch(batch) for batch in batches])
+    return [embedding for result in results for embedding in result]
+
+
+async def upsert_records(records, embeddings, namespace, index_endpoint, batch_size, semaphore):
+    vectors = [
+        {"id": vector_id, "values": embedding, "metadata": build_vector_metadata(passage, text)}
+        for (vector_id, text, passage), embedding in zip(records, embeddings)
+    ]
+
+    async def upsert_batch(batch):
+        async with semaphore:
+            for attempt in range(INGEST_MAX_RETRIES + 1):
+                try:
+                    return await upsert_vectors_async(batch, namespace, index_endpoint=index_endpoint)
+                except Exception as e:
+                    if attempt == INGEST_MAX_RETRIES:
+                        raise
+                    print(f"Error upserting vectors, retrying: {e}")
+                    await asyncio.sleep(min(60, 2 ** attempt) + random.random())
+
+    await asyncio.gather(*[upsert_batch(vectors[i:i + batch_size]) for i in range(0, len(vectors), batch_size)])
+    return len(vectors)
+
+
+async def ingest(namespace, strategy="plain", model_name=OPENAI_EMBEDDING_MODEL, index_name=INDEX_NAME, checkpoint_path=None,
+                 window_size=2000, embed_batch_size=INGEST_EMBED_BATCH_SIZE, upsert_batch_size=INGEST_UPSERT_BATCH_SIZE,
+                 concurrency=INGEST_EMBED_CONCURRENCY):
+    checkpoint = load_checkpoint(checkpoint_path)
+    if checkpoint.get("strategy", strategy) != strategy or checkpoint.get("namespace", namespace) != namespace:
+        raise ValueError(f"Checkpoint {checkpoint_path} belongs to a different namespace or strategy")
+
+    index_endpoint = await get_index_endpoint_async(index_name=index_name)
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.time()
+
+    print(f"Ingesting into {namespace} ({strategy}) after passage_id {checkpoint['last_passage_id']}")
+    for passages in stream_english_passages(after_passage_id=checkpoint["last_passage_id"], batch_size=window_size):
+        records = chunk_passages(passages, strategy)
+        if records:
+            embeddings = await embed_records(records, model_name, embed_batch_size, semaphore)
+            checkpoint["vectors_upserted"] += await upsert_records(records, embeddings, namespace, index_endpoint, upsert_batch_size, semaphore)
+
+        checkpoint.update(last_passage_id=passages[-1]["passage_id"], namespace=namespace, strategy=strategy)
+        if checkpoint_path:
+            save_checkpoint(checkpoint_path, checkpoint)
+        print(f"Upserted {checkpoint['vectors_upserted']} vectors through passage_id {checkpoint['last_passage_id']} ({time.time() - started:.0f}s)")
+
+    return checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed the corpus and upsert it to a Pinecone namespace.")
+    parser.add_argument("--namespace", required=True)
+    parser.add_argument("--strategy", choices=list(CHUNKING_STRATEGIES), default="plain")
+    parser.add_argument("--index-name", default=INDEX_NAME)
+    parser.add_argument("--model", default=OPENAI_EMBEDDING_MODEL)
+    parser.add_argument("--checkpoint", help="progress file (default: cache/ingest-<namespace>.json)")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint and start from the beginning")
+    parser.add_argument("--window-size", type=int, default=2000, help="passages read from the cursor between checkpoints")
+    parser.add_argument("--embed-batch-size", type=int, default=INGEST_EMBED_BATCH_SIZE)
+    parser.add_argument("--upsert-batch-size", type=int, default=INGEST_UPSERT_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=INGEST_EMBED_CONCURRENCY)
+    args = parser.parse_args()
+
+    checkpoint_path = args.checkpoint or os.path.join("cache", f"ingest-{args.namespace}.json")
+    os.makedirs(os.path.dirname(checkpoint_path) or ".", exist_ok=True)
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    checkpoint = asyncio.run(ingest(
+        args.namespace,
+        strategy=args.strategy,
+        model_name=args.model,
+        index_name=args.index_name,
+        checkpoint_path=checkpoint_path,
+        window_size=args.window_size,
+        embed_batch_size=args.embed_batch_size,
+        upsert_batch_size=args.upsert_batch_size,
+        concurrency=args.concurrency,
+    ))
+    print(f"Done: {checkpoint['vectors_upserted']} vectors in {args.namespace}")
+
+
+if __name__ == "__main__":
+    main()
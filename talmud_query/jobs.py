@@ -0,0 +1,285 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from talmud_query.config import (
+    JOB_DB_PATH,
+    JOB_WORKERS,
+    JOB_MAX_ATTEMPTS,
+    JOB_RETRY_BACKOFF,
+    JOB_LEASE_SECONDS,
+    JOB_RESULT_TTL,
+    JOB_POLL_INTERVAL,
+    JOB_QUEUE_MAX,
+)
+from talmud_query.metrics import record_job_event, observe_stage
+
+# Durable job queue for asynchronous /query requests. Jobs live in a SQLite file so they survive
+# restarts and can be claimed by any worker on the host (the web process's own pool, or a separate
+# `python worker.py`). A claimed job holds a lease, which its worker renews while the job runs; if the
+# worker dies the lease lapses and the job is picked up again. A claim is identified by the job's attempt
+# number, so a worker that lost its lease can't overwrite the outcome of the run that took over. Failed jobs are retried with backoff up to JOB_MAX_ATTEMPTS, and finished jobs are
+# deleted JOB_RESULT_TTL seconds after they complete.
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = "queued", "running", "succeeded", "failed"
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobQueue:
+    def __init__(self, path=JOB_DB_PATH, max_attempts=JOB_MAX_ATTEMPTS, retry_backoff=JOB_RETRY_BACKOFF,
+                 lease_seconds=JOB_LEASE_SECONDS, result_ttl=JOB_RESULT_TTL, max_pending=JOB_QUEUE_MAX):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.lease_seconds = lease_seconds
+        self.result_ttl = result_ttl
+        self.max_pending = max_pending
+        self.job_added = threading.Event()
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    query TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    available_at REAL NOT NULL,
+                    lease_expires_at REAL,
+                    expires_at REAL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_available ON jobs (status, available_at)")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, work):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(conn)
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def enqueue(self, query):
+        """Add a job and return its id. Raises QueueFullError when too many jobs are pending."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+
+        def insert(conn):
+            pending = conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)).fetchone()[0]
+            if pending >= self.max_pending:
+                raise QueueFullError(f"{pending} jobs are already pending")
+            conn.execute(
+                "INSERT INTO jobs (id, query, status, created_at, updated_at, available_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, query, QUEUED, now, now, now)
+            )
+
+        self._transaction(insert)
+        record_job_event("enqueued")
+        self.job_added.set()
+        return job_id
+
+    def get(self, job_id):
+        row = self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or (row["expires_at"] is not None and row["expires_at"] <= time.time()):
+            return None
+        job = {
+            "job_id": row["id"],
+            "query": row["query"],
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+        if row["status"] == SUCCEEDED:
+            job["result"] = json.loads(row["result"])
+        elif row["error"]:
+            job["error"] = row["error"]
+        return job
+
+    def claim(self):
+        """Take the oldest runnable job (queued, or running with a lapsed lease). Returns a dict or None."""
+        def take(conn):
+            now = time.time()
+            while True:
+                row = conn.execute("""
+                    SELECT id, query, attempts, created_at FROM jobs
+                    WHERE (status = ? AND available_at <= ?) OR (status = ? AND lease_expires_at <= ?)
+                    ORDER BY created_at LIMIT 1
+                """, (QUEUED, now, RUNNING, now)).fetchone()
+                if row is None:
+                    return None
+                if row["attempts"] >= self.max_attempts:
+                    # Its last worker died mid-run
+                    self._finish(conn, row["id"], FAILED, error="worker lost while running the job", now=now)
+                    record_job_event("failed")
+                    continue
+                conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_expires_at = ?, updated_at = ? WHERE id = ?",
+                    (RUNNING, now + self.lease_seconds, now, row["id"])
+                )
+                return {"job_id": row["id"], "query": row["query"], "attempts": row["attempts"] + 1, "created_at": row["created_at"]}
+
+        return self._transaction(take)
+
+    def _finish(self, conn, job_id, status, result=None, error=None, now=None, attempts=None):
+        """Returns whether the job was updated; with attempts given, only the claim with that attempt number can
+        finish it."""
+        now = now or time.time()
+        return conn.execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ?, lease_expires_at = NULL, expires_at = ? WHERE id = ?"
+            + ("" if attempts is None else " AND status = ? AND attempts = ?"),
+            (status, result, error, now, now + self.result_ttl, job_id) + (() if attempts is None else (RUNNING, attempts))
+        ).rowcount > 0
+
+    def renew(self, job_id, attempts):
+        """Extend the lease of a running claim. Returns False if the claim has been lost to another worker."""
+        now = time.time()
+        return self._transaction(lambda conn: conn.execute(
+            "UPDATE jobs SET lease_expires_at = ?, updated_at = ? WHERE id = ? AND status = ? AND attempts = ?",
+            (now + self.lease_seconds, now, job_id, RUNNING, attempts)
+        ).rowcount > 0)
+
+    def complete(self, job_id, attempts, result):
+        """Store the result of a claim. Returns False (and stores nothing) if the claim has been lost."""
+        if not self._transaction(lambda conn: self._finish(conn, job_id, SUCCEEDED, result=json.dumps(result, default=str), attempts=attempts)):
+            return False
+        record_job_event("succeeded")
+        return True
+
+    def fail(self, job_id, attempts, error):
+        """Requeue the job with backoff, or mark it failed once it is out of attempts. Returns False (and changes
+        nothing) if the claim has been lost."""
+        if attempts >= self.max_attempts:
+            if not self._transaction(lambda conn: self._finish(conn, job_id, FAILED, error=error, attempts=attempts)):
+                return False
+            record_job_event("failed")
+            return True
+        now = time.time()
+        if not self._transaction(lambda conn: conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, available_at = ?, lease_expires_at = NULL, updated_at = ? WHERE id = ? AND status = ? AND attempts = ?",
+            (QUEUED, error, now + self.retry_backoff * 2 ** (attempts - 1), now, job_id, RUNNING, attempts)
+        ).rowcount > 0):
+            return False
+        record_job_event("retried")
+        return True
+
+    def purge_expired(self):
+        return self._transaction(lambda conn: conn.execute("DELETE FROM jobs WHERE expires_at <= ?", (time.time(),)).rowcount)
+
+    def stats(self):
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+
+class JobWorkerPool:
+    """A fixed number of threads that claim jobs and run handler(query) for each. The handler's return
+    value is stored as the job result; an exception fails the attempt. The pool can be started again after
+    stop()."""
+
+    def __init__(self, queue, handler, workers=JOB_WORKERS, poll_interval=JOB_POLL_INTERVAL):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._threads = []
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+
+    def start(self):
+        with self._lock:
+            self._stopping.clear()
+            # Workers still finishing a job from before a stop() that timed out carry on
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            for i in range(len(self._threads), self.workers):
+                thread = threading.Thread(target=self._run, name=f"talmud-query-job-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        with self._lock:
+            self._stopping.set()
+            self.queue.job_added.set()
+            for thread in self._threads:
+                thread.join(timeout)
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self._maybe_purge()
+                job = self.queue.claim()
+            except sqlite3.Error as e:
+                print(f"Error claiming job: {e}")
+                job = None
+
+            if job is None:
+                # Woken early when a job is enqueued in this process
+                self.queue.job_added.wait(self.poll_interval)
+                self.queue.job_added.clear()
+                continue
+
+            if job["attempts"] == 1:
+                observe_stage("job_queue_wait", time.time() - job["created_at"])
+            done = threading.Event()
+            heartbeat = threading.Thread(target=self._heartbeat, args=(job, done), name=f"{threading.current_thread().name}-lease", daemon=True)
+            heartbeat.start()
+            try:
+                result = self.handler(job["query"])
+            except Exception as e:
+                print(f"Error running job {job['job_id']} (attempt {job['attempts']}): {e}")
+                self._record(self.queue.fail, job, str(e))
+                continue
+            finally:
+                done.set()
+                heartbeat.join()
+            self._record(self.queue.complete, job, result)
+
+    def _heartbeat(self, job, done):
+        """Renew the job's lease until done is set, so a long job isn't claimed again while it runs."""
+        while not done.wait(self.queue.lease_seconds / 3):
+            try:
+                if not self.queue.renew(job["job_id"], job["attempts"]):
+                    print(f"Lost the lease on job {job['job_id']} (attempt {job['attempts']})")
+                    return
+            except sqlite3.Error as e:
+                # Tried again on the next beat, before the lease lapses
+                print(f"Error renewing job lease: {e}")
+
+    def _record(self, update, job, outcome):
+        try:
+            if not update(job["job_id"], job["attempts"], outcome):
+                print(f"Not recording the outcome of job {job['job_id']} (attempt {job['attempts']}): its lease was taken over")
+        except sqlite3.Error as e:
+            # The lease will lapse and the job will run again
+            print(f"Error recording job outcome: {e}")
+
+    def _maybe_purge(self):
+        now = time.monotonic()
+        if now - self._last_purge >= 60:
+            self._last_purge = now
+            self.queue.purge_expired()
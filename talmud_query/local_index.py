@@ -0,0 +1,227 @@
+import argparse
+import json
+import os
+import threading
+import numpy as np
+from talmud_query.config import LOCAL_INDEX_DIR, LOCAL_INDEX_NPROBE, OPENAI_EMBEDDING_MODEL
+from talmud_query.metrics import timed
+
+# In-process vector search over a memory-mapped embedding matrix, as an alternative to Pinecone.
+#
+# Each namespace lives in LOCAL_INDEX_DIR/<namespace>/:
+#   vectors.npy    unit-normalized float16/float32 matrix, rows sorted by (book_name, page_number)
+#   metadata.json  one metadata dict per row (same fields as the Pinecone metadata)
+#   ranges.json    row ranges per book and per (book, page) so metadata filters become slices
+#   ivf_*.npy      optional coarse quantizer: centroids, row ids grouped by list, list offsets
+
+SCAN_CHUNK_ROWS = 65536
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+class LocalVectorIndex:
+    def __init__(self, path):
+        self.path = path
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        with open(os.path.join(path, "metadata.json")) as f:
+            self.metadata = json.load(f)
+        with open(os.path.join(path, "ranges.json")) as f:
+            ranges = json.load(f)
+        self.book_ranges = ranges["books"]
+        self.page_ranges = ranges["pages"]
+
+        self.ivf_centroids = None
+        if os.path.exists(os.path.join(path, "ivf_centroids.npy")):
+            self.ivf_centroids = np.load(os.path.join(path, "ivf_centroids.npy"))
+            self.ivf_rows = np.load(os.path.join(path, "ivf_rows.npy"), mmap_mode="r")
+            self.ivf_offsets = np.load(os.path.join(path, "ivf_offsets.npy"))
+
+    def _filter_ranges(self, filter):
+        """Turn a Pinecone style filter on book_name/page_number into row ranges (None means every row)."""
+        books = filter_values(filter, "book_name")
+        pages = filter_values(filter, "page_number")
+        if books is None and pages is None:
+            return None
+
+        ranges = []
+        for book in (books if books is not None else list(self.book_ranges)):
+            if pages is None:
+                if book in self.book_ranges:
+                    ranges.append(self.book_ranges[book])
+            else:
+                for page in pages:
+                    key = f"{book}|{page}"
+                    if key in self.page_ranges:
+                        ranges.append(self.page_ranges[key])
+        return ranges
+
+    def _score_rows(self, vector, rows):
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), SCAN_CHUNK_ROWS):
+            chunk = rows[start:start + SCAN_CHUNK_ROWS]
+            scores[start:start + len(chunk)] = self.vectors[chunk].astype(np.float32) @ vector
+        return scores
+
+    def _score_range(self, vector, start, end):
+        scores = np.empty(end - start, dtype=np.float32)
+        for chunk_start in range(start, end, SCAN_CHUNK_ROWS):
+            chunk_end = min(chunk_start + SCAN_CHUNK_ROWS, end)
+            scores[chunk_start - start:chunk_end - start] = self.vectors[chunk_start:chunk_end].astype(np.float32) @ vector
+        return scores
+
+    def _candidates(self, vector, ranges, nprobe):
+        if ranges is not None:
+            if not ranges:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            rows = np.concatenate([np.arange(start, end) for start, end in ranges])
+            scores = np.concatenate([self._score_range(vector, start, end) for start, end in ranges])
+            return rows, scores
+
+        if self.ivf_centroids is not None and nprobe < len(self.ivf_centroids):
+            lists = np.argpartition(-(self.ivf_centroids @ vector), nprobe)[:nprobe]
+            rows = np.sort(np.concatenate([self.ivf_rows[self.ivf_offsets[i]:self.ivf_offsets[i + 1]] for i in lists]))
+            return rows, self._score_rows(vector, rows)
+
+        return np.arange(len(self.vectors)), self._score_range(vector, 0, len(self.vectors))
+
+    def query(self, vector, top_k=20, filter=None, nprobe=LOCAL_INDEX_NPROBE):
+        """Return the top_k matches in the same shape as the Pinecone /query response."""
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector = vector / norm
+
+        rows, scores = self._candidates(vector, self._filter_ranges(filter), nprobe)
+        if len(rows) > top_k:
+            top = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            top = np.arange(len(rows))
+        top = top[np.argsort(-scores[top])]
+
+        return {
+            "matches": [
+                {"id": str(int(rows[i])), "score": float(scores[i]), "metadata": self.metadata[int(rows[i])]}
+                for i in top
+            ]
+        }
+
+
+def filter_values(filter, field):
+    if not filter or filter.get(field) is None:
+        return None
+    value = filter[field]
+    if isinstance(value, dict):
+        if "$eq" in value:
+            return [value["$eq"]]
+        if "$in" in value:
+            return list(value["$in"])
+        raise ValueError(f"Unsupported filter for {field}: {value}")
+    return [value]
+
+
+def get_local_index(namespace):
+    index = _indexes.get(namespace)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.get(namespace)
+            if index is None:
+                index = LocalVectorIndex(os.path.join(LOCAL_INDEX_DIR, namespace))
+                _indexes[namespace] = index
+    return index
+
+
+@timed("query_local_index")
+def query_local_index(vector, namespace=None, top_k=20, filter=None):
+    return get_local_index(namespace).query(vector, top_k=top_k, filter=filter)
+
+
+def train_ivf(vectors, n_lists, iterations=10, sample_size=100000, seed=0):
+    """Spherical k-means on a sample of rows; returns centroids, row ids grouped by list and list offsets."""
+    rng = np.random.default_rng(seed)
+    sample = vectors[np.sort(rng.choice(len(vectors), size=min(sample_size, len(vectors)), replace=False))].astype(np.float32)
+    centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)]
+
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        for i in range(n_lists):
+            members = sample[assignments == i]
+            if len(members):
+                centroid = members.sum(axis=0)
+                centroids[i] = centroid / np.linalg.norm(centroid)
+
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), SCAN_CHUNK_ROWS):
+        chunk = vectors[start:start + SCAN_CHUNK_ROWS].astype(np.float32)
+        assignments[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+
+    rows = np.argsort(assignments, kind="stable")
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assignments, minlength=n_lists))
+    return centroids, rows, offsets
+
+
+def build_local_index(passages, embeddings, path, dtype="float16", ivf_lists=0):
+    order = sorted(range(len(passages)), key=lambda i: (passages[i]["book_name"], passages[i]["page_number"]))
+    os.makedirs(path, exist_ok=True)
+
+    vectors = np.lib.format.open_memmap(os.path.join(path, "vectors.npy"), mode="w+", dtype=dtype, shape=(len(order), len(embeddings[0])))
+    metadata, books, pages = [], {}, {}
+    for row, i in enumerate(order):
+        vector = np.asarray(embeddings[i], dtype=np.float32)
+        vectors[row] = vector / np.linalg.norm(vector)
+
+        passage = passages[i]
+        metadata.append({key: value for key, value in passage.items() if key != "embedding"})
+        for ranges, key in ((books, passage["book_name"]), (pages, f"{passage['book_name']}|{passage['page_number']}")):
+            ranges.setdefault(key, [row, row])[1] = row + 1
+    vectors.flush()
+
+    with open(os.path.join(path, "metadata.json"), "w") as f:
+        json.dump(metadata, f)
+    with open(os.path.join(path, "ranges.json"), "w") as f:
+        json.dump({"books": books, "pages": pages}, f)
+
+    if ivf_lists:
+        centroids, rows, offsets = train_ivf(vectors, ivf_lists)
+        np.save(os.path.join(path, "ivf_centroids.npy"), centroids)
+        np.save(os.path.join(path, "ivf_rows.npy"), rows)
+        np.save(os.path.join(path, "ivf_offsets.npy"), offsets)
+
+    with _indexes_lock:
+        _indexes.pop(os.path.basename(path.rstrip(os.sep)), None)
+    return len(order)
+
+
+def main():
+    from talmud_query.db_utils import fetch_english_passages, fetch_sentence_passages, fetch_bolded_words_passages
+    from talmud_query.embed_utils import embed_text_openai_batch
+
+    fetchers = {
+        "plain": fetch_english_passages,
+        "sentence": fetch_sentence_passages,
+        "bold": fetch_bolded_words_passages,
+    }
+
+    parser = argparse.ArgumentParser(description="Build a local vector index for one namespace.")
+    parser.add_argument("--namespace", required=True)
+    parser.add_argument("--strategy", choices=list(fetchers), default="plain", help="how text_to_embed is derived from each passage")
+    parser.add_argument("--dtype", choices=["float16", "float32"], default="float16")
+    parser.add_argument("--ivf-lists", type=int, default=0, help="number of coarse quantizer lists (0 disables IVF)")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--model", default=OPENAI_EMBEDDING_MODEL)
+    args = parser.parse_args()
+
+    passages = [passage for passage in fetchers[args.strategy]() if passage["text_to_embed"].strip()]
+    embeddings = []
+    for start in range(0, len(passages), args.batch_size):
+        batch = passages[start:start + args.batch_size]
+        embeddings.extend(embed_text_openai_batch([passage["text_to_embed"] for passage in batch], model_name=args.model))
+        print(f"Embedded {len(embeddings)}/{len(passages)} passages")
+
+    count = build_local_index(passages, embeddings, os.path.join(LOCAL_INDEX_DIR, args.namespace), dtype=args.dtype, ivf_lists=args.ivf_lists)
+    print(f"Wrote {count} vectors to {os.path.join(LOCAL_INDEX_DIR, args.namespace)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import threading
+import time
+from collections import OrderedDict
+from talmud_query.metrics import record_cache_lookups
+
+
+class LRUCache:
+    """Thread-safe in-process LRU with an optional per-entry TTL (seconds) and hit/miss counters."""
+
+    def __init__(self, max_items, ttl=None, name=None):
+        self.name = name
+        self.max_items = max_items
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key, now):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= now:
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._get(key, time.time())
+            hit = value is not None
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if self.name:
+            record_cache_lookups(self.name, int(hit), int(not hit))
+        return value if hit else default
+
+    def __contains__(self, key):
+        """Whether key is cached, without counting a lookup or refreshing its position."""
+        with self._lock:
+            item = self._items.get(key)
+            return item is not None and (item[1] is None or item[1] > time.time())
+
+    def get_many(self, keys):
+        """Return {key: value} for the keys that are cached."""
+        found = {}
+        with self._lock:
+            now = time.time()
+            for key in keys:
+                value = self._get(key, now)
+                if value is not None:
+                    found[key] = value
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        if self.name:
+            record_cache_lookups(self.name, len(found), len(keys) - len(found))
+        return found
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            for key, value in items.items():
+                self._items[key] = (value, expires_at)
+                self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+        return item[0] if item else None
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "items": len(self._items)}
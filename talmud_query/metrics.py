@@ -0,0 +1,215 @@
+import functools
+import inspect
+import os
+import time
+from contextlib import contextmanager
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    CONTENT_TYPE_LATEST,
+    generate_latest,
+    multiprocess,
+)
+
+# Prometheus metrics for every pipeline stage. With several workers, set PROMETHEUS_MULTIPROC_DIR (gunicorn.conf.py
+# and asgi.py do this) so each worker writes its samples to shared files and /metrics aggregates all workers.
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120)
+
+STAGE_LATENCY = Histogram(
+    "talmud_query_stage_seconds",
+    "Latency of each pipeline stage",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+STAGE_ERRORS = Counter(
+    "talmud_query_stage_errors_total",
+    "Errors raised or swallowed by each pipeline stage",
+    ["stage"],
+)
+OPENAI_TOKENS = Counter(
+    "talmud_query_openai_tokens_total",
+    "OpenAI tokens by model and direction (prompt or completion)",
+    ["model", "direction"],
+)
+OPENAI_REQUESTS = Counter(
+    "talmud_query_openai_requests_total",
+    "OpenAI requests by model and stage",
+    ["model", "stage"],
+)
+OPENAI_RATE_LIMITED = Counter(
+    "talmud_query_openai_rate_limited_total",
+    "OpenAI calls rejected with 429",
+    ["model"],
+)
+PINECONE_RESPONSE_BYTES = Counter(
+    "talmud_query_pinecone_response_bytes_total",
+    "Bytes of Pinecone response payloads",
+    ["operation"],
+)
+CACHE_LOOKUPS = Counter(
+    "talmud_query_cache_lookups_total",
+    "Cache lookups by cache and result (hit or miss)",
+    ["cache", "result"],
+)
+DB_CHECKOUTS = Counter(
+    "talmud_query_db_checkouts_total",
+    "Database connection checkouts by result (ok, replaced after a failed health check, timeout)",
+    ["result"],
+)
+DB_CHECKOUT_WAIT = Histogram(
+    "talmud_query_db_checkout_wait_seconds",
+    "Time spent waiting for a pooled database connection",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30),
+)
+DB_CONNECTIONS_IN_USE = Gauge(
+    "talmud_query_db_connections_in_use",
+    "Pooled database connections currently checked out",
+    multiprocess_mode="livesum",
+)
+JOB_EVENTS = Counter(
+    "talmud_query_job_events_total",
+    "Query job lifecycle events (enqueued, retried, succeeded, failed)",
+    ["event"],
+)
+FEEDBACK_EVENTS = Counter(
+    "talmud_query_feedback_events_total",
+    "Spooled feedback events (spooled, sent, retried, failed)",
+    ["event"],
+)
+REFERENCE_FAST_PATH = Counter(
+    "talmud_query_reference_fast_path_total",
+    "Queries naming a page, by outcome (hit, or no_passages when the full pipeline ran instead)",
+    ["result"],
+)
+DEGRADATIONS = Counter(
+    "talmud_query_degradations_total",
+    "Pipeline stages skipped or cut short to stay within the request deadline",
+    ["degradation"],
+)
+PROFILES = Counter(
+    "talmud_query_profiles_total",
+    "Requests profiled, by what triggered the profile",
+    ["trigger"],
+)
+HEDGED_REQUESTS = Counter(
+    "talmud_query_hedged_requests_total",
+    "Slow upstream calls duplicated by a hedged second request",
+    ["operation"],
+)
+SINGLE_FLIGHT = Counter(
+    "talmud_query_single_flight_total",
+    "Coalesced /query requests by role (leader, follower_local or follower_shared)",
+    ["role"],
+)
+
+
+@contextmanager
+def time_stage(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        STAGE_LATENCY.labels(stage).observe(time.perf_counter() - started)
+
+
+def timed(stage):
+    """Decorator recording the latency (and raised errors) of a sync or async function under a stage label."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with time_stage(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with time_stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def observe_stage(stage, seconds):
+    STAGE_LATENCY.labels(stage).observe(seconds)
+
+
+def record_error(stage):
+    STAGE_ERRORS.labels(stage).inc()
+
+
+def record_openai_usage(model, stage, usage):
+    OPENAI_REQUESTS.labels(model, stage).inc()
+    if usage is not None:
+        OPENAI_TOKENS.labels(model, "prompt").inc(usage.prompt_tokens or 0)
+        OPENAI_TOKENS.labels(model, "completion").inc(usage.completion_tokens or 0)
+
+
+def record_openai_rate_limited(model):
+    OPENAI_RATE_LIMITED.labels(model).inc()
+
+
+def record_pinecone_response(operation, response):
+    PINECONE_RESPONSE_BYTES.labels(operation).inc(len(response.content))
+
+
+def record_cache_lookups(cache, hits, misses):
+    if hits:
+        CACHE_LOOKUPS.labels(cache, "hit").inc(hits)
+    if misses:
+        CACHE_LOOKUPS.labels(cache, "miss").inc(misses)
+
+
+def record_reference_fast_path(result):
+    REFERENCE_FAST_PATH.labels(result).inc()
+
+
+def record_degradation(name):
+    DEGRADATIONS.labels(name).inc()
+
+
+def record_profile(trigger):
+    PROFILES.labels(trigger).inc()
+
+
+def record_hedge(operation):
+    HEDGED_REQUESTS.labels(operation).inc()
+
+
+def record_single_flight(role):
+    SINGLE_FLIGHT.labels(role).inc()
+
+
+def record_job_event(event):
+    JOB_EVENTS.labels(event).inc()
+
+
+def record_feedback_event(event, count=1):
+    FEEDBACK_EVENTS.labels(event).inc(count)
+
+
+def record_db_checkout(result, wait_seconds):
+    DB_CHECKOUTS.labels(result).inc()
+    if result != "replaced":
+        DB_CHECKOUT_WAIT.observe(wait_seconds)
+
+
+def set_db_connections_in_use(count):
+    DB_CONNECTIONS_IN_USE.set(count)
+
+
+def render_metrics():
+    """Return (body, content_type) in the Prometheus text format, aggregated across workers when multiprocess."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
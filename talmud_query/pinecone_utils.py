@@ -1,30 +1,70 @@
 
+import asyncio
+import time
 import httpx
-from langsmith import traceable, Client
 import os
+import re
 import itertools
 import uuid
 from talmud_query.prompts import *
 from talmud_query.config import *
 from talmud_query.embed_utils import embed_text_openai
+from talmud_query.transport import get_http_client, get_async_http_client
+from talmud_query.local_index import query_local_index
+from talmud_query.db_utils import get_passages_and_translations
+from talmud_query.metrics import timed, record_pinecone_response
+from talmud_query.tracing import traceable
+from talmud_query.deadline import hedged, stage_timeout
 
-def get_index_endpoint(api_key=PINECONE_API_KEY, index_name=INDEX_NAME):
-    url = f"https://api.pinecone.io/indexes/{index_name}"
+# Resolved index hosts: index_name -> (host, expires_at)
+_index_hosts = {}
+# Vector ids written by ingest are "<passage_id>-<chunk>"
+SLIM_VECTOR_ID = re.compile(r"^(\d+)-\d+$")
+
+def _cached_index_host(index_name):
+    cached = _index_hosts.get(index_name)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    return None
+
+def _store_index_host(index_name, response_json):
+    if "host" not in response_json:
+        raise KeyError(f"'host' not found in the response: {response_json}")
+    _index_hosts[index_name] = (response_json["host"], time.monotonic() + INDEX_HOST_TTL)
+    return response_json["host"]
+
+def index_url(index_endpoint, path):
+    # Pinecone returns a bare host; stand-in servers may return one with an explicit scheme
+    base = index_endpoint if "://" in index_endpoint else f"https://{index_endpoint}"
+    return f"{base}{path}"
+
+@timed("get_index_endpoint")
+def get_index_endpoint(api_key=PINECONE_API_KEY, index_name=INDEX_NAME, refresh=False):
+    host = None if refresh else _cached_index_host(index_name)
+    if host:
+        return host
+
+    url = f"{PINECONE_CONTROLLER_URL}/indexes/{index_name}"
     headers = {"Api-Key": api_key}
 
-    response = httpx.get(url, headers=headers)
+    response = get_http_client().get(url, headers=headers)
     response.raise_for_status()
-    response_json = response.json()
+    return _store_index_host(index_name, response.json())
 
-    if "host" in response_json:
-        return response_json["host"]
-    else:
-        raise KeyError(f"'host' not found in the response: {response_json}")
+@timed("get_index_endpoint")
+async def get_index_endpoint_async(api_key=PINECONE_API_KEY, index_name=INDEX_NAME, refresh=False):
+    host = None if refresh else _cached_index_host(index_name)
+    if host:
+        return host
 
+    url = f"{PINECONE_CONTROLLER_URL}/indexes/{index_name}"
+    headers = {"Api-Key": api_key}
 
-@traceable
-def query_vectors(vector, api_key=PINECONE_API_KEY, index_endpoint=None, namespace=None, top_k=20, filter=None, run_id=""):
-    url = f"https://{index_endpoint}/query"
+    response = await get_async_http_client().get(url, headers=headers)
+    response.raise_for_status()
+    return _store_index_host(index_name, response.json())
+
+def build_query_request(vector, api_key, namespace, top_k, filter, include_metadata=None):
     headers = {
         "Api-Key": api_key,
         "Content-Type": "application/json"
@@ -32,40 +72,102 @@ def query_vectors(vector, api_key=PINECONE_API_KEY, index_endpoint=None, namespa
 
     if filter:
         filter = {k: v for k, v in filter.items() if v is not None}
-        
+
     data = {
         "namespace": namespace,
         "vector": vector,
         "topK": top_k,
-        "includeMetadata": True,
-        "filter": filter 
+        "includeMetadata": not SLIM_VECTOR_METADATA if include_metadata is None else include_metadata,
+        "filter": filter
     }
+    return headers, data
+
 
-    response = httpx.post(url, headers=headers, json=data)
+@traceable
+@timed("query_vectors")
+def query_vectors(vector, api_key=PINECONE_API_KEY, index_endpoint=None, namespace=None, top_k=20, filter=None, run_id="", index_name=INDEX_NAME, include_metadata=None):
+    headers, data = build_query_request(vector, api_key, namespace, top_k, filter, include_metadata)
+    index_endpoint = index_endpoint or get_index_endpoint(api_key=api_key, index_name=index_name)
+
+    try:
+        response = get_http_client().post(index_url(index_endpoint, "/query"), headers=headers, json=data)
+    except httpx.TransportError:
+        # The cached host may be stale, so resolve it again and retry once
+        index_endpoint = get_index_endpoint(api_key=api_key, index_name=index_name, refresh=True)
+        response = get_http_client().post(index_url(index_endpoint, "/query"), headers=headers, json=data)
     response.raise_for_status()
-    return response.json()
+    record_pinecone_response("query", response)
+    result = response.json()
+    if not data["includeMetadata"] and needs_metadata(result):
+        # Some vectors weren't written by ingest, so their ids don't carry a passage_id; ask for metadata instead
+        return query_vectors(vector, api_key, index_endpoint, namespace, top_k, filter, run_id, index_name, include_metadata=True)
+    return result
+
+def slim_passage_id(vector_id):
+    """The passage_id in a vector id written by ingest ("<passage_id>-<chunk>"), or None for any other id."""
+    match = SLIM_VECTOR_ID.match(vector_id)
+    return int(match.group(1)) if match else None
+
+def needs_metadata(response):
+    """True if a match came back without metadata and its id doesn't say which passage it is."""
+    return any(not result.get('metadata') and slim_passage_id(result['id']) is None for result in response['matches'])
+
+def parse_pinecone_matches(response):
+    """Return {"passage_id", "score", "metadata"} per match. Slim vectors come back without metadata,
+    in which case the passage_id is the prefix of the vector id ("<passage_id>-<chunk>"). Matches with
+    neither are skipped."""
+    matches = []
+    for result in response['matches']:
+        metadata = result.get('metadata') or {}
+        passage_id = int(metadata['passage_id']) if 'passage_id' in metadata else slim_passage_id(result['id'])
+        if passage_id is None:
+            print(f"Skipping vector {result['id']}: no passage_id in its metadata or id")
+            continue
+        matches.append({'passage_id': passage_id, 'score': result.get('score'), 'metadata': metadata})
+    return matches
+
+def hydrate_matches(matches):
+    """Build passages from parsed matches, loading the text of slim matches from Postgres in one query."""
+    slim_ids = [match['passage_id'] for match in matches if 'english_text' not in match['metadata']]
+    stored_passages = get_passages_and_translations(slim_ids) if slim_ids else {}
+
+    passages = []
+    for match in matches:
+        metadata = match['metadata']
+        if 'english_text' in metadata:
+            passages.append({
+                'passage_id': match['passage_id'],
+                'hebrew_text': metadata['hebrew_text'],
+                'english_text': metadata['english_text'],
+                'translation_id': metadata['translation_id'],
+                'book_name': metadata['book_name'],
+                'page_number': metadata['page_number'],
+                'text_to_embed': metadata['text_to_embed'] if 'text_to_embed' in metadata else None,
+                'score': match['score']
+            })
+        elif match['passage_id'] in stored_passages:
+            passages.append({**stored_passages[match['passage_id']], 'text_to_embed': metadata.get('text_to_embed'), 'score': match['score']})
+
+    # Filter out passages that have English text which includes "sample translation"
+    return [passage for passage in passages if "sample translation" not in passage['english_text'].lower()]
+
+def format_pinecone_matches(response):
+    return hydrate_matches(parse_pinecone_matches(response))
+
+def dedupe_passages(passages):
+    # Keep the first (best ranked) copy of each passage_id
+    seen_ids = set()
+    return [passage for passage in passages if not (passage['passage_id'] in seen_ids or seen_ids.add(passage['passage_id']))]
 
 @traceable
-def get_pinecone_vdb_results(embedded_query, index_endpoint, name_space, k=10, filter=None):
+def get_pinecone_vdb_results(embedded_query, index_endpoint, name_space, k=10, filter=None, index_name=INDEX_NAME):
     
-    response = query_vectors(embedded_query, index_endpoint=index_endpoint, namespace=name_space, top_k=k, filter=filter)
-
-    passages = [
-        {
-            'passage_id': int(result['metadata']['passage_id']),
-            'hebrew_text': result['metadata']['hebrew_text'],
-            'english_text': result['metadata']['english_text'],
-            'translation_id': result['metadata']['translation_id'],
-            'book_name': result['metadata']['book_name'],
-            'page_number': result['metadata']['page_number'],
-            'text_to_embed': result['metadata']['text_to_embed'] if 'text_to_embed' in result['metadata'] else None
-        }
-        for result in response['matches']
-    ]
+    if VECTOR_BACKEND == "local":
+        response = query_local_index(embedded_query, namespace=name_space, top_k=k, filter=filter)
+    else:
+        response = query_vectors(embedded_query, index_endpoint=index_endpoint, namespace=name_space, top_k=k, filter=filter, index_name=index_name)
 
-    # Filter out passages that have English text which includes "sample translation"
-    passages = [passage for passage in passages if "sample translation" not in passage['english_text'].lower()]
-    return passages
+    return format_pinecone_matches(response)
 
 @traceable
 def get_context_from_pinecone_vdb(queries, index_name, namespace, k=10, print_output=PRINT_OUTPUT):
@@ -73,16 +175,16 @@ def get_context_from_pinecone_vdb(queries, index_name, namespace, k=10, print_ou
 
     filter = queries["filter"] if "filter" in queries else None
 
-    index_endpoint = get_index_endpoint(api_key=PINECONE_API_KEY, index_name=index_name)
+    index_endpoint = None if VECTOR_BACKEND == "local" else get_index_endpoint(api_key=PINECONE_API_KEY, index_name=index_name)
 
     for key in queries:
         if key.startswith("query"):
             embedded_query = embed_text_openai(queries[key])
-            context = get_pinecone_vdb_results(embedded_query, index_endpoint, namespace, k, filter=filter)
+            context = get_pinecone_vdb_results(embedded_query, index_endpoint, namespace, k, filter=filter, index_name=index_name)
             contexts.extend(context)
 
     # Remove duplicates
-    contexts = [dict(t) for t in {tuple(d.items()) for d in contexts}]
+    contexts = dedupe_passages(contexts)
     
     if print_output:
         print("Number of contexts: ", len(contexts))
@@ -95,15 +197,104 @@ async def get_context_async(query, index_name, namespace, k, print_output):
 def get_context_from_pinecone_vdb_v2(embedded_queries, filter, index_name, namespace, k=10, print_output=PRINT_OUTPUT):
     contexts = []
 
-    index_endpoint = get_index_endpoint(api_key=PINECONE_API_KEY, index_name=index_name)
+    index_endpoint = None if VECTOR_BACKEND == "local" else get_index_endpoint(api_key=PINECONE_API_KEY, index_name=index_name)
 
     for query in embedded_queries:
-        context = get_pinecone_vdb_results(query, index_endpoint, namespace, k, filter=filter)
+        context = get_pinecone_vdb_results(query, index_endpoint, namespace, k, filter=filter, index_name=index_name)
         contexts.extend(context)
 
     # Remove duplicates
-    contexts = [dict(t) for t in {tuple(d.items()) for d in contexts}]
+    contexts = dedupe_passages(contexts)
     
     if print_output:
         print("Number of contexts: ", len(contexts))
     return contexts
+
+
+@traceable
+@timed("query_vectors")
+async def query_vectors_async(vector, api_key=PINECONE_API_KEY, index_endpoint=None, namespace=None, top_k=20, filter=None, index_name=INDEX_NAME, include_metadata=None):
+    headers, data = build_query_request(vector, api_key, namespace, top_k, filter, include_metadata)
+    index_endpoint = index_endpoint or await get_index_endpoint_async(api_key=api_key, index_name=index_name)
+    client = get_async_http_client()
+
+    # Each attempt is bounded by what is left of the request deadline, and a slow one is hedged with a
+    # duplicate request after PINECONE_HEDGE_DELAY
+    post = lambda: client.post(index_url(index_endpoint, "/query"), headers=headers, json=data, timeout=stage_timeout(PINECONE_TIMEOUT))
+    try:
+        response = await hedged(post, PINECONE_HEDGE_DELAY, "pinecone_query")
+    except httpx.TransportError:
+        # The cached host may be stale, so resolve it again and retry once
+        index_endpoint = await get_index_endpoint_async(api_key=api_key, index_name=index_name, refresh=True)
+        response = await hedged(post, PINECONE_HEDGE_DELAY, "pinecone_query")
+    response.raise_for_status()
+    record_pinecone_response("query", response)
+    result = response.json()
+    if not data["includeMetadata"] and needs_metadata(result):
+        # Some vectors weren't written by ingest, so their ids don't carry a passage_id; ask for metadata instead
+        return await query_vectors_async(vector, api_key, index_endpoint, namespace, top_k, filter, index_name, include_metadata=True)
+    return result
+
+async def query_vdb_async(embedded_query, index_endpoint, name_space, k=10, filter=None, index_name=INDEX_NAME):
+    if VECTOR_BACKEND == "local":
+        # NumPy releases the GIL during the matrix product, so local lookups also run in parallel
+        return await asyncio.to_thread(query_local_index, embedded_query, namespace=name_space, top_k=k, filter=filter)
+    return await query_vectors_async(embedded_query, index_endpoint=index_endpoint, namespace=name_space, top_k=k, filter=filter, index_name=index_name)
+
+async def get_pinecone_vdb_results_async(embedded_query, index_endpoint, name_space, k=10, filter=None, index_name=INDEX_NAME):
+    response = await query_vdb_async(embedded_query, index_endpoint, name_space, k, filter=filter, index_name=index_name)
+    return await asyncio.to_thread(format_pinecone_matches, response)
+
+@timed("upsert_vectors")
+async def upsert_vectors_async(vectors, namespace, api_key=PINECONE_API_KEY, index_endpoint=None, index_name=INDEX_NAME):
+    """Upsert a batch of {"id", "values", "metadata"} dicts into a namespace."""
+    headers = {
+        "Api-Key": api_key,
+        "Content-Type": "application/json"
+    }
+    data = {
+        "namespace": namespace,
+        "vectors": vectors
+    }
+    index_endpoint = index_endpoint or await get_index_endpoint_async(api_key=api_key, index_name=index_name)
+    client = get_async_http_client()
+
+    try:
+        response = await client.post(index_url(index_endpoint, "/vectors/upsert"), headers=headers, json=data)
+    except httpx.TransportError:
+        index_endpoint = await get_index_endpoint_async(api_key=api_key, index_name=index_name, refresh=True)
+        response = await client.post(index_url(index_endpoint, "/vectors/upsert"), headers=headers, json=data)
+    response.raise_for_status()
+    record_pinecone_response("upsert", response)
+    return response.json()
+
+@traceable
+async def get_ranked_lists_from_vdb_async(embedded_queries, filter, index_name, namespaces, k=10):
+    """Run every (namespace x query) lookup concurrently and return one ranked passage list per lookup."""
+    lookups = [(query, filter, namespace) for namespace in namespaces for query in embedded_queries]
+    return await get_ranked_lists_for_lookups_async(lookups, index_name, k)
+
+async def get_ranked_lists_for_lookups_async(lookups, index_name, k=10, concurrency=None):
+    """Run (embedded_query, filter, namespace) lookups concurrently, at most `concurrency` at a time, and
+    return one ranked passage list per lookup. Passages are loaded once however many lookups return them."""
+    # Resolve the index host once for all lookups
+    index_endpoint = None if VECTOR_BACKEND == "local" else await get_index_endpoint_async(api_key=PINECONE_API_KEY, index_name=index_name)
+    semaphore = asyncio.Semaphore(concurrency) if concurrency else None
+
+    async def lookup(query, filter, namespace):
+        if semaphore is None:
+            return await query_vdb_async(query, index_endpoint, namespace, k, filter=filter, index_name=index_name)
+        async with semaphore:
+            return await query_vdb_async(query, index_endpoint, namespace, k, filter=filter, index_name=index_name)
+
+    responses = await asyncio.gather(*[lookup(query, filter, namespace) for query, filter, namespace in lookups])
+    match_lists = [parse_pinecone_matches(response) for response in responses]
+
+    # Slim matches are hydrated with a single bulk query for all lookups
+    unique_matches = dedupe_passages([match for matches in match_lists for match in matches])
+    passages = {passage['passage_id']: passage for passage in await asyncio.to_thread(hydrate_matches, unique_matches)}
+
+    return [
+        [{**passages[match['passage_id']], 'score': match['score']} for match in matches if match['passage_id'] in passages]
+        for matches in match_lists
+    ]
@@ -0,0 +1,170 @@
+import contextvars
+import datetime
+import importlib.util
+import json
+import os
+import random
+import re
+import time
+import uuid
+from talmud_query.config import PROFILING_ENABLED, PROFILE_SAMPLE_RATE, PROFILE_INTERVAL, PROFILE_DIR, PROFILE_MAX_FILES
+from talmud_query.metrics import record_profile
+
+# Opt-in per-request profiling with pyinstrument, a sampling profiler, to tell Python-side work (dedup, dict
+# building, pydantic model creation, JSON) from network waits on a live worker.
+#
+# A profiled request runs two profilers: one on the request thread (Flask, caches, serialization) and one in
+# pyinstrument's async mode around the pipeline coroutine on the shared event loop (see profiled()). In async
+# mode, time the request spends awaiting the network shows up as <await> frames and other requests' work on the
+# loop is left out. The two sessions are combined and written to PROFILE_DIR as an HTML flamegraph and a
+# speedscope file (open in https://www.speedscope.app), next to a small JSON file describing the request.
+#
+# pyinstrument is imported on first use, so it costs nothing until a request is profiled.
+
+PYINSTRUMENT_AVAILABLE = importlib.util.find_spec("pyinstrument") is not None
+PROFILE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+FORMATS = {"html": ".html", "speedscope": ".speedscope.json"}
+
+_current_profile = contextvars.ContextVar("talmud_query_profile", default=None)
+
+
+class RequestProfile:
+    def __init__(self, name, trigger):
+        from pyinstrument import Profiler
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.trigger = trigger
+        self.started_at = time.time()
+        self.sessions = []
+        self.profiler = Profiler(interval=PROFILE_INTERVAL, async_mode="disabled")
+        self.token = None
+
+    def start(self):
+        self.profiler.start()
+        self.token = _current_profile.set(self)
+
+    def release(self):
+        """Stop pipelines scheduled from this context being profiled. Must run in the context that called start(),
+        i.e. in the request's teardown, so the next request on the thread doesn't inherit the profile."""
+        if self.token is not None:
+            _current_profile.reset(self.token)
+            self.token = None
+
+    def finish(self, status=None):
+        """Stop profiling and write the profile files. Must run on the thread that called start()."""
+        from pyinstrument.session import Session
+        from pyinstrument.renderers import HTMLRenderer, SpeedscopeRenderer
+        session = self.profiler.stop()
+        for other in self.sessions:
+            session = Session.combine(session, other)
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(profile_path(self.id, "html"), "w") as f:
+            f.write(HTMLRenderer().render(session))
+        with open(profile_path(self.id, "speedscope"), "w") as f:
+            f.write(SpeedscopeRenderer().render(session))
+        with open(profile_path(self.id), "w") as f:
+            json.dump({
+                "id": self.id,
+                "request": self.name,
+                "status": status,
+                "trigger": self.trigger,
+                "created_at": datetime.datetime.fromtimestamp(self.started_at, datetime.timezone.utc).isoformat(),
+                "duration_seconds": time.time() - self.started_at,
+                "cpu_seconds": session.cpu_time,
+            }, f)
+        record_profile(self.trigger)
+        prune_profiles()
+
+
+def profile_trigger(requested):
+    """Why this request should be profiled ("header" or "sampled"), or None to leave it alone."""
+    if not PROFILING_ENABLED or not PYINSTRUMENT_AVAILABLE:
+        return None
+    if requested:
+        return "header"
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        return "sampled"
+    return None
+
+
+def start_request_profile(name, trigger):
+    """Start profiling the current request on this thread. Returns the RequestProfile, or None on failure."""
+    try:
+        profile = RequestProfile(name, trigger)
+        profile.start()
+        return profile
+    except Exception as e:
+        print(f"Error starting profiler: {e}")
+        return None
+
+
+async def profiled(coro):
+    """Await coro, profiling it if the request that scheduled it is being profiled. Context variables are
+    carried to the event loop by submit_async, which is how the profile is found."""
+    profile = _current_profile.get()
+    if profile is None:
+        return await coro
+    try:
+        from pyinstrument import Profiler
+        profiler = Profiler(interval=PROFILE_INTERVAL, async_mode="enabled")
+        profiler.start()
+    except Exception as e:
+        print(f"Error starting pipeline profiler: {e}")
+        return await coro
+    try:
+        return await coro
+    finally:
+        profile.sessions.append(profiler.stop())
+
+
+def profile_path(profile_id, format=None):
+    return os.path.join(PROFILE_DIR, profile_id + (FORMATS[format] if format else ".json"))
+
+
+def get_profile_path(profile_id, format):
+    """Path of a stored profile file, or None if there is no such profile or format."""
+    if not PROFILE_ID_PATTERN.match(profile_id) or format not in FORMATS:
+        return None
+    path = profile_path(profile_id, format)
+    return path if os.path.exists(path) else None
+
+
+def modified_at(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        # Pruned by another worker since it was listed
+        return 0
+
+
+def profile_ids():
+    """Ids of the stored profiles, newest first by the mtime of their metadata file."""
+    try:
+        names = [name for name in os.listdir(PROFILE_DIR) if PROFILE_ID_PATTERN.match(name[:-len(".json")]) and name.endswith(".json")]
+    except FileNotFoundError:
+        return []
+    ids = [name[:-len(".json")] for name in names]
+    return sorted(ids, key=lambda profile_id: modified_at(profile_path(profile_id)), reverse=True)
+
+
+def list_profiles(limit=50):
+    """Metadata of the most recent profiles, newest first."""
+    profiles = []
+    for path in [profile_path(profile_id) for profile_id in profile_ids()[:limit]]:
+        try:
+            with open(path) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"Error reading profile {path}: {e}")
+    return profiles
+
+
+def prune_profiles(max_files=PROFILE_MAX_FILES):
+    """Delete the oldest profiles beyond max_files. Goes by file mtimes alone, so no profile is read."""
+    for profile_id in profile_ids()[max_files:]:
+        for format in (None, *FORMATS):
+            try:
+                os.remove(profile_path(profile_id, format))
+            except FileNotFoundError:
+                pass
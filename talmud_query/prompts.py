@@ -29,7 +29,16 @@ USER_PROMPT_FILTER_CONTEXT = ("A user has a query about the Talmud. I have a vec
                               "respond with YES if it is relevant and NO if it is not (don't include anything else in your response or it will mess up my code). "
                               "Here is the query: \n{query}\nHere is the context: \n{context_text}")
 
+SYSTEM_PROMPT_FILTER_CONTEXT_BATCH = "Your are an LLM that is proficient in Talmudic studies. Your job is to help users and follow instructions."
+USER_PROMPT_FILTER_CONTEXT_BATCH = ("A user has a query about the Talmud. I have a vector database that contains all the passages of the Talmud in English. "
+                                    "I already queried it and received an array of context passages. I will soon give the context to a big LLM but first I want "
+                                    "to filter out the results that are not relevant to the query. I will give you the query and several context passages, each "
+                                    "labeled with its passage id. Judge every passage on its own and return one verdict per passage id, with relevant set to true "
+                                    "if the passage is relevant to the query and false if it is not. "
+                                    "Here is the query: \n{query}\nHere are the passages: \n{context_text}")
+
 SYSTEM_PROMPT_FINAL_ANSWER = "Your are an LLM that is proficient in Talmudic studies. Your job is to answer questions by using the given context."
 USER_PROMPT_FINAL_ANSWER = ("I will give you a query about the Talmud and some context passages. You need to answer the query using the context. "
                             "When referencing passages in your answer, please use their book and page name instead of their ids since the user will not "
-                            "recognize the ids. You also need to return all the relevant passage ids. Here is the query: \n{query}\nHere are the context passages: \n{context_json}")
+                            "recognize the ids. You also need to return all the relevant passage ids. Each passage starts with a line giving its id, book and page, "
+                            "followed by its text. Here is the query: \n{query}\nHere are the context passages: \n{context}")
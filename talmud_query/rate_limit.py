@@ -0,0 +1,347 @@
+import asyncio
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+from talmud_query.config import (
+    RATE_LIMIT_ENABLED,
+    RATE_LIMIT_PATH,
+    OPENAI_RPM_LIMIT,
+    OPENAI_TPM_LIMIT,
+    OPENAI_RATE_LIMITS,
+    OPENAI_QUOTA_GROUPS,
+    RATE_LIMIT_FILTER_RESERVE,
+    RATE_LIMIT_MAX_RETRIES,
+    RATE_LIMIT_BACKOFF,
+    RATE_LIMIT_POLL_INTERVAL,
+    RATE_LIMIT_MAX_POLL_INTERVAL,
+    RATE_LIMIT_MAX_WAIT,
+)
+from talmud_query.transport import retryable_openai_errors, retry_after_seconds
+from talmud_query.metrics import observe_stage, record_openai_rate_limited
+
+# Client-side scheduler for OpenAI chat calls. Models are grouped by the quota they draw on (see quota_group):
+# a dated snapshot shares its alias's limits, so expansion ("gpt-4o") and the final answer ("gpt-4o-2024-08-06")
+# compete for one quota, and OPENAI_QUOTA_GROUPS can join further models, e.g. gpt-4o-mini for filtering when the
+# account's limits are shared. Each group has two token buckets, one for requests and one for tokens, refilled
+# at the per-minute limits. The buckets live in a SQLite file on the host so every gunicorn worker draws from
+# the same quota. Callers of a group wait in a shared queue ordered by priority class (final answer, then
+# expansion, then filtering) and arrival time, and only the head of the queue may take capacity. Filtering also
+# leaves RATE_LIMIT_FILTER_RESERVE of its group's buckets untouched, so a final answer in the same group never
+# waits behind a filter burst.
+#
+# A call that finds capacity with nobody ahead of it costs one SQLite transaction: it is only written to the
+# queue when it has to wait, and the token correction from the response's usage (estimated up front) is kept
+# in memory and applied by the process's next transaction on that group.
+#
+# A 429 pauses the group for every worker until its Retry-After has passed, and the call is queued again
+# instead of failing.
+
+PRIORITY_FINAL_ANSWER, PRIORITY_EXPANSION, PRIORITY_FILTER = 0, 1, 2
+PRIORITY_NAMES = {PRIORITY_FINAL_ANSWER: "final_answer", PRIORITY_EXPANSION: "expansion", PRIORITY_FILTER: "filter"}
+# Rough completion sizes, charged up front and settled once the real usage is known
+EXPECTED_OUTPUT_TOKENS = {PRIORITY_FINAL_ANSWER: 800, PRIORITY_EXPANSION: 300, PRIORITY_FILTER: 200}
+STALE_WAITER_SECONDS = 10
+SNAPSHOT_SUFFIX = re.compile(r"-\d{4}-\d{2}-\d{2}$")
+
+# Per-event-loop wakeups for waiters in this process, and cleanups that must outlive a cancelled waiter
+_wakeups = weakref.WeakKeyDictionary()
+_cleanups = set()
+
+
+def quota_group(model):
+    """The quota a model draws on: its OPENAI_QUOTA_GROUPS entry, or the model name without a snapshot date."""
+    if model in OPENAI_QUOTA_GROUPS:
+        return OPENAI_QUOTA_GROUPS[model]
+    alias = SNAPSHOT_SUFFIX.sub("", model)
+    return OPENAI_QUOTA_GROUPS.get(alias, alias)
+
+
+def model_limits(group):
+    """(requests per minute, tokens per minute) for a quota group."""
+    limits = OPENAI_RATE_LIMITS.get(group, {})
+    return limits.get("rpm", OPENAI_RPM_LIMIT), limits.get("tpm", OPENAI_TPM_LIMIT)
+
+
+def estimate_tokens(messages, priority):
+    return sum(len(message["content"]) for message in messages) // 4 + EXPECTED_OUTPUT_TOKENS[priority]
+
+
+class RateLimiter:
+    def __init__(self, path=RATE_LIMIT_PATH, poll_interval=RATE_LIMIT_POLL_INTERVAL, max_wait=RATE_LIMIT_MAX_WAIT):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self._local = threading.local()
+        # Token corrections from reported usage, per group, not yet written to the bucket
+        self._corrections = {}
+        self._corrections_lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (model TEXT PRIMARY KEY, requests REAL, tokens REAL, updated_at REAL, paused_until REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS waiters (id TEXT PRIMARY KEY, model TEXT, priority INTEGER, created_at REAL, heartbeat REAL)")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, work):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = work(conn)
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _load_bucket(self, conn, group, now):
+        """Current (requests, tokens, paused_until) for the group, refilled up to now."""
+        rpm, tpm = model_limits(group)
+        row = conn.execute("SELECT requests, tokens, updated_at, paused_until FROM buckets WHERE model = ?", (group,)).fetchone()
+        if row is None:
+            return rpm, tpm, 0.0
+        requests, tokens, updated_at, paused_until = row
+        elapsed = max(0.0, now - updated_at)
+        return min(rpm, requests + elapsed * rpm / 60), min(tpm, tokens + elapsed * tpm / 60), paused_until
+
+    def _save_bucket(self, conn, group, requests, tokens, now, paused_until):
+        conn.execute(
+            "INSERT OR REPLACE INTO buckets (model, requests, tokens, updated_at, paused_until) VALUES (?, ?, ?, ?, ?)",
+            (group, requests, tokens, now, paused_until)
+        )
+
+    def _take_correction(self, group):
+        with self._corrections_lock:
+            return self._corrections.pop(group, 0)
+
+    def _add_correction(self, group, tokens):
+        if tokens:
+            with self._corrections_lock:
+                self._corrections[group] = self._corrections.get(group, 0) + tokens
+
+    def _group_transaction(self, group, work):
+        """Run work(conn, now, requests, tokens, paused_until) in a transaction on the group's bucket, with this
+        process's pending token correction applied. work returns (result, bucket) where bucket is the
+        (requests, tokens, paused_until) to store."""
+        correction = self._take_correction(group)
+
+        def run(conn):
+            now = time.time()
+            requests, tokens, paused_until = self._load_bucket(conn, group, now)
+            result, bucket = work(conn, now, requests, tokens - correction, paused_until)
+            self._save_bucket(conn, group, *bucket[:2], now, bucket[2])
+            return result
+
+        try:
+            return self._transaction(run)
+        except BaseException:
+            self._add_correction(group, correction)
+            raise
+
+    def _try_acquire(self, waiter_id, group, priority, tokens, created_at):
+        """Take capacity if no waiter of the group is ahead of this one. Returns 0 on success, the seconds until
+        capacity frees up when at the head, or None when other waiters are ahead. Any result but 0 leaves the
+        waiter in the queue."""
+        def attempt(conn, now, requests, available_tokens, paused_until):
+            conn.execute("DELETE FROM waiters WHERE heartbeat < ?", (now - STALE_WAITER_SECONDS,))
+            ahead = conn.execute(
+                "SELECT 1 FROM waiters WHERE model = ? AND id != ? AND (priority < ? OR (priority = ? AND created_at < ?)) LIMIT 1",
+                (group, waiter_id, priority, priority, created_at)
+            ).fetchone()
+            bucket = (requests, available_tokens, paused_until)
+            if ahead is None and paused_until <= now:
+                rpm, tpm = model_limits(group)
+                reserve = RATE_LIMIT_FILTER_RESERVE if priority == PRIORITY_FILTER else 0.0
+                needed_tokens = min(tokens, tpm * (1 - reserve))
+                request_deficit = 1 + reserve * rpm - requests
+                token_deficit = needed_tokens + reserve * tpm - available_tokens
+                if request_deficit <= 0 and token_deficit <= 0:
+                    conn.execute("DELETE FROM waiters WHERE id = ?", (waiter_id,))
+                    return 0, (requests - 1, available_tokens - needed_tokens, paused_until)
+                wait = max(request_deficit * 60 / rpm, token_deficit * 60 / tpm, self.poll_interval / 5)
+            else:
+                wait = None if ahead is not None else paused_until - now
+            # Queued (or heartbeat refreshed) so lower priority callers wait behind it
+            conn.execute(
+                "INSERT OR REPLACE INTO waiters (id, model, priority, created_at, heartbeat) VALUES (?, ?, ?, ?, ?)",
+                (waiter_id, group, priority, created_at, now)
+            )
+            return wait, bucket
+
+        return self._group_transaction(group, attempt)
+
+    def _remove_waiter(self, waiter_id):
+        try:
+            self._connection().execute("DELETE FROM waiters WHERE id = ?", (waiter_id,))
+        except sqlite3.Error as e:
+            print(f"Error leaving the rate limit queue: {e}")
+
+    def _next_poll(self, wait, polls):
+        """Seconds to sleep before the next attempt. Waiters behind the head back off, but poll often
+        enough to keep their heartbeat fresh."""
+        if wait is not None:
+            return min(wait, 1.0)
+        return min(self.poll_interval * 2 ** polls, RATE_LIMIT_MAX_POLL_INTERVAL, STALE_WAITER_SECONDS / 4)
+
+    def acquire(self, model, priority, tokens):
+        """Block until the call may go out. Returns the seconds waited."""
+        group = quota_group(model)
+        waiter_id, started, polls = uuid.uuid4().hex, time.time(), 0
+        queued = False
+        try:
+            while time.time() - started < self.max_wait:
+                wait = self._try_acquire(waiter_id, group, priority, tokens, started)
+                queued = wait != 0
+                if not queued:
+                    break
+                time.sleep(self._next_poll(wait, polls))
+                polls = 0 if wait is not None else polls + 1
+        except sqlite3.Error as e:
+            # Better to risk a 429 than to fail the request
+            print(f"Error in rate limiter, sending without it: {e}")
+        finally:
+            if queued:
+                self._remove_waiter(waiter_id)
+                self._notify_local_waiters()
+        return time.time() - started
+
+    async def acquire_async(self, model, priority, tokens):
+        """Like acquire, but waits without blocking the event loop. Waiters in this process are woken as
+        soon as one of them leaves the queue; waiters in other processes notice on their next poll."""
+        group = quota_group(model)
+        waiter_id, started, polls = uuid.uuid4().hex, time.time(), 0
+        attempt = None
+        try:
+            while time.time() - started < self.max_wait:
+                woken = self._local_wakeup()
+                # Shielded so a cancellation can't abandon the thread mid-write; the cleanup below waits for it
+                attempt = asyncio.ensure_future(asyncio.to_thread(self._try_acquire, waiter_id, group, priority, tokens, started))
+                wait = await asyncio.shield(attempt)
+                if wait == 0:
+                    break
+                try:
+                    await asyncio.wait_for(woken.wait(), self._next_poll(wait, polls))
+                    polls = 0
+                except asyncio.TimeoutError:
+                    polls = 0 if wait is not None else polls + 1
+        except sqlite3.Error as e:
+            print(f"Error in rate limiter, sending without it: {e}")
+        finally:
+            if attempt is not None:
+                cleanup = asyncio.ensure_future(self._leave_queue_async(attempt, waiter_id))
+                _cleanups.add(cleanup)
+                cleanup.add_done_callback(_cleanups.discard)
+                await asyncio.shield(cleanup)
+        return time.time() - started
+
+    async def _leave_queue_async(self, attempt, waiter_id):
+        # A cancelled waiter's last attempt may still be running and would write the waiter row back after a
+        # removal, leaving a stale head that blocks the group for STALE_WAITER_SECONDS, so remove it after
+        try:
+            if await attempt == 0:
+                # Took capacity, which also took it off the queue
+                return
+        except Exception:
+            pass
+        await asyncio.to_thread(self._remove_waiter, waiter_id)
+        self._notify_local_waiters()
+
+    def _local_wakeup(self):
+        """An event set the next time a waiter on this event loop leaves the queue."""
+        loop = asyncio.get_running_loop()
+        event = _wakeups.get(loop)
+        if event is None:
+            event = _wakeups[loop] = asyncio.Event()
+        return event
+
+    def _notify_local_waiters(self):
+        for loop, event in list(_wakeups.items()):
+            _wakeups[loop] = asyncio.Event()
+            loop.call_soon_threadsafe(event.set)
+
+    def settle(self, model, estimated_tokens, usage):
+        """Correct the token bucket by the difference between the estimate and the reported usage. The correction
+        is applied with the process's next transaction on the group rather than written now."""
+        if usage is not None:
+            self._add_correction(quota_group(model), usage.total_tokens - estimated_tokens)
+
+    def pause(self, model, seconds):
+        """Stop every worker from calling the model's quota group for the given number of seconds."""
+        def extend(conn, now, requests, tokens, paused_until):
+            return None, (requests, tokens, max(paused_until, now + seconds))
+        try:
+            self._group_transaction(quota_group(model), extend)
+        except sqlite3.Error as e:
+            print(f"Error pausing rate limited model: {e}")
+
+
+rate_limiter = RateLimiter()
+
+
+def is_rate_limit_error(error):
+    return getattr(error, "status_code", None) == 429
+
+
+def retry_delay(error, attempt, backoff):
+    return retry_after_seconds(error) or backoff * 2 ** attempt + random.random() * backoff
+
+
+def call_openai(model, priority, messages, make_call, max_retries=RATE_LIMIT_MAX_RETRIES, backoff=RATE_LIMIT_BACKOFF):
+    """Run make_call() under the shared rate limits, queueing again (after Retry-After) on 429s and retrying
+    other transient errors with backoff."""
+    tokens = estimate_tokens(messages, priority)
+    for attempt in range(max_retries + 1):
+        if RATE_LIMIT_ENABLED:
+            observe_stage(f"rate_limit_wait.{PRIORITY_NAMES[priority]}", rate_limiter.acquire(model, priority, tokens))
+        try:
+            response = make_call()
+        except retryable_openai_errors() as e:
+            if attempt == max_retries:
+                raise
+            delay = retry_delay(e, attempt, backoff)
+            if is_rate_limit_error(e):
+                record_openai_rate_limited(model)
+                if RATE_LIMIT_ENABLED:
+                    rate_limiter.pause(model, delay)
+                    continue
+            time.sleep(delay)
+            continue
+        if RATE_LIMIT_ENABLED:
+            rate_limiter.settle(model, tokens, getattr(response, "usage", None))
+        return response
+
+
+async def call_openai_async(model, priority, messages, make_call, max_retries=RATE_LIMIT_MAX_RETRIES, backoff=RATE_LIMIT_BACKOFF):
+    """Async call_openai; make_call() returns an awaitable."""
+    tokens = estimate_tokens(messages, priority)
+    for attempt in range(max_retries + 1):
+        if RATE_LIMIT_ENABLED:
+            observe_stage(f"rate_limit_wait.{PRIORITY_NAMES[priority]}", await rate_limiter.acquire_async(model, priority, tokens))
+        try:
+            response = await make_call()
+        except retryable_openai_errors() as e:
+            if attempt == max_retries:
+                raise
+            delay = retry_delay(e, attempt, backoff)
+            if is_rate_limit_error(e):
+                record_openai_rate_limited(model)
+                if RATE_LIMIT_ENABLED:
+                    await asyncio.to_thread(rate_limiter.pause, model, delay)
+                    continue
+            await asyncio.sleep(delay)
+            continue
+        if RATE_LIMIT_ENABLED:
+            rate_limiter.settle(model, tokens, getattr(response, "usage", None))
+        return response
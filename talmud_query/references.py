@@ -0,0 +1,134 @@
+import re
+from talmud_query.config import POSSIBLE_BOOKS, REFERENCE_MAX_PAGES
+
+# Local parser for direct references such as "Berakhot 2a", "bava metzia 59b", "Rosh Hashanah 16a-b",
+# "Menachot 29b:" or "Sanhedrin daf 37 amud a". Queries that name a page can skip query expansion and
+# vector retrieval and load the page straight from Postgres.
+#
+# Pages are stored as "<daf><amud>" ("2a", "59b"). Daf notation uses "." for amud a and ":" for amud b, but
+# only written straight after the daf and followed by more of the reference ("Berakhot 3:-4"); otherwise it is
+# read as punctuation, so "Berakhot 2. What does it say" is not 2a. A daf without an amud means both sides. A bare number after a book name only counts when it ends the query
+# or follows "daf"/"page", so "Berakhot 2 times a day" is left to retrieval.
+
+# Spellings in POSSIBLE_BOOKS that don't differ only by spaces/underscores
+BOOK_ALIASES = {
+    'Chagigah': ['Hagigah'],
+    'Berakhot': ['Berachot', 'Brachot'],
+    'Eiruvin': ['Eruvin'],
+    'Beitzah': ['Beitza', 'Betzah'],
+    'Taanit': ["Ta'anit"],
+    'Ketubot': ['Ketubbot'],
+    'Bava_Kamma': ['Bava Kama'],
+    'Bava_Batra': ['Bava Basra'],
+}
+FIRST_DAF, LAST_DAF = 2, 176  # Bava Batra is the longest tractate
+AMUD_A = {'a', 'aleph', 'alef', '.'}
+
+
+def normalize_book(name):
+    return re.sub(r"[\s_\-']+", " ", name).strip().lower()
+
+
+def build_book_groups():
+    """{normalized spelling: [every POSSIBLE_BOOKS name for that tractate]}"""
+    groups = {}
+    for name in POSSIBLE_BOOKS:
+        groups.setdefault(normalize_book(name), []).append(name)
+    for canonical, aliases in BOOK_ALIASES.items():
+        group = groups.setdefault(normalize_book(canonical), [canonical])
+        for alias in aliases:
+            if alias in POSSIBLE_BOOKS:
+                group.extend(name for name in groups.pop(normalize_book(alias), []) if name not in group)
+            groups[normalize_book(alias)] = group
+    return groups
+
+
+BOOK_GROUPS = build_book_groups()
+
+
+def book_pattern(spelling):
+    return r"[\s_\-']*".join(re.escape(part) for part in spelling.replace("'", " ").split())
+
+
+REFERENCE_PATTERN = re.compile(
+    r"\b(?P<book>" + "|".join(book_pattern(spelling) for spelling in sorted(BOOK_GROUPS, key=len, reverse=True)) + r")"
+    r"[\s,]*(?:(?P<prefix>daf|page|folio|fol\.|f\.)\s*)?"
+    r"(?P<daf>\d{1,3})(?:(?P<amud>[ab])\b|\s*amud\s+(?P<amud_name>aleph|alef|bet|beit|beth|a|b)\b|(?P<mark>[.:])(?=[^\s.,;:!?)\]\"']))?"
+    r"(?:\s*(?:-|–|to)\s*(?P<end_daf>\d{1,3})?\s*(?P<end_amud>[ab])?\b)?",
+    re.IGNORECASE
+)
+BOOK_NAME_PATTERN = re.compile(
+    r"\b(?P<book>" + "|".join(book_pattern(spelling) for spelling in sorted(BOOK_GROUPS, key=len, reverse=True)) + r")\b",
+    re.IGNORECASE
+)
+QUERY_END_PATTERN = re.compile(r"[\s.,;:!?)\]\"']*$")
+
+
+def expand_pages(daf, amud, end_daf=None, end_amud=None):
+    """Page numbers from daf/amud to end_daf/end_amud (amud None means both sides), or None if out of range."""
+    start = (daf - FIRST_DAF) * 2 + (0 if amud in (None, 'a') else 1)
+    if end_daf is None and end_amud is None:
+        end = start + (1 if amud is None else 0)
+    else:
+        end_daf = daf if end_daf is None else end_daf
+        end = (end_daf - FIRST_DAF) * 2 + (0 if end_amud == 'a' else 1)
+    if not FIRST_DAF <= daf <= LAST_DAF or end < start or end - start + 1 > REFERENCE_MAX_PAGES or end_daf and end_daf > LAST_DAF:
+        return None
+    return [f"{FIRST_DAF + side // 2}{'ab'[side % 2]}" for side in range(start, end + 1)]
+
+
+def parse_amud(match):
+    amud = match.group('amud') or match.group('amud_name') or match.group('mark')
+    if amud is None:
+        return None
+    return 'a' if amud.lower() in AMUD_A else 'b'
+
+
+def is_page_reference(match):
+    """A book name followed by a bare number ("Berakhot 2 times a day", "Shabbat 7 labors") is only a page
+    reference with an amud, a "daf"/"page" prefix, or when the number ends the query."""
+    return bool(
+        match.group('prefix') or parse_amud(match) or match.group('end_amud')
+        or QUERY_END_PATTERN.match(match.string, match.end())
+    )
+
+
+def parse_references(query):
+    """Return [{"book_names": [...], "page_numbers": [...]}] for every page reference in the query.
+
+    book_names lists every spelling of the tractate in POSSIBLE_BOOKS, since either may be the one stored.
+    Ranges longer than REFERENCE_MAX_PAGES sides are ignored.
+    """
+    references = []
+    for match in REFERENCE_PATTERN.finditer(query):
+        if not is_page_reference(match):
+            continue
+        book_names = BOOK_GROUPS[normalize_book(match.group('book'))]
+        end_daf = match.group('end_daf')
+        end_amud = match.group('end_amud')
+        pages = expand_pages(
+            int(match.group('daf')),
+            parse_amud(match),
+            int(end_daf) if end_daf else None,
+            end_amud.lower() if end_amud else None,
+        )
+        if pages:
+            references.append({"book_names": book_names, "page_numbers": pages})
+    return references
+
+
+def parse_book_names(query):
+    """Every POSSIBLE_BOOKS spelling of the tractates the query names, e.g. for "What does Berakhot say about
+    the Shema?" ["Berakhot"]. Empty when no tractate is named."""
+    names = []
+    for match in BOOK_NAME_PATTERN.finditer(query):
+        names.extend(name for name in BOOK_GROUPS[normalize_book(match.group('book'))] if name not in names)
+    return sorted(names)
+
+
+def reference_filter(references):
+    """A Pinecone style metadata filter matching the referenced pages."""
+    return {
+        "book_name": {"$in": sorted({name for reference in references for name in reference["book_names"]})},
+        "page_number": {"$in": sorted({page for reference in references for page in reference["page_numbers"]})},
+    }
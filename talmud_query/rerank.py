@@ -0,0 +1,78 @@
+import math
+import re
+from collections import Counter
+from talmud_query.config import RRF_K, RERANK_TOP_N, RERANK_USE_BM25, RERANK_BM25_WEIGHT, FULLTEXT_WEIGHT
+
+# Reranking between retrieval and the LLM relevance filter. Each (namespace x query) lookup is one
+# ranked list; reciprocal-rank fusion combines them, optionally together with a local BM25 ranking of
+# the candidates' English text, and only the top-N fused passages go on to filtering. Full-text hits from
+# Postgres (see fulltext.py) join the fusion as one more ranked list.
+
+TAG_PATTERN = re.compile(r"<[^>]+>")
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(TAG_PATTERN.sub(" ", text or "").lower())
+
+
+def bm25_scores(query, passages, text_field="english_text", k1=1.5, b=0.75):
+    """BM25 score of each passage for the query, with document frequencies taken from the candidate set."""
+    documents = [tokenize(passage[text_field]) for passage in passages]
+    if not documents:
+        return []
+    average_length = sum(len(document) for document in documents) / len(documents) or 1
+    document_frequency = Counter(term for document in documents for term in set(document))
+    query_terms = set(tokenize(query))
+
+    scores = []
+    for document in documents:
+        term_counts = Counter(document)
+        score = 0.0
+        for term in query_terms:
+            if term not in term_counts:
+                continue
+            idf = math.log(1 + (len(documents) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+            tf = term_counts[term]
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(document) / average_length))
+        scores.append(score)
+    return scores
+
+
+def reciprocal_rank_fusion(ranked_lists, weights=None, k=RRF_K):
+    """Fuse ranked passage lists by passage_id. Returns unique passages, best first, each carrying
+    'fused_score' and the best vector 'score' seen for it."""
+    weights = weights or [1.0] * len(ranked_lists)
+    fused, passages = {}, {}
+    for ranked, weight in zip(ranked_lists, weights):
+        seen = set()
+        for rank, passage in enumerate(ranked):
+            passage_id = passage['passage_id']
+            if passage_id in seen:
+                continue
+            seen.add(passage_id)
+            fused[passage_id] = fused.get(passage_id, 0.0) + weight / (k + rank + 1)
+            best = passages.get(passage_id)
+            if best is None or (passage.get('score') or 0) > (best.get('score') or 0):
+                passages[passage_id] = passage
+
+    order = sorted(fused, key=lambda passage_id: (fused[passage_id], passages[passage_id].get('score') or 0), reverse=True)
+    return [{**passages[passage_id], 'fused_score': fused[passage_id]} for passage_id in order]
+
+
+def rerank_passages(query, ranked_lists, top_n=RERANK_TOP_N, use_bm25=RERANK_USE_BM25, bm25_weight=RERANK_BM25_WEIGHT, text_field="english_text",
+                    lexical=None, lexical_weight=FULLTEXT_WEIGHT):
+    ranked_lists = [ranked for ranked in ranked_lists if ranked]
+    weights = [1.0] * len(ranked_lists)
+    if lexical:
+        ranked_lists = ranked_lists + [lexical]
+        weights = weights + [lexical_weight]
+
+    if use_bm25 and ranked_lists:
+        candidates = reciprocal_rank_fusion(ranked_lists)
+        scores = bm25_scores(query, candidates, text_field=text_field)
+        lexical = [passage for passage, score in sorted(zip(candidates, scores), key=lambda item: item[1], reverse=True) if score > 0]
+        ranked_lists = ranked_lists + [lexical]
+        weights = weights + [bm25_weight]
+
+    return reciprocal_rank_fusion(ranked_lists, weights)[:top_n]
@@ -0,0 +1,155 @@
+import concurrent.futures
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from talmud_query.config import SINGLE_FLIGHT_PATH, SINGLE_FLIGHT_TIMEOUT, SINGLE_FLIGHT_POLL_INTERVAL, SINGLE_FLIGHT_RESULT_TTL
+from talmud_query.metrics import record_single_flight
+
+# Request coalescing for identical in-flight queries. Within a worker, the first caller for a key runs
+# the work and concurrent duplicates wait on its future. Across gunicorn workers, a SQLite file on the
+# host acts as the shared lock and result store: one worker claims the key, the others poll for the
+# result it publishes. Results must be JSON serializable to be shared across workers.
+#
+# A worker that dies mid-flight leaves its claim behind; the claim lapses after SINGLE_FLIGHT_TIMEOUT
+# and the next caller takes over. A leader that fails (or whose result is rejected by publish_if) publishes nothing,
+# so waiters in other workers then try again themselves.
+
+
+class SingleFlight:
+    def __init__(self, path=SINGLE_FLIGHT_PATH, timeout=SINGLE_FLIGHT_TIMEOUT, poll_interval=SINGLE_FLIGHT_POLL_INTERVAL, result_ttl=SINGLE_FLIGHT_RESULT_TTL):
+        self.path = path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.result_ttl = result_ttl
+        self._instance_id = uuid.uuid4().hex[:8]
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def owner(self):
+        # Includes the pid so workers forked from a preloaded app don't share an owner id
+        return f"{os.getpid()}-{self._instance_id}"
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS inflight (key TEXT PRIMARY KEY, owner TEXT, expires_at REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT, expires_at REAL)")
+            self._local.conn = conn
+        return conn
+
+    def do(self, key, fn, publish_if=None):
+        """Return (result, shared). shared is True when the result came from another caller's run of fn.
+
+        publish_if(result), if given, decides whether a result is offered to other workers; results it
+        rejects (e.g. errors) still go to duplicates waiting in this worker.
+        """
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self._inflight[key] = future
+
+        if not leader:
+            record_single_flight("follower_local")
+            return future.result(), True
+
+        try:
+            result, shared = self._do_shared(key, fn, publish_if) if self.path else (fn(), False)
+            future.set_result(result)
+            return result, shared
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def _do_shared(self, key, fn, publish_if):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                claimed, result = self._claim(key)
+            except sqlite3.Error as e:
+                print(f"Error coordinating query across workers: {e}")
+                record_single_flight("leader")
+                return fn(), False
+
+            if result is not None:
+                record_single_flight("follower_shared")
+                return result, True
+            if claimed:
+                record_single_flight("leader")
+                return self._run_and_publish(key, fn, publish_if), False
+            if time.monotonic() >= deadline:
+                # Give up on the other worker and do the work here
+                record_single_flight("leader")
+                return fn(), False
+            time.sleep(self.poll_interval)
+
+    def _claim(self, key):
+        """Try to take the key. Returns (claimed, published result or None)."""
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT result FROM results WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+            if row is not None:
+                conn.execute("COMMIT")
+                return False, json.loads(row[0])
+            conn.execute("DELETE FROM inflight WHERE key = ? AND expires_at <= ?", (key, now))
+            cursor = conn.execute("INSERT OR IGNORE INTO inflight (key, owner, expires_at) VALUES (?, ?, ?)", (key, self.owner, now + self.timeout))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return cursor.rowcount == 1, None
+
+    def _run_and_publish(self, key, fn, publish_if):
+        published = False
+        try:
+            result = fn()
+            if publish_if is not None and not publish_if(result):
+                return result
+            try:
+                self._publish(key, json.dumps(result, default=str))
+                published = True
+            except (sqlite3.Error, TypeError, ValueError) as e:
+                print(f"Error publishing coalesced query result: {e}")
+            return result
+        finally:
+            if not published:
+                self._release(key)
+
+    def _publish(self, key, result_json):
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM results WHERE expires_at <= ?", (now,))
+            conn.execute("INSERT OR REPLACE INTO results (key, result, expires_at) VALUES (?, ?, ?)", (key, result_json, now + self.result_ttl))
+            conn.execute("DELETE FROM inflight WHERE key = ? AND owner = ?", (key, self.owner))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _release(self, key):
+        try:
+            self._connection().execute("DELETE FROM inflight WHERE key = ? AND owner = ?", (key, self.owner))
+        except sqlite3.Error as e:
+            print(f"Error releasing coalesced query: {e}")
+
+
+single_flight = SingleFlight()
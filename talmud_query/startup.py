@@ -0,0 +1,28 @@
+import importlib
+import time
+
+# Modules the request path imports lazily. Preloading them in the gunicorn master (GUNICORN_PRELOAD=true)
+# moves their import cost out of the workers, and forked workers share the loaded pages copy-on-write.
+PRELOAD_MODULES = [
+    "openai",
+    "langsmith",
+    "langsmith.run_helpers",
+    "langsmith.wrappers",
+    "langchain.embeddings.openai",
+    "tiktoken",
+    "talmud_query.talmud_query",
+]
+
+
+def preload_modules(modules=PRELOAD_MODULES):
+    """Import the given modules and return {module: seconds} for each."""
+    timings = {}
+    for module in modules:
+        started = time.perf_counter()
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            print(f"Error preloading {module}: {e}")
+            continue
+        timings[module] = time.perf_counter() - started
+    return timings
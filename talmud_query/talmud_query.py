@@ -1,25 +1,66 @@
-import openai
 import json as JSON
 import asyncio
-import httpx
+import time
+import weakref
+import jiter
 from pydantic import BaseModel, create_model
 from typing import Union, Optional
-from langsmith.wrappers import wrap_openai
-from langsmith.run_helpers import get_current_run_tree
-from langsmith import traceable, Client
 from talmud_query.prompts import (
     SYSTEM_PROMPT_FILTER_QUERY,
     USER_PROMPT_FILTER_QUERY,
     SYSTEM_PROMPT_GET_QUERIES,
     USER_PROMPT_GET_QUERIES,
-    SYSTEM_PROMPT_FILTER_CONTEXT,
-    USER_PROMPT_FILTER_CONTEXT,
+    SYSTEM_PROMPT_FILTER_CONTEXT_BATCH,
+    USER_PROMPT_FILTER_CONTEXT_BATCH,
     SYSTEM_PROMPT_FINAL_ANSWER,
     USER_PROMPT_FINAL_ANSWER,
 )
-from talmud_query.config import OPENAI_API_KEY, PRINT_OUTPUT, POSSIBLE_BOOKS
-from talmud_query.pinecone_utils import get_context_from_pinecone_vdb, get_context_async, get_context_from_pinecone_vdb_v2
-from talmud_query.embed_utils import embed_text_openai_batch
+from talmud_query.config import (
+    PRINT_OUTPUT,
+    POSSIBLE_BOOKS,
+    FILTER_BATCH_SIZE,
+    FILTER_CONCURRENCY,
+    FILTER_MAX_RETRIES,
+    FILTER_RETRY_BACKOFF,
+    FILTER_VERDICT_CACHE_MAX_ITEMS,
+    FILTER_VERDICT_CACHE_TTL,
+    RERANK_ENABLED,
+    REFERENCE_FAST_PATH_ENABLED,
+    REFERENCE_MAX_PASSAGES,
+    FULLTEXT_ENABLED,
+    HYBRID_VECTOR_K,
+    HYBRID_RERANK_TOP_N,
+    RERANK_TOP_N,
+    SPECULATIVE_RETRIEVAL_ENABLED,
+    EXPANSION_CACHE_MAX_ITEMS,
+    EXPANSION_CACHE_TTL,
+    QUERY_DEADLINE_SECONDS,
+    EXPANSION_TIMEOUT,
+    RETRIEVAL_TIMEOUT,
+    FILTER_TIMEOUT,
+    FINAL_ANSWER_RESERVE,
+    FILTER_MIN_SECONDS,
+    FINAL_ANSWER_MIN_SECONDS,
+    DEGRADED_CONTEXT_PASSAGES,
+    BATCH_CONCURRENCY,
+    BATCH_EMBED_SIZE,
+    BATCH_LOOKUP_CONCURRENCY,
+)
+from talmud_query.pinecone_utils import get_context_from_pinecone_vdb, get_context_async, get_context_from_pinecone_vdb_v2, get_ranked_lists_from_vdb_async, get_ranked_lists_for_lookups_async, dedupe_passages
+from talmud_query.rerank import rerank_passages
+from talmud_query.references import parse_references, parse_book_names, reference_filter
+from talmud_query.db_utils import get_passages_by_reference
+from talmud_query.fulltext import search_passages_fulltext
+from talmud_query.local_index import filter_values
+from talmud_query.context_packer import pack_context
+from talmud_query.embed_utils import embed_text_openai_batch, embed_text_openai_batch_async
+from talmud_query.transport import get_openai_client, get_async_openai_client, run_async
+from talmud_query.rate_limit import call_openai, call_openai_async, PRIORITY_FINAL_ANSWER, PRIORITY_EXPANSION, PRIORITY_FILTER
+from talmud_query.answer_cache import normalize_query
+from talmud_query.deadline import request_deadline, stage_timeout, remaining, run_within, degrade, get_degradations
+from talmud_query.lru import LRUCache
+from talmud_query.tracing import traceable, get_current_run_tree
+from talmud_query.metrics import timed, record_error, record_openai_usage, record_reference_fast_path
 
 # load env variables
 from dotenv import load_dotenv
@@ -27,6 +68,51 @@ import os
 
 load_dotenv()
 
+NO_RELEVANT_PASSAGES_ANSWER = "No relevant passages were found. Please note that there is a lot of randomness in the responses, so you may want to try again. You can also try again with different wording."
+PASSAGES_ONLY_ANSWER = "There wasn't time to write an answer to this question, but these passages look relevant to it. Please try again for a full answer."
+
+# Query expansions keyed on (normalized query, model, metadata fields, number of queries)
+expansion_cache = LRUCache(EXPANSION_CACHE_MAX_ITEMS, ttl=EXPANSION_CACHE_TTL, name="expansions")
+
+def expansion_cache_key(query, model_name, available_md, num_queries):
+    return (normalize_query(query), model_name, tuple(available_md), num_queries)
+
+class AnswerStreamInterrupted(Exception):
+    """The final answer stream failed after part of the answer had been streamed to the client."""
+
+class FinalAnswer(BaseModel):
+    answer: str
+    relevant_passage_ids: list[int]
+
+def build_query_response_model(available_md):
+    filter_fields = {field: (Optional[str], None) for field in available_md}
+    Filter = create_model('Filter', **filter_fields)
+    return create_model(
+        'QueryResponse',
+        query_1=(str, ...),
+        query_2=(str, ...),
+        query_3=(str, ...),
+        query_4=(str, ...),
+        query_5=(str, ...),
+        filter=(Optional[Filter], None)
+    )
+
+def build_get_queries_messages(query, available_md, num_queries):
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT_GET_QUERIES},
+        {"role": "user", "content": USER_PROMPT_GET_QUERIES.format(
+            num_queries=num_queries, available_md=", ".join(available_md), query=query, book_names=", ".join(POSSIBLE_BOOKS))}
+    ]
+
+def build_final_answer_messages(query, context, model_name, print_output=PRINT_OUTPUT):
+    packed_context, included_ids = pack_context(context, model_name)
+    if print_output and len(included_ids) < len(context):
+        print(f"Context budget kept {len(included_ids)} of {len(context)} passages")
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT_FINAL_ANSWER},
+        {"role": "user", "content": USER_PROMPT_FINAL_ANSWER.format(query=query, context=packed_context)}
+    ]
+
 @traceable
 def filter_query(query, model_name="gpt-4o", print_output=PRINT_OUTPUT, openai_client=None):
     try:
@@ -48,86 +134,180 @@ def filter_query(query, model_name="gpt-4o", print_output=PRINT_OUTPUT, openai_c
         return ""
 
 @traceable
+@timed("get_queries_from_openai")
 def get_queries_from_openai(query, model_name="gpt-4o", available_md=[], print_output=PRINT_OUTPUT, num_queries=5, openai_client=None):
-    filter_fields = {field: (Optional[str], None) for field in available_md}
-    Filter = create_model('Filter', **filter_fields)  
-    QueryResponse = create_model(
-        'QueryResponse',
-        query_1=(str, ...),
-        query_2=(str, ...),
-        query_3=(str, ...),
-        query_4=(str, ...),
-        query_5=(str, ...),
-        filter=(Optional[Filter], None)
-    )
+    cache_key = expansion_cache_key(query, model_name, available_md, num_queries)
+    cached = expansion_cache.get(cache_key)
+    if cached:
+        return dict(cached)
+    QueryResponse = build_query_response_model(available_md)
 
     try:
-        response = openai_client.beta.chat.completions.parse(
+        messages = build_get_queries_messages(query, available_md, num_queries)
+        response = call_openai(model_name, PRIORITY_EXPANSION, messages, lambda: openai_client.beta.chat.completions.parse(
             model=model_name,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT_GET_QUERIES},
-                {"role": "user", "content": USER_PROMPT_GET_QUERIES.format(
-                    num_queries=num_queries, available_md=", ".join(available_md), query=query, book_names=", ".join(POSSIBLE_BOOKS))}
-            ],
+            messages=messages,
             response_format=QueryResponse,
-        )
+        ))
+        record_openai_usage(model_name, "get_queries_from_openai", response.usage)
         response_text = response.choices[0].message.parsed.model_dump()
 
         if print_output:
             print("raw text from get queries: ", response_text)
 
-        return response_text
+        expansion_cache.set(cache_key, response_text)
+        return dict(response_text)
+    except Exception as e:
+        print(f"Error retrieving queries from OpenAI: {e}")
+        record_error("get_queries_from_openai")
+        return ""
+
+@traceable
+@timed("get_queries_from_openai")
+async def get_queries_from_openai_async(query, model_name="gpt-4o", available_md=[], print_output=PRINT_OUTPUT, num_queries=5, openai_client=None):
+    cache_key = expansion_cache_key(query, model_name, available_md, num_queries)
+    cached = expansion_cache.get(cache_key)
+    if cached:
+        return dict(cached)
+    QueryResponse = build_query_response_model(available_md)
+
+    try:
+        messages = build_get_queries_messages(query, available_md, num_queries)
+        response = await call_openai_async(model_name, PRIORITY_EXPANSION, messages, lambda: openai_client.beta.chat.completions.parse(
+            model=model_name,
+            messages=messages,
+            response_format=QueryResponse,
+        ))
+        record_openai_usage(model_name, "get_queries_from_openai", response.usage)
+        response_text = response.choices[0].message.parsed.model_dump()
+
+        if print_output:
+            print("raw text from get queries: ", response_text)
+
+        expansion_cache.set(cache_key, response_text)
+        return dict(response_text)
     except Exception as e:
         print(f"Error retrieving queries from OpenAI: {e}")
+        record_error("get_queries_from_openai")
         return ""
 
+class FilterVerdict(BaseModel):
+    passage_id: int
+    relevant: bool
+
+class FilterVerdicts(BaseModel):
+    verdicts: list[FilterVerdict]
+
+# Relevance verdicts keyed on (model, normalized query, passage_id) so repeat questions skip grading
+filter_verdict_cache = LRUCache(FILTER_VERDICT_CACHE_MAX_ITEMS, ttl=FILTER_VERDICT_CACHE_TTL, name="filter_verdicts")
+_filter_semaphores = weakref.WeakKeyDictionary()
+
+def get_filter_semaphore():
+    # Shared by every request on the loop so the total number of in-flight grading calls stays bounded
+    loop = asyncio.get_running_loop()
+    semaphore = _filter_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(FILTER_CONCURRENCY)
+        _filter_semaphores[loop] = semaphore
+    return semaphore
+
+def build_filter_batch_messages(query, passages, text_field):
+    context_text = "\n\n".join(
+        f"Passage id: {passage['passage_id']}\nBook: {passage['book_name']}, Page: {passage['page_number']}\n{passage[text_field]}"
+        for passage in passages
+    )
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT_FILTER_CONTEXT_BATCH},
+        {"role": "user", "content": USER_PROMPT_FILTER_CONTEXT_BATCH.format(query=query, context_text=context_text)}
+    ]
+
+async def grade_passage_batch(query, passages, model_name, text_field, openai_client):
+    """Return {passage_id: relevant} for one batch, retrying with backoff. Raises once retries run out."""
+    messages = build_filter_batch_messages(query, passages, text_field)
+
+    async def grade():
+        return await openai_client.beta.chat.completions.parse(
+            model=model_name,
+            messages=messages,
+            response_format=FilterVerdicts,
+        )
+
+    # Wait for a filter slot before reserving rate-limit tokens, so queued batches don't hold tokens they can't use yet
+    async with get_filter_semaphore():
+        response = await call_openai_async(model_name, PRIORITY_FILTER, messages, grade, max_retries=FILTER_MAX_RETRIES, backoff=FILTER_RETRY_BACKOFF)
+    record_openai_usage(model_name, "filter_context", response.usage)
+    verdicts = response.choices[0].message.parsed.verdicts
+    return {verdict.passage_id: verdict.relevant for verdict in verdicts}
+
 @traceable
-async def async_filter_context(query, context, model_name="gpt-4o-mini", text_field='english_text'):
-    async def filter_single_context(client, query, passage):
-        try:
-            context_text = f"Book: {passage['book_name']}, Page: {passage['page_number']}\n{passage[text_field]}"
-            response = await client.post(
-                url="https://api.openai.com/v1/chat/completions",
-                json={
-                    "model": model_name,
-                    "messages": [
-                        {"role": "system", "content": SYSTEM_PROMPT_FILTER_CONTEXT},
-                        {"role": "user", "content": USER_PROMPT_FILTER_CONTEXT.format(query=query, context_text=context_text)}
-                    ]
-                },
-                headers={"Authorization": f"Bearer {OPENAI_API_KEY}"}
-            )
-            raw_text = response.json()["choices"][0]["message"]["content"]
-            return passage if raw_text.strip() == "YES" else None
-        except Exception as e:
-            print(f"Error filtering passage: {e}")
-            return passage
-
-    async with httpx.AsyncClient() as client:
-        tasks = [filter_single_context(client, query, passage) for passage in context]
-        filtered_passages = await asyncio.gather(*tasks)
-
-    return [passage for passage in filtered_passages if passage is not None]
+@timed("filter_context")
+async def async_filter_context(query, context, model_name="gpt-4o-mini", text_field='english_text', openai_client=None, batch_size=None):
+    openai_client = openai_client or get_async_openai_client()
+    batch_size = batch_size or FILTER_BATCH_SIZE
+    normalized_query = normalize_query(query)
+
+    verdicts = {
+        passage_id: relevant
+        for (_, _, passage_id), relevant in filter_verdict_cache.get_many([(model_name, normalized_query, passage['passage_id']) for passage in context]).items()
+    }
+    pending = [passage for passage in context if passage['passage_id'] not in verdicts]
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+
+    results = await asyncio.gather(
+        *[grade_passage_batch(query, batch, model_name, text_field, openai_client) for batch in batches],
+        return_exceptions=True
+    )
+
+    for batch, result in zip(batches, results):
+        if isinstance(result, Exception):
+            # Keep the passages rather than lose them, but don't remember an unverified verdict
+            print(f"Error filtering passages {[passage['passage_id'] for passage in batch]}: {result}")
+            record_error("filter_context")
+            continue
+        graded = {passage['passage_id']: result[passage['passage_id']] for passage in batch if passage['passage_id'] in result}
+        filter_verdict_cache.set_many({(model_name, normalized_query, passage_id): relevant for passage_id, relevant in graded.items()})
+        verdicts.update(graded)
+
+    # Passages without a verdict (failed batch or skipped by the model) are kept
+    return [passage for passage in context if verdicts.get(passage['passage_id'], True)]
 
 @traceable
 def filter_context(query, context, model_name="gpt-4o-mini", text_field="english_text"):
-    return asyncio.run(async_filter_context(query, context, model_name, text_field))
+    return run_async(async_filter_context(query, context, model_name, text_field))
 
 @traceable
+@timed("get_final_answer")
 def get_final_answer(query, context, model_name="gpt-4o-2024-08-06", print_output=PRINT_OUTPUT, run_id="", openai_client=None):
     try:
-        class FinalAnswer(BaseModel):
-            answer: str
-            relevant_passage_ids: list[int]
+        messages = build_final_answer_messages(query, context, model_name, print_output)
+        response = call_openai(model_name, PRIORITY_FINAL_ANSWER, messages, lambda: openai_client.beta.chat.completions.parse(
+            model=model_name,
+            messages=messages,
+            response_format=FinalAnswer,
+        ))
+        record_openai_usage(model_name, "get_final_answer", response.usage)
+        final_answer = response.choices[0].message.parsed.model_dump()
+
+        if print_output:
+            print("Final answer: ", final_answer)
+
+        return final_answer
+    except Exception as e:
+        print(f"Error retrieving final answer: {e}")
+        record_error("get_final_answer")
+        return ""
 
-        response = openai_client.beta.chat.completions.parse(
+@traceable
+@timed("get_final_answer")
+async def get_final_answer_async(query, context, model_name="gpt-4o-2024-08-06", print_output=PRINT_OUTPUT, openai_client=None):
+    try:
+        messages = build_final_answer_messages(query, context, model_name, print_output)
+        response = await call_openai_async(model_name, PRIORITY_FINAL_ANSWER, messages, lambda: openai_client.beta.chat.completions.parse(
             model=model_name,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT_FINAL_ANSWER},
-                {"role": "user", "content": USER_PROMPT_FINAL_ANSWER.format(query=query, context_json=JSON.dumps(context, indent=4))}
-            ],
+            messages=messages,
             response_format=FinalAnswer,
-        )
+        ))
+        record_openai_usage(model_name, "get_final_answer", response.usage)
         final_answer = response.choices[0].message.parsed.model_dump()
 
         if print_output:
@@ -136,9 +316,119 @@ def get_final_answer(query, context, model_name="gpt-4o-2024-08-06", print_outpu
         return final_answer
     except Exception as e:
         print(f"Error retrieving final answer: {e}")
+        record_error("get_final_answer")
         return ""
 
 @traceable
+@timed("get_final_answer")
+async def stream_final_answer_async(query, context, model_name="gpt-4o-2024-08-06", print_output=PRINT_OUTPUT, openai_client=None, on_delta=None):
+    """Like get_final_answer_async, but calls on_delta(text) with each new piece of the answer as it is generated.
+
+    Raises AnswerStreamInterrupted if the stream fails after part of the answer was sent."""
+    try:
+        messages = build_final_answer_messages(query, context, model_name, print_output)
+        emitted = 0
+
+        async def stream_answer():
+            nonlocal emitted
+            try:
+                async with openai_client.beta.chat.completions.stream(
+                    model=model_name,
+                    messages=messages,
+                    response_format=FinalAnswer,
+                ) as stream:
+                    async for event in stream:
+                        if event.type != "content.delta":
+                            continue
+                        # Parse the partial FinalAnswer JSON, keeping the unfinished answer string
+                        partial = jiter.from_json(event.snapshot.encode(), partial_mode="trailing-strings")
+                        if isinstance(partial, dict):
+                            answer = partial.get("answer") or ""
+                            if len(answer) > emitted:
+                                on_delta(answer[emitted:])
+                                emitted = len(answer)
+                    return await stream.get_final_completion()
+            except Exception as e:
+                if emitted:
+                    # A retry would be a different completion, and its text would not continue what was sent
+                    raise AnswerStreamInterrupted(f"answer stream failed after {emitted} characters: {e}") from e
+                raise
+
+        # A rate-limited stream fails before any text arrives and is retried; once text has been sent it is not
+        completion = await call_openai_async(model_name, PRIORITY_FINAL_ANSWER, messages, stream_answer)
+        record_openai_usage(model_name, "get_final_answer", completion.usage)
+        final_answer = completion.choices[0].message.parsed.model_dump()
+
+        if print_output:
+            print("Final answer: ", final_answer)
+
+        return final_answer
+    except AnswerStreamInterrupted as e:
+        print(f"Error streaming final answer: {e}")
+        record_error("get_final_answer")
+        raise
+    except Exception as e:
+        print(f"Error retrieving final answer: {e}")
+        record_error("get_final_answer")
+        return ""
+
+@traceable
+def get_reference_context(query):
+    """Return (references, passages) when the query names pages that are in the database, else None.
+    Such queries skip query expansion and vector retrieval."""
+    if not REFERENCE_FAST_PATH_ENABLED:
+        return None
+    references = parse_references(query)
+    if not references:
+        return None
+    try:
+        context = get_passages_by_reference(references, limit=REFERENCE_MAX_PASSAGES)
+    except Exception as e:
+        print(f"Error loading referenced passages: {e}")
+        record_error("reference_fast_path")
+        return None
+    if not context:
+        record_reference_fast_path("no_passages")
+        return None
+    record_reference_fast_path("hit")
+    return references, context
+
+def passage_matches_filter(passage, filter):
+    for field in ("book_name", "page_number"):
+        values = filter_values(filter, field)
+        if values is not None and passage[field] not in values:
+            return False
+    return True
+
+def speculative_filter(query):
+    """The metadata filter for raw-query lookups that start before the expansion has chosen one: the tractates
+    the query names (which the expansion's filter nearly always picks too), or None."""
+    book_names = parse_book_names(query)
+    return {"book_name": {"$in": book_names}} if book_names else None
+
+async def get_raw_query_ranked_lists_async(query, index_name, namespaces, k, filter=None, query_embedding=None):
+    """Vector lookups for the user's own query, so they can start before the expansion returns. query_embedding,
+    if given, is an awaitable of the query's embedding already under way."""
+    try:
+        # Shielded so a pipeline cut short by its deadline doesn't cancel an embedding others are waiting on
+        embedded_query = await asyncio.shield(query_embedding) if query_embedding is not None else await embed_text_openai_batch_async([query])
+        return await get_ranked_lists_from_vdb_async(embedded_query, filter, index_name, namespaces, k)
+    except Exception as e:
+        print(f"Error in speculative retrieval: {e}")
+        record_error("speculative_retrieval")
+        return []
+
+async def get_lexical_context_async(query, filter):
+    """Full-text matches for the query, or [] if the search fails (the vector results still stand)."""
+    try:
+        return await asyncio.to_thread(search_passages_fulltext, query, filter=filter)
+    except Exception as e:
+        print(f"Error in full-text search: {e}")
+        record_error("fulltext_search")
+        return []
+
+@traceable
+@timed("talmud_query_v1")
 def talmud_query_v1(
     query, 
     model_name="gpt-4o-2024-08-06", 
@@ -150,10 +440,11 @@ def talmud_query_v1(
     index_name = "talmud-test-index-openai"
     namespace = "SWD-passages-openai"
     
-    openai.api_key = OPENAI_API_KEY
-    openai_client = wrap_openai(openai.OpenAI(api_key=OPENAI_API_KEY))
+    openai_client = get_openai_client()
     
+    # No run tree when LangSmith tracing is off; callers fall back to a generated run id
     run = get_current_run_tree()
+    run_id = run.id if run else None
 
     query_alts = get_queries_from_openai(query, model_name, available_md=available_md, print_output=print_output, num_queries=num_alt_queries, openai_client=openai_client)
     context = get_context_from_pinecone_vdb(query_alts, index_name, namespace, k, print_output=print_output)
@@ -161,15 +452,16 @@ def talmud_query_v1(
     
     if not filtered_context:
         return [{
-            "answer": "No relevant passages were found. Please note that there is a lot of randomness in the responses, so you may want to try again. You can also try again with different wording.",
+            "answer": NO_RELEVANT_PASSAGES_ANSWER,
             "relevant_passage_ids": []
-        }, run.id]
+        }, run_id]
     
     final_answer = get_final_answer(query, filtered_context, model_name, print_output=print_output, openai_client=openai_client)
 
-    return [final_answer, run.id]
+    return [final_answer, run_id]
 
 @traceable
+@timed("talmud_query_v2")
 def talmud_query_v2(
     query, 
     model_name="gpt-4o-2024-08-06", 
@@ -184,38 +476,331 @@ def talmud_query_v2(
         "SWD-passages-openai-bold"
     ]
     
-    openai.api_key = OPENAI_API_KEY
-    openai_client = wrap_openai(openai.OpenAI(api_key=OPENAI_API_KEY))
-
-    query_alts = get_queries_from_openai(query, model_name, available_md=available_md, print_output=print_output, num_queries=num_alt_queries, openai_client=openai_client)   
-    filter = query_alts.get("filter")
-   
-    # embedded_query_list = [embed_text_openai(query_alts[key]) for key in query_alts if key.startswith("query")]
-    embedded_query_list = embed_text_openai_batch([query_alts[key] for key in query_alts if key.startswith("query")])
-    
-    contexts_list = []
-    for namespace in namespaces:
-        contexts_list.append(get_context_from_pinecone_vdb_v2(embedded_query_list, filter, index_name, namespace, k, print_output))
-    
-    context = [item for sublist in contexts_list for item in sublist]
-    
-    # Remove duplicate passages by passage_id
-    seen_ids = set()
-    context = [passage for passage in context if not (passage['passage_id'] in seen_ids or seen_ids.add(passage['passage_id']))]
+    openai_client = get_openai_client()
+
+    reference = get_reference_context(query)
+    if reference:
+        context = reference[1]
+    else:
+        query_alts = get_queries_from_openai(query, model_name, available_md=available_md, print_output=print_output, num_queries=num_alt_queries, openai_client=openai_client)   
+        filter = query_alts.get("filter")
+       
+        # embedded_query_list = [embed_text_openai(query_alts[key]) for key in query_alts if key.startswith("query")]
+        embedded_query_list = embed_text_openai_batch([query_alts[key] for key in query_alts if key.startswith("query")])
+        
+        contexts_list = []
+        for namespace in namespaces:
+            contexts_list.append(get_context_from_pinecone_vdb_v2(embedded_query_list, filter, index_name, namespace, k, print_output))
+        
+        context = [item for sublist in contexts_list for item in sublist]
+        
+        # Remove duplicate passages by passage_id
+        context = dedupe_passages(context)
 
     print(f"Number of unique passages: {len(context)}")
     # Filter context asynchronously
     filtered_context = filter_context(query, context)
+    if reference and not filtered_context:
+        # The user asked for this page, so answer from all of it
+        filtered_context = context
     print(f"Number of filtered passages: {len(filtered_context)}")
 
+    # No run tree when LangSmith tracing is off; callers fall back to a generated run id
     run = get_current_run_tree()
+    run_id = run.id if run else None
     
     if not filtered_context:
         return [{
-            "answer": "No relevant passages were found. Please note that there is a lot of randomness in the responses, so you may want to try again. You can also try again with different wording.",
+            "answer": NO_RELEVANT_PASSAGES_ANSWER,
             "relevant_passage_ids": []
-        }, run.id]
+        }, run_id]
     
     final_answer = get_final_answer(query, filtered_context, model_name, print_output=print_output, openai_client=openai_client)
 
-    return [final_answer, run.id]
\ No newline at end of file
+    return [final_answer, run_id]
+
+@traceable
+@timed("talmud_query_v2")
+async def talmud_query_v2_async(
+    query,
+    model_name="gpt-4o-2024-08-06",
+    print_output=False,
+    available_md=["book_name", "page_number"],
+    k=40,
+    num_alt_queries=4,
+    on_event=None,
+    deadline_seconds=QUERY_DEADLINE_SECONDS,
+    query_embedding=None
+):
+    """on_event(event, data), if given, is called as each stage finishes and the final answer is streamed
+    through it as "answer_delta" events. query_embedding, if given, is a task embedding [query] that the caller
+    started (e.g. for an answer cache lookup), reused instead of embedding the query again.
+
+    The whole run has deadline_seconds. Each stage gets its own timeout, cut down so FINAL_ANSWER_RESERVE
+    is left for the answer; a stage that runs out of time is skipped or cut short and the answer lists it
+    under "degradations"."""
+    with request_deadline(deadline_seconds):
+        final_answer, run_id = await run_pipeline_v2_async(query, model_name, print_output, available_md, k, num_alt_queries, on_event, query_embedding)
+        # A failed final answer comes back as ""
+        if final_answer:
+            final_answer["degradations"] = get_degradations()
+        return [final_answer, run_id]
+
+@traceable
+def talmud_query_coalesced(query, leader_run_id, final_answer):
+    """Trace a caller answered by an identical in-flight run (see single_flight) so it has a run id of its
+    own for feedback. The run's metadata links it to the leader's run that produced the answer."""
+    run = get_current_run_tree()
+    if run is None:
+        return [final_answer, None]
+    if leader_run_id:
+        run.add_metadata({"leader_run_id": str(leader_run_id)})
+    return [final_answer, run.id]
+
+async def run_pipeline_v2_async(query, model_name, print_output, available_md, k, num_alt_queries, on_event, query_embedding=None):
+    index_name = "talmud-test-index-openai"
+    namespaces = [
+        "SWD-passages-openai",
+        "SWD-passages-openai-bold"
+    ]
+    emit = on_event or (lambda event, data: None)
+
+    openai_client = get_async_openai_client()
+
+    reference = await asyncio.to_thread(get_reference_context, query)
+    if reference:
+        references, context = reference
+        emit("queries_generated", {"queries": [], "filter": reference_filter(references)})
+        print(f"Number of referenced passages: {len(context)}")
+        emit("passages_retrieved", {"count": len(context)})
+    else:
+        # Precise full-text hits (see below) let the vector channel use a smaller k and fewer fused passages
+        # go on to filtering
+        vector_k, top_n = (min(k, HYBRID_VECTOR_K), HYBRID_RERANK_TOP_N) if FULLTEXT_ENABLED else (k, RERANK_TOP_N)
+
+        # Retrieval for the raw query runs while gpt-4o expands it, so its embedding and lookups are off the
+        # critical path; the alternate-query lookups still start once the expansion returns. The lookups use the
+        # tractates named in the query as their filter, since their results are filtered again by the expansion's
+        # choice. With the expansion already cached there is nothing to overlap, so they are skipped
+        expansion_known = expansion_cache_key(query, model_name, available_md, num_alt_queries) in expansion_cache
+        speculative_task = None
+        if SPECULATIVE_RETRIEVAL_ENABLED and not expansion_known:
+            speculative_task = asyncio.create_task(get_raw_query_ranked_lists_async(query, index_name, namespaces, vector_k, speculative_filter(query), query_embedding))
+
+        query_alts = await run_within(
+            get_queries_from_openai_async(query, model_name, available_md=available_md, print_output=print_output, num_queries=num_alt_queries, openai_client=openai_client),
+            stage_timeout(EXPANSION_TIMEOUT, reserve=FINAL_ANSWER_RESERVE), "expansion_skipped", fallback={}
+        ) or {}
+        filter = query_alts.get("filter")
+        alt_queries = [query_alts[key] for key in query_alts if key.startswith("query")]
+        # An expansion that timed out, failed or came back empty leaves the raw query to be looked up on its
+        # own (unless it already is being, speculatively)
+        if not alt_queries and not speculative_task:
+            alt_queries = [query]
+        emit("queries_generated", {"queries": alt_queries, "filter": filter})
+
+        # The full-text search runs alongside embedding and the vector lookups
+        lexical_task = asyncio.create_task(get_lexical_context_async(query, filter)) if FULLTEXT_ENABLED else None
+
+        async def alternate_ranked_lists():
+            embedded_query_list = await embed_text_openai_batch_async(alt_queries)
+            # Every (namespace x alternative query) lookup goes out at once, then straight into the async filter
+            return await get_ranked_lists_from_vdb_async(embedded_query_list, filter, index_name, namespaces, vector_k)
+
+        ranked_lists = []
+        if alt_queries:
+            ranked_lists = await run_within(alternate_ranked_lists(), stage_timeout(RETRIEVAL_TIMEOUT, reserve=FINAL_ANSWER_RESERVE), "alternate_retrieval_skipped", fallback=[])
+        if speculative_task:
+            # The raw-query lookups ran before the expansion's filter was known, so apply it to their results here
+            try:
+                speculative = await run_within(speculative_task, stage_timeout(RETRIEVAL_TIMEOUT, reserve=FINAL_ANSWER_RESERVE), "raw_retrieval_skipped", fallback=[])
+                ranked_lists = [[passage for passage in ranked if passage_matches_filter(passage, filter)] for ranked in speculative] + ranked_lists
+            except ValueError as e:
+                print(f"Dropping speculative results: {e}")
+        lexical = await run_within(lexical_task, stage_timeout(RETRIEVAL_TIMEOUT, reserve=FINAL_ANSWER_RESERVE), "fulltext_skipped", fallback=[]) if lexical_task else []
+        unique_passage_count = len({passage['passage_id'] for ranked in ranked_lists + [lexical] for passage in ranked})
+        print(f"Number of unique passages: {unique_passage_count} ({len(lexical)} full-text matches)")
+        emit("passages_retrieved", {"count": unique_passage_count})
+
+        # Fuse the per-lookup rankings (plus BM25 over the candidates and the full-text list) and only grade the top-N
+        if RERANK_ENABLED:
+            context = rerank_passages(query, ranked_lists, top_n=top_n, lexical=lexical)
+        else:
+            context = dedupe_passages([passage for ranked in ranked_lists + [lexical] for passage in ranked])
+        print(f"Number of reranked passages: {len(context)}")
+
+    # Short on time, the best fused passages go to the final answer ungraded
+    filter_timeout = stage_timeout(FILTER_TIMEOUT, reserve=FINAL_ANSWER_RESERVE)
+    if filter_timeout < FILTER_MIN_SECONDS:
+        degrade("filter_skipped")
+        filtered_context = context[:DEGRADED_CONTEXT_PASSAGES]
+    else:
+        filtered_context = await run_within(async_filter_context(query, context), filter_timeout, "filter_timed_out", fallback=context[:DEGRADED_CONTEXT_PASSAGES])
+    if reference and not filtered_context:
+        # The user asked for this page, so answer from all of it
+        filtered_context = context
+    print(f"Number of filtered passages: {len(filtered_context)}")
+    emit("passages_filtered", {"count": len(filtered_context), "passage_ids": [passage['passage_id'] for passage in filtered_context]})
+
+    # No run tree when LangSmith tracing is off; callers fall back to a generated run id
+    run = get_current_run_tree()
+    run_id = run.id if run else None
+
+    if not filtered_context:
+        return [{
+            "answer": NO_RELEVANT_PASSAGES_ANSWER,
+            "relevant_passage_ids": []
+        }, run_id]
+
+    passages_only = {
+        "answer": PASSAGES_ONLY_ANSWER,
+        "relevant_passage_ids": [passage['passage_id'] for passage in filtered_context[:DEGRADED_CONTEXT_PASSAGES]]
+    }
+    if remaining() < FINAL_ANSWER_MIN_SECONDS:
+        degrade("passages_only")
+        return [passages_only, run_id]
+
+    if on_event:
+        answer = stream_final_answer_async(query, filtered_context, model_name, print_output=print_output, openai_client=get_async_openai_client(traced=False),
+                                           on_delta=lambda text: emit("answer_delta", {"text": text}))
+    else:
+        answer = get_final_answer_async(query, filtered_context, model_name, print_output=print_output, openai_client=openai_client)
+    final_answer = await run_within(answer, remaining(), "final_answer_timed_out", fallback=passages_only)
+
+    return [final_answer, run_id]
+
+@traceable
+@timed("talmud_query_batch")
+async def talmud_query_batch_async(
+    queries,
+    model_name="gpt-4o-2024-08-06",
+    available_md=["book_name", "page_number"],
+    k=40,
+    num_alt_queries=4,
+    on_result=None
+):
+    """Answer many questions, sharing work between them: repeated questions run once, every alternative query
+    is embedded in a few large calls, identical (query, filter, namespace) lookups go out once, each passage
+    is loaded once, and filtering and final answers run BATCH_CONCURRENCY questions at a time.
+
+    Returns {"results": [{"query", "answer", "relevant_passage_ids"}] in the order of queries, "stats": {...}}.
+    on_result(index, result), if given, is called as each question is answered."""
+    index_name = "talmud-test-index-openai"
+    namespaces = [
+        "SWD-passages-openai",
+        "SWD-passages-openai-bold"
+    ]
+    openai_client = get_async_openai_client()
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    vector_k, top_n = (min(k, HYBRID_VECTOR_K), HYBRID_RERANK_TOP_N) if FULLTEXT_ENABLED else (k, RERANK_TOP_N)
+    started = time.perf_counter()
+    stage_seconds = {}
+
+    # Repeated questions (after normalization) are answered once
+    unique_queries, indexes = {}, {}
+    for index, query in enumerate(queries):
+        question = unique_queries.setdefault(normalize_query(query), query)
+        indexes.setdefault(question, []).append(index)
+    questions = list(indexes)
+
+    # Questions naming a page use it directly; the rest are expanded
+    references = dict(zip(questions, await asyncio.gather(*[asyncio.to_thread(get_reference_context, query) for query in questions])))
+
+    async def expand(query):
+        async with semaphore:
+            return await get_queries_from_openai_async(query, model_name, available_md=available_md, num_queries=num_alt_queries, openai_client=openai_client) or {}
+
+    to_expand = [query for query in questions if not references[query]]
+    expansions = dict(zip(to_expand, await asyncio.gather(*[expand(query) for query in to_expand])))
+    stage_seconds["expansion"] = time.perf_counter() - started
+
+    # Each question looks up its alternative queries (and itself, as speculative retrieval does) under its filter
+    lookup_texts = {}
+    for query, expansion in expansions.items():
+        alt_queries = [expansion[key] for key in expansion if key.startswith("query")]
+        lookup_texts[query] = list(dict.fromkeys(([query] if SPECULATIVE_RETRIEVAL_ENABLED or not alt_queries else []) + alt_queries))
+
+    stage_started = time.perf_counter()
+    texts = list(dict.fromkeys(text for query_texts in lookup_texts.values() for text in query_texts))
+    chunks = [texts[i:i + BATCH_EMBED_SIZE] for i in range(0, len(texts), BATCH_EMBED_SIZE)]
+    embeddings = dict(zip(texts, [embedding for chunk in await asyncio.gather(*[embed_text_openai_batch_async(chunk) for chunk in chunks]) for embedding in chunk]))
+    stage_seconds["embedding"] = time.perf_counter() - stage_started
+
+    stage_started = time.perf_counter()
+    lookup_keys = {
+        query: [(text, JSON.dumps(expansions[query].get("filter"), sort_keys=True), namespace) for namespace in namespaces for text in query_texts]
+        for query, query_texts in lookup_texts.items()
+    }
+    unique_lookups = list(dict.fromkeys(key for keys in lookup_keys.values() for key in keys))
+    ranked_lists = dict(zip(unique_lookups, await get_ranked_lists_for_lookups_async(
+        [(embeddings[text], JSON.loads(filter), namespace) for text, filter, namespace in unique_lookups], index_name, vector_k, concurrency=BATCH_LOOKUP_CONCURRENCY
+    )))
+
+    async def lexical_context(query):
+        async with semaphore:
+            return await get_lexical_context_async(query, expansions[query].get("filter"))
+
+    lexical = dict(zip(to_expand, await asyncio.gather(*[lexical_context(query) for query in to_expand]))) if FULLTEXT_ENABLED else {}
+    stage_seconds["retrieval"] = time.perf_counter() - stage_started
+    unique_passage_ids = {passage['passage_id'] for ranked in ranked_lists.values() for passage in ranked}
+
+    def question_context(query):
+        if references[query]:
+            return references[query][1]
+        query_ranked_lists = [ranked_lists[key] for key in lookup_keys[query]]
+        query_lexical = lexical.get(query, [])
+        if RERANK_ENABLED:
+            return rerank_passages(query, query_ranked_lists, top_n=top_n, lexical=query_lexical)
+        return dedupe_passages([passage for ranked in query_ranked_lists + [query_lexical] for passage in ranked])
+
+    async def answer(query):
+        async with semaphore:
+            try:
+                context = question_context(query)
+                filtered_context = await async_filter_context(query, context)
+                if references[query] and not filtered_context:
+                    # The user asked for this page, so answer from all of it
+                    filtered_context = context
+                if not filtered_context:
+                    final_answer = {"answer": NO_RELEVANT_PASSAGES_ANSWER, "relevant_passage_ids": []}
+                else:
+                    final_answer = await get_final_answer_async(query, filtered_context, model_name, openai_client=openai_client)
+            except Exception as e:
+                print(f"Error answering batch question {query!r}: {e}")
+                record_error("talmud_query_batch")
+                final_answer = None
+        result = {
+            "answer": final_answer["answer"] if final_answer else None,
+            "relevant_passage_ids": final_answer["relevant_passage_ids"] if final_answer else None
+        }
+        if on_result:
+            for index in indexes[query]:
+                on_result(index, {"query": queries[index], **result})
+        return result
+
+    stage_started = time.perf_counter()
+    answers = dict(zip(questions, await asyncio.gather(*[answer(query) for query in questions])))
+    stage_seconds["answering"] = time.perf_counter() - stage_started
+
+    total_seconds = time.perf_counter() - started
+    return {
+        "results": [{"query": query, **answers[unique_queries[normalize_query(query)]]} for query in queries],
+        "stats": {
+            "questions": len(queries),
+            "unique_questions": len(questions),
+            "reference_questions": len(questions) - len(to_expand),
+            "answered": sum(1 for result in answers.values() if result["answer"]),
+            "embedded_texts": len(texts),
+            "embedding_batches": len(chunks),
+            "vector_lookups": len(unique_lookups),
+            "vector_lookups_saved": sum(len(keys) for keys in lookup_keys.values()) - len(unique_lookups),
+            "unique_passages": len(unique_passage_ids),
+            "stage_seconds": stage_seconds,
+            "total_seconds": total_seconds,
+            "questions_per_minute": len(queries) * 60 / total_seconds if total_seconds else None
+        }
+    }
+
+def talmud_query_batch(queries, **kwargs):
+    """Blocking talmud_query_batch_async, for scripts and the Flask views."""
+    return run_async(talmud_query_batch_async(queries, **kwargs))
@@ -0,0 +1,33 @@
+import functools
+import inspect
+
+# LangSmith helpers that import langsmith on first use instead of at startup: importing
+# langsmith.run_helpers (which `from langsmith import traceable` does) costs about half a second.
+
+
+def traceable(func):
+    """Like langsmith.traceable, but the LangSmith wrapper is built the first time func is called."""
+    traced = None
+
+    def get_traced():
+        nonlocal traced
+        if traced is None:
+            from langsmith import traceable as langsmith_traceable
+            traced = langsmith_traceable(func)
+        return traced
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            return await get_traced()(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return get_traced()(*args, **kwargs)
+    return wrapper
+
+
+def get_current_run_tree():
+    from langsmith.run_helpers import get_current_run_tree as langsmith_get_current_run_tree
+    return langsmith_get_current_run_tree()
@@ -0,0 +1,213 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import threading
+import weakref
+import httpx
+from talmud_query.config import (
+    OPENAI_API_KEY,
+    OPENAI_BASE_URL,
+    RATE_LIMIT_ENABLED,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_KEEPALIVE_EXPIRY,
+    HTTP_TIMEOUT,
+    HTTP2_ENABLED,
+)
+
+# One process-wide transport layer: long-lived httpx clients (keep-alive, optional HTTP/2)
+# shared by every Pinecone and OpenAI call, plus one background event loop that all
+# async pipeline code runs on so the async clients (and their connections) outlive a request.
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# openai, langsmith and its OpenAI wrapper are imported inside the functions that need them, which keeps
+# them off the startup path (together they take most of a second to import).
+
+
+def retryable_openai_errors():
+    """OpenAI errors worth retrying with backoff."""
+    import openai
+    return (
+        openai.RateLimitError,
+        openai.APIConnectionError,
+        openai.APITimeoutError,
+        openai.InternalServerError,
+    )
+
+_lock = threading.RLock()
+_sync_client = None
+_openai_client = None
+_langsmith_client = None
+_async_clients = weakref.WeakKeyDictionary()
+_async_openai_clients = weakref.WeakKeyDictionary()
+_loop = None
+_loop_thread = None
+
+
+def _client_kwargs():
+    return {
+        "http2": HTTP2_ENABLED and HTTP2_AVAILABLE,
+        "limits": httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(HTTP_TIMEOUT),
+    }
+
+
+def get_http_client():
+    global _sync_client
+    if _sync_client is None:
+        with _lock:
+            if _sync_client is None:
+                _sync_client = httpx.Client(**_client_kwargs())
+    return _sync_client
+
+
+def get_async_http_client():
+    # Async connections are bound to the loop that opened them, so keep one client per loop.
+    # In practice that is the shared background loop, giving a single long-lived client.
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(**_client_kwargs())
+        _async_clients[loop] = client
+    return client
+
+
+def _openai_kwargs():
+    # With the rate limiter on, 429s must reach it (to pause every worker and requeue), so the SDK doesn't retry
+    return {"api_key": OPENAI_API_KEY, "base_url": OPENAI_BASE_URL, "max_retries": 0 if RATE_LIMIT_ENABLED else 2}
+
+
+def get_openai_client():
+    global _openai_client
+    if _openai_client is None:
+        import openai
+        from langsmith.wrappers import wrap_openai
+        with _lock:
+            if _openai_client is None:
+                _openai_client = wrap_openai(openai.OpenAI(**_openai_kwargs(), http_client=get_http_client()))
+    return _openai_client
+
+
+def get_langsmith_client():
+    global _langsmith_client
+    if _langsmith_client is None:
+        with _lock:
+            if _langsmith_client is None:
+                from langsmith import Client
+                _langsmith_client = Client()
+    return _langsmith_client
+
+
+def get_async_openai_client(traced=True):
+    # The LangSmith wrapper breaks beta.chat.completions.stream, so streaming callers ask for traced=False
+    clients = _async_openai_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(traced)
+    if client is None:
+        import openai
+        from langsmith.wrappers import wrap_openai
+        client = openai.AsyncOpenAI(**_openai_kwargs(), http_client=get_async_http_client())
+        if traced:
+            client = wrap_openai(client)
+        clients[traced] = client
+    return client
+
+
+def get_event_loop():
+    global _loop, _loop_thread
+    if _loop is None:
+        with _lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="talmud-query-loop", daemon=True)
+                thread.start()
+                _loop, _loop_thread = loop, thread
+    return _loop
+
+
+def submit_async(coro):
+    """Schedule a coroutine on the shared event loop and return a concurrent.futures.Future for its result.
+
+    The caller's context variables (e.g. the LangSmith parent run) are carried over to the task.
+    """
+    loop = get_event_loop()
+    ctx = contextvars.copy_context()
+    future = concurrent.futures.Future()
+
+    def _on_done(task):
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def _schedule():
+        if not future.set_running_or_notify_cancel():
+            coro.close()
+            return
+        task = ctx.run(loop.create_task, coro)
+        task.add_done_callback(_on_done)
+
+    loop.call_soon_threadsafe(_schedule)
+    return future
+
+
+def run_async(coro):
+    """Run a coroutine on the shared event loop and block until it finishes."""
+    if threading.current_thread() is _loop_thread:
+        raise RuntimeError("run_async() cannot be called from the shared event loop; await the coroutine instead")
+    return submit_async(coro).result()
+
+
+def retry_after_seconds(error):
+    """Seconds from the Retry-After header of a failed response, if the server sent one."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+async def _warm_up_async_clients():
+    get_async_openai_client()
+    get_async_openai_client(traced=False)
+
+
+def warm_up():
+    """Create the process-wide clients and the shared event loop up front (call once per worker, after
+    any fork) so the first requests don't pay for it."""
+    try:
+        get_openai_client()
+        run_async(_warm_up_async_clients())
+    except Exception as e:
+        # Not fatal: the clients are created on first use instead
+        print(f"Error warming up clients: {e}")
+
+
+def _reset_after_fork():
+    # Threads don't survive fork and sockets must not be shared with the parent,
+    # so a forked worker starts with no clients and no loop and creates its own on first use
+    global _lock, _sync_client, _openai_client, _langsmith_client, _async_clients, _async_openai_clients, _loop, _loop_thread
+    _lock = threading.RLock()
+    _sync_client = None
+    _openai_client = None
+    _langsmith_client = None
+    _async_clients = weakref.WeakKeyDictionary()
+    _async_openai_clients = weakref.WeakKeyDictionary()
+    _loop = None
+    _loop_thread = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,25 @@
+import os
+import sys
+import tempfile
+
+# Keep the tests off the network and out of the repo's cache/ directory. Config is read at import time,
+# so this has to happen before any talmud_query module is imported.
+_cache_dir = tempfile.mkdtemp(prefix="talmud_query_tests_")
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+os.environ.setdefault("PINECONE_API_KEY", "pc-test")
+os.environ.setdefault("API_KEY", "test-key")
+os.environ.setdefault("LANGCHAIN_TRACING_V2", "false")
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+os.environ.setdefault("RATE_LIMIT_BACKOFF", "0.01")
+for name, file_name in (
+    ("EMBED_CACHE_PATH", "embeddings.sqlite3"),
+    ("ANSWER_CACHE_PATH", "answers.sqlite3"),
+    ("SINGLE_FLIGHT_PATH", "single_flight.sqlite3"),
+    ("JOB_DB_PATH", "jobs.sqlite3"),
+    ("FEEDBACK_SPOOL_PATH", "feedback.sqlite3"),
+    ("RATE_LIMIT_PATH", "rate_limit.sqlite3"),
+):
+    os.environ.setdefault(name, os.path.join(_cache_dir, file_name))
+os.environ.setdefault("PROFILE_DIR", os.path.join(_cache_dir, "profiles"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,127 @@
+import asyncio
+import sqlite3
+import numpy as np
+from talmud_query.answer_cache import AnswerCache
+
+
+def make_caches(tmp_path, **kwargs):
+    # Two instances on one file stand in for two gunicorn workers
+    path = str(tmp_path / "answers.sqlite3")
+    return AnswerCache(path=path, **kwargs), AnswerCache(path=path, **kwargs)
+
+
+def test_answers_are_shared_between_processes(tmp_path):
+    first, second = make_caches(tmp_path, flush_interval=0)
+    embedding = np.random.default_rng(0).random(16)
+    first.set("Why is the Shema said at night?", {"answer": "Because", "relevant_passage_ids": [1]}, embedding=embedding)
+
+    assert second.get_exact("why is the shema said at night") == {"answer": "Because", "relevant_passage_ids": [1]}
+    assert second.get_similar(embedding) == {"answer": "Because", "relevant_passage_ids": [1]}
+    assert first.stats()["exact_hits"] == 1
+    assert first.stats()["semantic_hits"] == 1
+
+
+def test_invalidation_reaches_every_process(tmp_path):
+    first, second = make_caches(tmp_path)
+    embedding = np.random.default_rng(1).random(16)
+    first.set("q", {"answer": "a", "relevant_passage_ids": [1]}, embedding=embedding)
+    assert first.get_similar(embedding) is not None
+
+    assert second.invalidate() == 1
+    assert first.get_exact("q") is None
+    assert first.get_similar(embedding) is None
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache, _ = make_caches(tmp_path, max_items=2)
+    for query in ("a", "b", "c"):
+        cache.set(query, {"answer": query, "relevant_passage_ids": [1]})
+
+    assert cache.get_exact("a") is None
+    assert cache.stats()["items"] == 2
+    assert cache.stats()["evictions"] == 1
+
+
+def test_hits_are_counted_without_writing_each_one(tmp_path):
+    cache, other = make_caches(tmp_path, flush_interval=60)
+    cache.set("Why is the Shema said at night?", {"answer": "Because", "relevant_passage_ids": [1]})
+    for _ in range(3):
+        cache.get_exact("why is the shema said at night")
+
+    assert other.stats()["exact_hits"] == 0
+    assert cache.stats()["exact_hits"] == 3
+    assert other.stats()["exact_hits"] == 3
+
+
+def test_unavailable_cache_degrades(tmp_path):
+    cache = AnswerCache(path=str(tmp_path / "missing" / "answers.sqlite3"))
+    cache._local.conn = sqlite3.connect(":memory:", isolation_level=None)  # no tables
+
+    assert cache.invalidate() is None
+    assert "error" in cache.stats()
+
+
+class FakePipeline:
+    """Stands in for talmud_query_v2_async, recording how it was called and whether it was cancelled."""
+
+    def __init__(self):
+        self.calls = []
+        self.cancelled = False
+
+    async def __call__(self, query, on_event=None, query_embedding=None):
+        self.calls.append((query, query_embedding))
+        if query_embedding is not None:
+            await query_embedding
+        try:
+            await asyncio.sleep(0.2)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        return [{"answer": f"Fresh answer to {query}", "relevant_passage_ids": [3]}, None]
+
+
+def use_cache(monkeypatch, cache, embedding):
+    import main
+    pipeline = FakePipeline()
+    embedded = []
+
+    async def embed(texts):
+        embedded.append(texts)
+        return [embedding for _ in texts]
+
+    monkeypatch.setattr(main, "answer_cache", cache)
+    monkeypatch.setattr(main, "ANSWER_CACHE_ENABLED", True)
+    monkeypatch.setattr(main, "SINGLE_FLIGHT_ENABLED", False)
+    monkeypatch.setattr(main, "embed_text_openai_batch_async", embed)
+    monkeypatch.setattr(main, "talmud_query_v2_async", pipeline)
+    return main, pipeline, embedded
+
+
+def test_page_references_never_match_semantically(tmp_path, monkeypatch):
+    cache, _ = make_caches(tmp_path)
+    embedding = np.random.default_rng(2).random(16)
+    # Both queries embed to the same vector, as near-identical references nearly do
+    main, pipeline, embedded = use_cache(monkeypatch, cache, embedding)
+    cache.set("Berakhot 2a", {"answer": "About 2a", "relevant_passage_ids": [1]}, embedding=embedding)
+    cache.set("why is the shema said at night", {"answer": "Because", "relevant_passage_ids": [2]}, embedding=embedding)
+
+    assert main.answer_query("Berakhot 2b")["answer"] == "Fresh answer to Berakhot 2b"
+    assert embedded == []
+    assert main.answer_query("Berakhot 2a")["answer"] == "About 2a"
+    assert main.answer_query("when is the evening shema said")["cached"]
+
+
+def test_similarity_lookup_runs_alongside_the_pipeline(tmp_path, monkeypatch):
+    cache, _ = make_caches(tmp_path)
+    embedding = np.random.default_rng(3).random(16)
+    main, pipeline, embedded = use_cache(monkeypatch, cache, embedding)
+
+    # A miss: the pipeline started at once and was handed the embedding, which went out only once
+    result = main.answer_query("when is the evening shema said")
+    assert result["answer"] == "Fresh answer to when is the evening shema said"
+    assert len(embedded) == 1 and pipeline.calls[0][1] is not None
+
+    # A hit: the pipeline that started alongside the lookup is cancelled
+    result = main.answer_query("at what time is the evening shema said")
+    assert result["cached"] and result["answer"] == "Fresh answer to when is the evening shema said"
+    assert pipeline.cancelled
@@ -0,0 +1,84 @@
+import psycopg2.pool
+import pytest
+from talmud_query import db
+
+
+class FakeCursor:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, sql):
+        pass
+
+
+class FakeConnection:
+    closed = False
+
+    def cursor(self):
+        return FakeCursor()
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool:
+    """Enough of ThreadedConnectionPool for get_connection/release_connection, without a database: minconn
+    connections are opened up front and kept idle, and any returned beyond that are closed."""
+
+    def __init__(self, minconn, maxconn, **kwargs):
+        self.closed = False
+        self.minconn = minconn
+        self.used = {}
+        self.idle = [FakeConnection() for _ in range(minconn)]
+
+    def getconn(self):
+        conn = self.idle.pop() if self.idle else FakeConnection()
+        self.used[id(conn)] = conn
+        return conn
+
+    def putconn(self, conn, close=False):
+        if self.closed:
+            raise psycopg2.pool.PoolError("connection pool is closed")
+        del self.used[id(conn)]
+        if close or len(self.idle) >= self.minconn:
+            conn.close()
+        else:
+            self.idle.append(conn)
+
+    def closeall(self):
+        for conn in [*self.used.values(), *self.idle]:
+            conn.close()
+        self.closed = True
+
+
+@pytest.fixture
+def fake_pool(monkeypatch):
+    monkeypatch.setattr(psycopg2.pool, "ThreadedConnectionPool", FakePool)
+    db._reset_after_fork()
+    yield
+    db._reset_after_fork()
+
+
+def test_release_after_pool_is_recreated(fake_pool):
+    conn = db.get_connection()
+    db.close_pool()
+    db.initialize_connection_pool()
+
+    db.release_connection(conn)
+
+    assert conn.closed
+    minimum = db.DB_POOL_MIN_CONNECTIONS
+    assert db.get_pool_stats() == {"open": minimum, "in_use": 0, "idle": minimum, "max": db.DB_POOL_MAX_CONNECTIONS}
+    # The slot taken by the old connection is free again
+    conns = [db.get_connection() for _ in range(db.DB_POOL_MAX_CONNECTIONS)]
+    assert db.get_pool_stats() == {"open": db.DB_POOL_MAX_CONNECTIONS, "in_use": db.DB_POOL_MAX_CONNECTIONS, "idle": 0, "max": db.DB_POOL_MAX_CONNECTIONS}
+    for conn in conns:
+        db.release_connection(conn)
+    # Only the pool's minimum is kept open
+    assert db.get_pool_stats() == {"open": minimum, "in_use": 0, "idle": minimum, "max": db.DB_POOL_MAX_CONNECTIONS}
@@ -0,0 +1,57 @@
+import asyncio
+from types import SimpleNamespace
+from talmud_query import talmud_query
+from talmud_query.talmud_query import async_filter_context, filter_verdict_cache, FilterVerdict, FilterVerdicts
+
+CONTEXT = [
+    {"passage_id": 1, "english_text": "The evening Shema", "book_name": "Berakhot", "page_number": "2a"},
+    {"passage_id": 2, "english_text": "The morning Shema", "book_name": "Berakhot", "page_number": "9b"},
+]
+
+
+class FakeCompletions:
+    """Grades passage 1 relevant and passage 2 not, counting calls per model."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def parse(self, model, messages, response_format):
+        self.calls.append(model)
+        verdicts = FilterVerdicts(verdicts=[FilterVerdict(passage_id=1, relevant=True), FilterVerdict(passage_id=2, relevant=False)])
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(parsed=verdicts))],
+            usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5, total_tokens=15),
+        )
+
+
+def fake_client():
+    return SimpleNamespace(beta=SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions())))
+
+
+def test_verdicts_are_cached_per_model():
+    filter_verdict_cache.clear()
+    client = fake_client()
+    completions = client.beta.chat.completions
+
+    kept = asyncio.run(async_filter_context("When is the Shema said", CONTEXT, model_name="model-a", openai_client=client))
+    assert [passage["passage_id"] for passage in kept] == [1]
+
+    asyncio.run(async_filter_context("When is the Shema said", CONTEXT, model_name="model-a", openai_client=client))
+    assert completions.calls == ["model-a"]
+
+    asyncio.run(async_filter_context("When is the Shema said", CONTEXT, model_name="model-b", openai_client=client))
+    assert completions.calls == ["model-a", "model-b"]
+
+
+def test_filter_slot_is_taken_before_rate_limiting(monkeypatch):
+    filter_verdict_cache.clear()
+    held = []
+    original = talmud_query.call_openai_async
+
+    async def call_openai_async(model, priority, messages, make_call, **kwargs):
+        held.append(talmud_query.get_filter_semaphore()._value < talmud_query.FILTER_CONCURRENCY)
+        return await original(model, priority, messages, make_call, **kwargs)
+
+    monkeypatch.setattr(talmud_query, "call_openai_async", call_openai_async)
+    asyncio.run(async_filter_context("When is the Shema said", CONTEXT, model_name="model-a", openai_client=fake_client()))
+    assert held == [True]
@@ -0,0 +1,57 @@
+import threading
+import time
+from talmud_query.jobs import JobQueue, JobWorkerPool, SUCCEEDED
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_lease_is_renewed_while_a_job_runs(tmp_path):
+    queue = JobQueue(path=str(tmp_path / "jobs.sqlite3"), lease_seconds=0.3)
+    release = threading.Event()
+    calls = []
+
+    def handler(query):
+        calls.append(query)
+        release.wait(5)
+        return {"answer": query}
+
+    pool = JobWorkerPool(queue, handler, workers=1, poll_interval=0.01).start()
+    job_id = queue.enqueue("When is the Shema said?")
+    wait_for(lambda: calls)
+    # Well past the original lease
+    time.sleep(0.8)
+    assert queue.claim() is None
+    release.set()
+    wait_for(lambda: queue.get(job_id)["status"] == SUCCEEDED)
+    pool.stop(timeout=5)
+    assert calls == ["When is the Shema said?"]
+
+
+def test_a_lost_claim_cannot_record_its_outcome(tmp_path):
+    queue = JobQueue(path=str(tmp_path / "jobs.sqlite3"), lease_seconds=0)
+    job_id = queue.enqueue("When is the Shema said?")
+    first = queue.claim()
+    second = queue.claim()
+    assert second["attempts"] == 2
+
+    assert not queue.complete(job_id, first["attempts"], {"answer": "stale"})
+    assert not queue.renew(job_id, first["attempts"])
+    assert queue.complete(job_id, second["attempts"], {"answer": "fresh"})
+    assert queue.get(job_id)["result"] == {"answer": "fresh"}
+
+
+def test_pool_can_be_restarted(tmp_path):
+    queue = JobQueue(path=str(tmp_path / "jobs.sqlite3"))
+    pool = JobWorkerPool(queue, lambda query: {"answer": query}, workers=2, poll_interval=0.01)
+    pool.start()
+    pool.stop(timeout=5)
+
+    pool.start()
+    job_id = queue.enqueue("When is the Shema said?")
+    wait_for(lambda: queue.get(job_id)["status"] == SUCCEEDED)
+    pool.stop(timeout=5)
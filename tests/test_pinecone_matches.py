@@ -0,0 +1,37 @@
+import httpx
+from talmud_query import pinecone_utils
+from talmud_query.pinecone_utils import parse_pinecone_matches, query_vectors
+
+
+def test_passage_ids_from_metadata_or_vector_id():
+    response = {"matches": [
+        {"id": "12-0", "score": 0.9},
+        {"id": "passage-7", "score": 0.8, "metadata": {"passage_id": 7, "book_name": "Berakhot"}},
+        {"id": "3a9f-c2", "score": 0.7},
+    ]}
+    assert [(match["passage_id"], match["score"]) for match in parse_pinecone_matches(response)] == [(12, 0.9), (7, 0.8)]
+
+
+class FakeHttpClient:
+    """Answers /query like a slim index whose vectors come from another writer, so ids aren't "<passage_id>-<chunk>"."""
+
+    def __init__(self):
+        self.requests = []
+
+    def post(self, url, headers, json):
+        self.requests.append(json)
+        match = {"id": "passage-7", "score": 0.8}
+        if json["includeMetadata"]:
+            match["metadata"] = {"passage_id": 7}
+        return httpx.Response(200, json={"matches": [match]}, request=httpx.Request("POST", url))
+
+
+def test_slim_query_falls_back_to_metadata_for_unknown_ids(monkeypatch):
+    client = FakeHttpClient()
+    monkeypatch.setattr(pinecone_utils, "SLIM_VECTOR_METADATA", True)
+    monkeypatch.setattr(pinecone_utils, "get_http_client", lambda: client)
+
+    response = query_vectors([0.1, 0.2], index_endpoint="index.example.com", namespace="passages", top_k=1)
+
+    assert [request["includeMetadata"] for request in client.requests] == [False, True]
+    assert [match["passage_id"] for match in parse_pinecone_matches(response)] == [7]
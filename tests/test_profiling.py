@@ -0,0 +1,36 @@
+import os
+import time
+import main
+from talmud_query import profiling
+
+
+def test_profile_is_released_and_only_linked_for_api_key_holders(monkeypatch):
+    monkeypatch.setattr(main, "profile_trigger", lambda requested: "header" if requested else "sampled")
+    client = main.app.test_client()
+
+    response = client.get("/cache/stats", headers={"X-API-Key": "wrong"})
+    response.close()
+    assert response.status_code == 401
+    assert "X-Profile-URL" not in response.headers
+    assert profiling._current_profile.get() is None
+
+    response = client.get("/cache/stats", headers={"X-API-Key": os.getenv("API_KEY"), "X-Profile": "1"})
+    response.close()
+    assert response.headers["X-Profile-URL"].startswith("/profiles/")
+    assert profiling._current_profile.get() is None
+
+
+def test_pruning_keeps_the_newest_profiles(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    ids = [f"{index:032x}" for index in range(4)]
+    for index, profile_id in enumerate(ids):
+        for format in (None, *profiling.FORMATS):
+            path = profiling.profile_path(profile_id, format)
+            # Unreadable metadata: pruning must not need to parse it
+            with open(path, "w") as f:
+                f.write("not json")
+            os.utime(path, (time.time() + index, time.time() + index))
+
+    profiling.prune_profiles(max_files=2)
+    assert profiling.profile_ids() == [ids[3], ids[2]]
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(profiling.profile_path(profile_id, format)) for profile_id in ids[2:] for format in (None, *profiling.FORMATS))
@@ -0,0 +1,98 @@
+import asyncio
+import time
+from types import SimpleNamespace
+from talmud_query import rate_limit
+from talmud_query.rate_limit import RateLimiter, quota_group, PRIORITY_FILTER, PRIORITY_FINAL_ANSWER
+
+
+class SlowRateLimiter(RateLimiter):
+    """Every SQLite attempt takes a while, so a cancellation lands while the thread is still writing."""
+
+    def _try_acquire(self, *args):
+        time.sleep(0.2)
+        return super()._try_acquire(*args)
+
+
+def waiter_count(limiter):
+    return limiter._connection().execute("SELECT COUNT(*) FROM waiters").fetchone()[0]
+
+
+def test_cancelled_waiter_leaves_no_row_behind(tmp_path):
+    limiter = SlowRateLimiter(path=str(tmp_path / "rate_limit.sqlite3"))
+    # Paused, so the attempt queues the waiter instead of taking capacity
+    limiter.pause("gpt-4o", 5)
+
+    async def cancel_while_acquiring():
+        task = asyncio.create_task(limiter.acquire_async("gpt-4o", PRIORITY_FILTER, 100))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        # The attempt's thread finishes after the cancellation; the cleanup runs once it has
+        await asyncio.sleep(0.5)
+
+    asyncio.run(cancel_while_acquiring())
+    assert waiter_count(limiter) == 0
+
+
+def test_cancelled_waiter_does_not_block_the_next_caller(tmp_path):
+    limiter = SlowRateLimiter(path=str(tmp_path / "rate_limit.sqlite3"))
+    limiter.pause("gpt-4o", 0.3)
+
+    async def run():
+        task = asyncio.create_task(limiter.acquire_async("gpt-4o", PRIORITY_FILTER, 100))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        started = time.monotonic()
+        await limiter.acquire_async("gpt-4o", PRIORITY_FILTER, 100)
+        return time.monotonic() - started
+
+    assert asyncio.run(run()) < 2
+
+
+def test_snapshots_share_their_alias_quota():
+    assert quota_group("gpt-4o-2024-08-06") == quota_group("gpt-4o") == "gpt-4o"
+    assert quota_group("gpt-4o-mini") == "gpt-4o-mini"
+
+
+def test_final_answer_does_not_wait_behind_a_filter_burst(tmp_path, monkeypatch):
+    # Filtering and the final answer draw on one quota of 10 requests a minute; filtering leaves 2 of them free
+    monkeypatch.setattr(rate_limit, "OPENAI_QUOTA_GROUPS", {"gpt-4o-mini": "shared", "gpt-4o": "shared"})
+    monkeypatch.setattr(rate_limit, "OPENAI_RATE_LIMITS", {"shared": {"rpm": 10, "tpm": 1000000}})
+    monkeypatch.setattr(rate_limit, "RATE_LIMIT_FILTER_RESERVE", 0.2)
+    limiter = RateLimiter(path=str(tmp_path / "rate_limit.sqlite3"))
+
+    async def run():
+        burst = [asyncio.create_task(limiter.acquire_async("gpt-4o-mini", PRIORITY_FILTER, 100)) for _ in range(12)]
+        await asyncio.sleep(0.3)
+        through = sum(task.done() for task in burst)
+        started = time.monotonic()
+        await limiter.acquire_async("gpt-4o-2024-08-06", PRIORITY_FINAL_ANSWER, 100)
+        waited = time.monotonic() - started
+        for task in burst:
+            task.cancel()
+        await asyncio.gather(*burst, return_exceptions=True)
+        return through, waited
+
+    through, waited = asyncio.run(run())
+    assert through == 8
+    assert waited < 0.5
+
+
+def test_a_call_with_free_capacity_is_one_transaction(tmp_path):
+    limiter = RateLimiter(path=str(tmp_path / "rate_limit.sqlite3"))
+    transactions = []
+    original = limiter._transaction
+    limiter._transaction = lambda work: transactions.append(work) or original(work)
+
+    limiter.acquire("gpt-4o", PRIORITY_FINAL_ANSWER, 100)
+    limiter.settle("gpt-4o", 100, SimpleNamespace(total_tokens=400))
+    limiter.acquire("gpt-4o", PRIORITY_FINAL_ANSWER, 100)
+
+    assert len(transactions) == 2
+    assert waiter_count(limiter) == 0
+    tokens = limiter._connection().execute("SELECT tokens FROM buckets WHERE model = 'gpt-4o'").fetchone()[0]
+    # Both estimates and the 300 token correction, less what refilled in between
+    assert rate_limit.OPENAI_TPM_LIMIT - 500 <= tokens < rate_limit.OPENAI_TPM_LIMIT - 400
@@ -0,0 +1,32 @@
+import pytest
+from talmud_query.references import parse_references
+
+
+@pytest.mark.parametrize("query, pages", [
+    ("Berakhot 2a", ["2a"]),
+    ("what does bava metzia 59b say about the oven", ["59b"]),
+    ("Rosh Hashanah 16a-b", ["16a", "16b"]),
+    ("Menachot 29b: Moshe in the academy of Rabbi Akiva", ["29b"]),
+    ("Sanhedrin daf 37 amud a", ["37a"]),
+    ("Berakhot daf 2 on the evening Shema", ["2a", "2b"]),
+    ("Berakhot 2", ["2a", "2b"]),
+    ("What is discussed in Berakhot 2?", ["2a", "2b"]),
+    ("Berakhot 2.", ["2a", "2b"]),
+    ("Berakhot 3:-4 on the Shema", ["3b", "4a", "4b"]),
+])
+def test_page_references(query, pages):
+    assert [reference["page_numbers"] for reference in parse_references(query)] == [pages]
+
+
+@pytest.mark.parametrize("query", [
+    "Berakhot 2 times a day",
+    "does Berakhot 3 blessings come before the Shema",
+    "Sanhedrin 23 judges for capital cases",
+    "Berakhot 2 a day",
+    "Berakhot 2-3 cases",
+    # A sentence-ending period is not the "." amud marker
+    "Berakhot 2. What does it say about the Shema?",
+    "Sanhedrin 37: who may judge",
+])
+def test_bare_numbers_are_not_page_references(query):
+    assert parse_references(query) == []
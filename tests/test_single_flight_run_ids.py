@@ -0,0 +1,54 @@
+import asyncio
+import threading
+import uuid
+import main
+from langsmith import Client
+from langsmith.run_helpers import tracing_context
+
+
+class RecordingClient(Client):
+    """Keeps the runs that would have been sent to LangSmith."""
+
+    def __init__(self):
+        super().__init__(api_key="test-key", auto_batch_tracing=False)
+        self.runs = []
+
+    def create_run(self, **run):
+        self.runs.append(run)
+
+    def update_run(self, run_id, **run):
+        self.runs.append({"id": run_id, **run})
+
+
+def test_coalesced_callers_get_their_own_run_ids(monkeypatch):
+    leader_run_id = uuid.uuid4()
+    started = threading.Event()
+
+    async def pipeline(query, **kwargs):
+        started.set()
+        await asyncio.sleep(0.3)
+        return [{"answer": "Three times a day", "relevant_passage_ids": [1]}, leader_run_id]
+
+    monkeypatch.setattr(main, "ANSWER_CACHE_ENABLED", False)
+    monkeypatch.setattr(main, "SINGLE_FLIGHT_ENABLED", True)
+    monkeypatch.setattr(main, "talmud_query_v2_async", pipeline)
+    client = RecordingClient()
+    results = {}
+
+    def ask(name):
+        with tracing_context(enabled=True, client=client):
+            results[name] = main.answer_query("How often is the Amidah said")
+
+    leader = threading.Thread(target=ask, args=("leader",))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=ask, args=("follower",))
+    follower.start()
+    leader.join()
+    follower.join()
+
+    assert results["leader"]["run_id"] == str(leader_run_id)
+    assert results["follower"]["coalesced"]
+    assert results["follower"]["run_id"] != str(leader_run_id)
+    follower_run = [run for run in client.runs if str(run["id"]) == results["follower"]["run_id"]][-1]
+    assert follower_run["extra"]["metadata"]["leader_run_id"] == str(leader_run_id)
@@ -0,0 +1,79 @@
+import asyncio
+from talmud_query import talmud_query
+from talmud_query.talmud_query import talmud_query_v2_async, expansion_cache, expansion_cache_key
+
+MODEL = "gpt-4o-2024-08-06"
+AVAILABLE_MD = ["book_name", "page_number"]
+PASSAGES = [
+    {"passage_id": 1, "english_text": "The evening Shema", "book_name": "Berakhot", "page_number": "2a"},
+    {"passage_id": 2, "english_text": "Carrying on Shabbat", "book_name": "Eiruvin", "page_number": "2a"},
+]
+
+
+class FakePipeline:
+    """Stands in for OpenAI and Pinecone, recording the filter of every vector lookup."""
+
+    def __init__(self, expansion):
+        self.expansion = expansion
+        self.lookup_filters = []
+
+    async def get_queries_from_openai_async(self, query, *args, **kwargs):
+        return self.expansion
+
+    async def embed_text_openai_batch_async(self, texts):
+        return [[1.0, 0.0] for text in texts]
+
+    async def get_ranked_lists_from_vdb_async(self, embedded_queries, filter, index_name, namespaces, k):
+        self.lookup_filters.append(filter)
+        return [[passage for passage in PASSAGES if talmud_query.passage_matches_filter(passage, filter)] for _ in embedded_queries]
+
+    async def async_filter_context(self, query, context, **kwargs):
+        return context
+
+    async def get_final_answer_async(self, query, context, *args, **kwargs):
+        return {"answer": "An answer", "relevant_passage_ids": [passage["passage_id"] for passage in context]}
+
+
+def use_pipeline(monkeypatch, pipeline):
+    for name in ("get_queries_from_openai_async", "embed_text_openai_batch_async", "get_ranked_lists_from_vdb_async", "async_filter_context", "get_final_answer_async"):
+        monkeypatch.setattr(talmud_query, name, getattr(pipeline, name))
+    monkeypatch.setattr(talmud_query, "get_reference_context", lambda query: None)
+    monkeypatch.setattr(talmud_query, "get_async_openai_client", lambda traced=True: None)
+    monkeypatch.setattr(talmud_query, "SPECULATIVE_RETRIEVAL_ENABLED", True)
+    monkeypatch.setattr(talmud_query, "FULLTEXT_ENABLED", False)
+    monkeypatch.setattr(talmud_query, "RERANK_ENABLED", False)
+
+
+def test_raw_query_lookups_use_the_tractate_the_query_names(monkeypatch):
+    expansion_cache.clear()
+    pipeline = FakePipeline({"filter": {"book_name": "Berakhot"}, "query1": "When is the evening Shema recited?"})
+    use_pipeline(monkeypatch, pipeline)
+
+    answer, run_id = asyncio.run(talmud_query_v2_async("What does Berakhot say about the Shema?"))
+    assert len(pipeline.lookup_filters) == 2
+    assert {"book_name": {"$in": ["Berakhot"]}} in pipeline.lookup_filters
+    assert answer["relevant_passage_ids"] == [1]
+
+
+def test_no_speculation_once_the_expansion_is_cached(monkeypatch):
+    expansion_cache.clear()
+    query = "When is the Shema said?"
+    expansion = {"filter": {"book_name": "Berakhot"}, "query1": "When is the evening Shema recited?"}
+    expansion_cache.set(expansion_cache_key(query, MODEL, AVAILABLE_MD, 4), expansion)
+    pipeline = FakePipeline(expansion)
+    use_pipeline(monkeypatch, pipeline)
+
+    asyncio.run(talmud_query_v2_async(query))
+    assert pipeline.lookup_filters == [{"book_name": "Berakhot"}]
+
+
+def test_raw_query_is_looked_up_when_the_expansion_fails(monkeypatch):
+    expansion_cache.clear()
+    # get_queries_from_openai_async returns "" on error
+    pipeline = FakePipeline("")
+    use_pipeline(monkeypatch, pipeline)
+    monkeypatch.setattr(talmud_query, "SPECULATIVE_RETRIEVAL_ENABLED", False)
+
+    answer, run_id = asyncio.run(talmud_query_v2_async("When is the Shema said?"))
+    assert pipeline.lookup_filters == [None]
+    assert answer["relevant_passage_ids"] == [1, 2]
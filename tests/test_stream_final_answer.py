@@ -0,0 +1,97 @@
+import asyncio
+import json
+import httpx
+import openai
+import pytest
+from types import SimpleNamespace
+from talmud_query.talmud_query import stream_final_answer_async, AnswerStreamInterrupted
+
+CONTEXT = [{"passage_id": 1, "english_text": "The evening Shema", "hebrew_text": "", "book_name": "Berakhot", "page_number": "2a"}]
+
+
+class Delta:
+    type = "content.delta"
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+
+class FailingStream:
+    """Sends the given snapshots, then drops the connection."""
+
+    def __init__(self, snapshots):
+        self.snapshots = snapshots
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    def __aiter__(self):
+        return self.events()
+
+    async def events(self):
+        for snapshot in self.snapshots:
+            yield Delta(snapshot)
+        raise openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+
+
+class CompleteStream(FailingStream):
+    """Sends the whole answer and finishes normally."""
+
+    def __init__(self, answer):
+        super().__init__([json.dumps({"answer": answer, "relevant_passage_ids": [1]})])
+        self.answer = answer
+
+    async def events(self):
+        for snapshot in self.snapshots:
+            yield Delta(snapshot)
+
+    async def get_final_completion(self):
+        parsed = SimpleNamespace(model_dump=lambda: {"answer": self.answer, "relevant_passage_ids": [1]})
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(parsed=parsed))],
+            usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5, total_tokens=15),
+        )
+
+
+class FakeCompletions:
+    def __init__(self, streams):
+        self.streams = streams
+        self.calls = 0
+
+    def stream(self, **kwargs):
+        self.calls += 1
+        return self.streams.pop(0)
+
+
+class FakeClient:
+    def __init__(self, streams):
+        self.beta = type("Beta", (), {})()
+        self.beta.chat = type("Chat", (), {})()
+        self.beta.chat.completions = FakeCompletions(streams)
+
+
+def test_stream_is_not_retried_after_the_first_delta():
+    first = json.dumps({"answer": "The first"})[:-2]
+    second = json.dumps({"answer": "A different answer entirely"})[:-2]
+    client = FakeClient([FailingStream([first]), FailingStream([second])])
+    deltas = []
+
+    with pytest.raises(AnswerStreamInterrupted):
+        asyncio.run(stream_final_answer_async("why?", CONTEXT, openai_client=client, on_delta=deltas.append))
+
+    assert client.beta.chat.completions.calls == 1
+    assert "".join(deltas) == "The first"
+
+
+def test_stream_failing_before_any_delta_is_retried():
+    client = FakeClient([FailingStream([]), CompleteStream("The whole answer")])
+    deltas = []
+
+    final_answer = asyncio.run(stream_final_answer_async("why?", CONTEXT, openai_client=client, on_delta=deltas.append))
+
+    assert client.beta.chat.completions.calls == 2
+    assert final_answer["answer"] == "The whole answer"
+    assert "".join(deltas) == "The whole answer"
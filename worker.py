@@ -0,0 +1,20 @@
+import os
+import signal
+import threading
+from main import job_pool
+
+# Drains the /query job queue in its own process, so pipeline throughput scales separately from the
+# web workers. Run it on the same host as the web process (the queue is a local SQLite file) and set
+# JOB_WORKERS=0 for the web process if it should only accept jobs.
+#
+#   JOB_WORKERS=8 python worker.py
+
+if __name__ == '__main__':
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+
+    job_pool.start()
+    print(f"Running {job_pool.workers} job workers (pid {os.getpid()})")
+    stopped.wait()
+    job_pool.stop(timeout=30)